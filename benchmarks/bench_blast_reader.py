@@ -0,0 +1,91 @@
+"""
+Benchmark the columnar BlastReader.read_blast_table against the previous line-by-line parser on a synthetic annotated BLAST table.
+With several hits per ZOTU, the columnar reader also computes the lowest common ancestor of the hits.
+Reports the parse time, and the peak memory allocated while parsing in a second run under tracemalloc (which also tracks
+NumPy buffers, but slows the parsers down too much to time them).
+
+Usage:
+    python benchmarks/bench_blast_reader.py --rows 1000000 --hits-per-zotu 50 --workdir /scratch/bench
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+from analysis_toolkit.read.read_blast_csv import BlastReader
+
+N_SPECIES = 2000
+
+
+def write_table(path: str, n_rows: int, hits_per_zotu: int, seed: int = 0):
+    """
+    Write an annotated BLAST table like AssignTaxaStage does: a few hits per ZOTU from a pool of species.
+    """
+    rng = random.Random(seed)
+    lineages = []
+    for n in range(N_SPECIES):
+        genus = f"Genus{n // 5}"
+        lineages.append(f"{genus} species{n}:{n % 3},{genus},Family{n // 40},Order{n // 200},Actinopteri,Chordata,Metazoa")
+    with open(path, "w") as handle:
+        for i in range(n_rows):
+            length = rng.randint(160, 180)
+            mismatch = rng.randint(0, 15)
+            handle.write(
+                f"Zotu{i // hits_per_zotu + 1},gb|AB{rng.randrange(10 ** 6):06d}.1|,{rng.choice(lineages)},"
+                f"{100 * (length - mismatch) / length:.3f},{length},{mismatch},0,1,{length},1,{length},"
+                f"{rng.random() * 1e-40:.2e},{1.8 * (length - 2 * mismatch):.1f}\n"
+            )
+
+
+def legacy_read(path: str) -> dict:
+    reader = BlastReader()
+    with open(path, "r") as file:
+        for line in file.readlines():
+            reader.process_line(line)
+    return reader.hap2level
+
+
+def columnar_read(path: str) -> dict:
+    reader = BlastReader()
+    reader.read_blast_table(path)
+    return reader.hap2level
+
+
+def measure(func, path: str) -> tuple[float, float, dict]:
+    start = time.perf_counter()
+    result = func(path)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    func(path)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak / (1 << 20), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1000000, help="Number of hits in the table.")
+    parser.add_argument("--hits-per-zotu", type=int, default=1, help="Number of hits of every ZOTU (maxhitnum).")
+    parser.add_argument("--workdir", default=None, help="Directory for the synthetic table. Default: a temporary directory.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+        path = os.path.join(workdir, "bench_blast.csv")
+        print(f"Writing {args.rows} BLAST hits to {path} ...")
+        write_table(path, args.rows, args.hits_per_zotu)
+        print(f"Table size: {os.path.getsize(path) / (1 << 20):.1f} MB")
+
+        legacy_s, legacy_mb, legacy = measure(legacy_read, path)
+        columnar_s, columnar_mb, columnar = measure(columnar_read, path)
+        if args.hits_per_zotu == 1:
+            assert columnar == legacy, "The columnar reader differs from the line parser."
+        hits = BlastReader().read_blast_columns(path)
+        print(f"{'line parser':>12}: {legacy_s:8.2f} s  {args.rows / legacy_s:12.0f} rows/s  peak {legacy_mb:8.1f} MB")
+        print(f"{'columnar':>12}: {columnar_s:8.2f} s  {args.rows / columnar_s:12.0f} rows/s  peak {columnar_mb:8.1f} MB")
+        print(f"Typed hit table: {hits.memory_usage(deep=True).sum() / (1 << 20):.1f} MB for {len(hits)} rows and {len(hits.columns)} columns")
+
+
+if __name__ == "__main__":
+    main()
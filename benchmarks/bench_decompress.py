@@ -0,0 +1,109 @@
+"""
+Benchmark DecompressStage against the previous line-by-line gunzip on a synthetic paired-end sample.
+
+Usage:
+    python benchmarks/bench_decompress.py --size-mb 2048 --workdir /scratch/bench
+"""
+import argparse
+import gzip
+import hashlib
+import os
+import random
+import tempfile
+import time
+
+from analysis_toolkit.runner_build.base_logger import logger
+from fastq_processor.step_build.stage_config import StageConfig
+from fastq_processor.step_exec.decompress import BACKENDS, DecompressStage
+
+READ_LEN = 250
+READS_PER_CHUNK = 2000
+N_CHUNKS = 16
+
+
+def make_chunks(seed: int = 0) -> list[list[tuple[str, str]]]:
+    rng = random.Random(seed)
+    return [
+        [("".join(rng.choices("ACGT", k=READ_LEN)), "".join(rng.choices("FGHI:,", k=READ_LEN))) for _ in range(READS_PER_CHUNK)]
+        for _ in range(N_CHUNKS)
+    ]
+
+
+def write_fastq_gz(path: str, size_mb: int, read: int, chunks: list):
+    """
+    Write a gzipped FASTQ of about 'size_mb' MB uncompressed, cycling through pre-generated random reads.
+    """
+    target = size_mb * 1024 * 1024
+    written = 0
+    n = 0
+    with gzip.open(path, "wt", compresslevel=6) as handle:
+        while written < target:
+            chunk = chunks[(n // READS_PER_CHUNK) % N_CHUNKS]
+            records = []
+            for seq, qual in chunk:
+                n += 1
+                records.append(f"@M00001:1:000000000-A1B2C:1:1101:{n}:1 {read}:N:0:1\n{seq}\n+\n{qual}\n")
+            block = "".join(records)
+            handle.write(block)
+            written += len(block)
+
+
+def legacy_gunzip(infiles: list[str], outfiles: list[str]):
+    for infile, outfile in zip(infiles, outfiles):
+        with gzip.open(infile, 'rb')as in_handler, open(outfile, 'wb') as out_handler:
+            for line in in_handler:
+                out_handler.write(line)
+
+
+def sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as handle:
+        while block := handle.read(1 << 20):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-mb", type=int, default=1024, help="Uncompressed size of each of R1 and R2, in MB.")
+    parser.add_argument("--workdir", default=None, help="Directory for the synthetic files. Default: a temporary directory.")
+    parser.add_argument("--backends", nargs="+", default=[backend for backend in BACKENDS if backend != "auto"])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+        fastq_dir = os.path.join(workdir, "fastq")
+        save_dir = os.path.join(workdir, "decompress")
+        os.makedirs(fastq_dir)
+        os.makedirs(save_dir)
+
+        chunks = make_chunks()
+        infiles = [os.path.join(fastq_dir, f"bench_R{read}.fastq.gz") for read in (1, 2)]
+        outfiles = [os.path.join(save_dir, f"bench_R{read}.fastq") for read in (1, 2)]
+        print(f"Writing 2 x {args.size_mb} MB of synthetic FASTQ.GZ to {fastq_dir} ...")
+        for read, infile in enumerate(infiles, start=1):
+            write_fastq_gz(infile, args.size_mb, read, chunks)
+
+        start = time.perf_counter()
+        legacy_gunzip(infiles, outfiles)
+        legacy_time = time.perf_counter() - start
+        expected = [sha256(path) for path in outfiles]
+        print(f"{'legacy':>8}: {legacy_time:8.2f} s")
+
+        config = StageConfig(verbose=False, logger=logger, n_cpu=2)
+        for backend in args.backends:
+            stage = DecompressStage(config, fastq_dir=fastq_dir, save_dir=save_dir, backend=backend)
+            if stage.backend != backend:
+                print(f"{backend:>8}: not available")
+                continue
+            for path in outfiles:
+                os.remove(path)
+            stage.setup("bench")
+            start = time.perf_counter()
+            is_complete = stage.run()
+            elapsed = time.perf_counter() - start
+            identical = is_complete and [sha256(path) for path in outfiles] == expected
+            print(f"{backend:>8}: {elapsed:8.2f} s  speed-up {legacy_time / elapsed:5.2f}x  identical={identical}")
+
+
+if __name__ == "__main__":
+    main()
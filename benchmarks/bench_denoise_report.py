@@ -0,0 +1,118 @@
+"""
+Benchmark the tab-field DenoiseReportReader.read_denoise_report against the previous regular-expression parser
+on a synthetic usearch -tabbedout report.
+
+Usage:
+    python benchmarks/bench_denoise_report.py --lines 3000000 --amp-fraction 0.3 --workdir /scratch/bench
+"""
+import argparse
+import os
+import random
+import re
+import tempfile
+import time
+
+from analysis_toolkit.read.read_denoise_report import DenoiseReportReader
+
+
+def write_report(path: str, n_lines: int, amp_fraction: float = 0.01, chimera_fraction: float = 0.1, seed: int = 0):
+    """
+    Write a -tabbedout report like DenoiseStage does: 'denoise' lines by decreasing size, noise pointing to an earlier amplicon,
+    then a 'chfilter' line per amplicon.
+    """
+    rng = random.Random(seed)
+    amplicons = []
+    with open(path, "w") as handle:
+        for i in range(1, n_lines + 1):
+            size = max(1, n_lines * 10 // i)
+            if not amplicons or rng.random() < amp_fraction:
+                amplicons.append((f"Uniq{i}", size))
+                handle.write(f"Uniq{i};size={size};\tdenoise\tamp{len(amplicons)}\n")
+            else:
+                top = rng.choice(amplicons)[0]
+                handle.write(f"Uniq{i};size={size};\tdenoise\tnoise\ttop={top}\n")
+        for name, size in amplicons:
+            handle.write(f"{name};size={size};\tchfilter\t{'chimera' if rng.random() < chimera_fraction else 'zotu'}\n")
+
+
+class LegacyDenoiseReportReader:
+    """
+    The previous parser of DenoiseReportReader, matching every line with regular expressions into plain dictionaries.
+    """
+    RE_DENOISE_PATTERN = re.compile(r"(Uniq\d*)|size=(\d*)|(amp\d*)|top=(Uniq\d*)")
+    RE_CHFILTER_PATTERN = re.compile(r"(Uniq\d*)|size=(\d*)|(zotu)|(chimera)")
+
+    def __init__(self):
+        self.amp_size = {}
+        self.hap2amp = {}
+        self.hap_size = {}
+
+    def process_denoise_line(self, line: str):
+        amplicon, size, top = ["".join(t) for t in self.RE_DENOISE_PATTERN.findall(line)]
+        # If Top is "ampXX", it is a true amplicon, otherwise, it is a noise.
+        if 'amp' in top:
+            top = amplicon
+        self.amp_size[amplicon] = size
+        self.hap2amp.setdefault(top, []).append(amplicon)
+
+    def process_chifilter_line(self, line: str, zotu_count: int, chimera_count: int) -> tuple[int, int]:
+        old_top, size, assigned_type = ["".join(t) for t in self.RE_CHFILTER_PATTERN.findall(line)]
+        if assigned_type == 'zotu':
+            zotu_count += 1
+            new_top = f'Zotu{zotu_count}'
+            self.hap_size[new_top] = size
+        else:
+            chimera_count += 1
+            new_top = f'Chimera{chimera_count}'
+        if old_top in self.hap2amp:
+            self.hap2amp[new_top] = self.hap2amp.pop(old_top)
+        return zotu_count, chimera_count
+
+
+def legacy_read(path: str) -> LegacyDenoiseReportReader:
+    reader = LegacyDenoiseReportReader()
+    zotu_count = 0
+    chimera_count = 0
+    with open(path, "r") as file:
+        for line in file.readlines():
+            if 'denoise' in line:
+                reader.process_denoise_line(line)
+            elif 'chfilter' in line:
+                zotu_count, chimera_count = reader.process_chifilter_line(line, zotu_count, chimera_count)
+    return reader
+
+
+def tabbed_read(path: str) -> DenoiseReportReader:
+    reader = DenoiseReportReader()
+    reader.read_denoise_report(path)
+    return reader
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lines", type=int, default=3000000, help="Number of 'denoise' lines in the report.")
+    parser.add_argument("--amp-fraction", type=float, default=0.3, help="Fraction of the 'denoise' lines that are true amplicons.")
+    parser.add_argument("--workdir", default=None, help="Directory for the synthetic report. Default: a temporary directory.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+        path = os.path.join(workdir, "bench_denoise_report.txt")
+        print(f"Writing a report with {args.lines} denoise lines to {path} ...")
+        write_report(path, args.lines, amp_fraction=args.amp_fraction)
+        print(f"Report size: {os.path.getsize(path) / (1 << 20):.1f} MB")
+
+        timings = {}
+        for name, func in [("regex", legacy_read), ("tab fields", tabbed_read)]:
+            start = time.perf_counter()
+            reader = func(path)
+            timings[name] = time.perf_counter() - start
+            print(f"{name:>12}: {timings[name]:8.2f} s  {args.lines / timings[name]:12.0f} lines/s")
+            if name == "regex":
+                legacy = reader
+        assert reader.hap2amp == legacy.hap2amp, "The tab-field parser differs from the regex parser."
+        assert reader.hap_size == {hap: int(size) for hap, size in legacy.hap_size.items()}
+        print(f"Speed-up: {timings['regex'] / timings['tab fields']:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+Benchmark the memory-mapped FastaReader.read_fasta, with and without lazy sequences, against the previous Biopython parser
+on a synthetic unique amplicon FASTA file.
+
+Usage:
+    python benchmarks/bench_fasta_reader.py --records 2000000 --workdir /scratch/bench
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from Bio import SeqIO
+
+from analysis_toolkit.read.read_fasta import FastaReader
+
+
+def write_fasta(path: str, n_records: int, seed: int = 0):
+    """
+    Write a unique amplicon FASTA file like DereplicateStage does: 'UniqN;size=M;' labels and one line per sequence.
+    """
+    rng = random.Random(seed)
+    with open(path, "w") as handle:
+        for i in range(1, n_records + 1):
+            handle.write(f">Uniq{i};size={max(1, n_records // i)};\n{''.join(rng.choices('ACGT', k=rng.randint(160, 180)))}\n")
+
+
+def seqio_read(path: str) -> dict:
+    seq_dict = {}
+    with open(path) as handle:
+        for record in SeqIO.parse(handle, "fasta"):
+            seq_dict[record.description.split(";")[0]] = str(record.seq)
+    return seq_dict
+
+
+def mmap_read(path: str, lazy: bool = False):
+    reader = FastaReader()
+    reader.read_fasta(path, seq_type="Amplicon", lazy=lazy)
+    return reader.seq_dict
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--records", type=int, default=2000000, help="Number of sequences in the FASTA file.")
+    parser.add_argument("--workdir", default=None, help="Directory for the synthetic FASTA file. Default: a temporary directory.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+        path = os.path.join(workdir, "bench_uniq.fasta")
+        print(f"Writing {args.records} sequences to {path} ...")
+        write_fasta(path, args.records)
+        print(f"FASTA size: {os.path.getsize(path) / (1 << 20):.1f} MB")
+
+        timings = {}
+        results = {}
+        for name, func in [("SeqIO", seqio_read), ("mmap", mmap_read), ("mmap lazy", lambda p: mmap_read(p, lazy=True))]:
+            start = time.perf_counter()
+            results[name] = func(path)
+            timings[name] = time.perf_counter() - start
+            print(f"{name:>12}: {timings[name]:8.2f} s  {args.records / timings[name]:12.0f} records/s")
+        assert results["mmap"] == results["SeqIO"], "The mmap reader differs from SeqIO."
+        names = random.Random(1).sample(list(results["SeqIO"]), min(1000, args.records))
+        assert all(results["mmap lazy"][name] == results["SeqIO"][name] for name in names)
+        print(f"Speed-up: {timings['SeqIO'] / timings['mmap']:.1f}x, lazy {timings['SeqIO'] / timings['mmap lazy']:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Benchmark the native paired-end merger of MergeStage against usearch -fastq_mergepairs on synthetic amplicon reads.
+usearch is skipped if it is not on the PATH.
+
+Usage:
+    python benchmarks/bench_merge.py --pairs 1000000 --n-cpu 1 4 --workdir /scratch/bench
+"""
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from analysis_toolkit.runner_build.base_logger import logger
+from fastq_processor.step_build.stage_config import StageConfig
+from fastq_processor.step_exec.merge import COMPLEMENT, MergeStage
+
+READ_LEN = 250
+ERROR_RATE = 0.005
+N_TEMPLATES = 200
+
+
+def write_pairs(decompress_dir: str, n_pairs: int, seed: int = 0) -> list[bytes]:
+    """
+    Write R1/R2 FASTQ of amplicons of 160-280 bases, with substitution errors at low quality.
+
+    :returns: The amplicon of every pair.
+    """
+    rng = random.Random(seed)
+    templates = ["".join(rng.choices("ACGT", k=rng.randint(160, 280))).encode() for _ in range(N_TEMPLATES)]
+    amplicons = []
+    with open(os.path.join(decompress_dir, "bench_R1.fastq"), "wb") as r1, open(os.path.join(decompress_dir, "bench_R2.fastq"), "wb") as r2:
+        for i in range(n_pairs):
+            amplicon = rng.choice(templates)
+            reads = []
+            for seq in (amplicon[:READ_LEN], amplicon.translate(COMPLEMENT)[::-1][:READ_LEN]):
+                seq, qual = bytearray(seq), bytearray(b"I" * len(seq))
+                for pos in range(len(seq)):
+                    if rng.random() < ERROR_RATE:
+                        seq[pos] = ord(rng.choice("ACGT"))
+                        qual[pos] = ord("+")
+                reads.append((bytes(seq), bytes(qual)))
+            r1.write(b"@M00001:1:1101:%d 1:N:0:1\n%s\n+\n%s\n" % (i, *reads[0]))
+            r2.write(b"@M00001:1:1101:%d 2:N:0:1\n%s\n+\n%s\n" % (i, *reads[1]))
+            amplicons.append(amplicon)
+    return amplicons
+
+
+def run_stage(decompress_dir: str, save_dir: str, backend: str, n_cpu: int) -> tuple[float, list[bytes]]:
+    config = StageConfig(verbose=False, logger=logger, n_cpu=n_cpu)
+    stage = MergeStage(config, decompress_dir=decompress_dir, save_dir=save_dir, backend=backend)
+    stage.setup("bench")
+    start = time.perf_counter()
+    if not stage.run():
+        raise RuntimeError(f"The {backend} backend failed.")
+    elapsed = time.perf_counter() - start
+    with open(os.path.join(save_dir, "bench_merge.fastq"), "rb") as handle:
+        lines = handle.read().split(b"\n")
+    return elapsed, lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pairs", type=int, default=200000, help="Number of read pairs.")
+    parser.add_argument("--n-cpu", type=int, nargs="+", default=[1], help="Worker counts to run the native backend with.")
+    parser.add_argument("--workdir", default=None, help="Directory for the synthetic files. Default: a temporary directory.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+        decompress_dir = os.path.join(workdir, "decompress")
+        save_dir = os.path.join(workdir, "merge")
+        os.makedirs(decompress_dir)
+        print(f"Writing {args.pairs} synthetic read pairs to {decompress_dir} ...")
+        amplicons = write_pairs(decompress_dir, args.pairs)
+
+        runs = [("native", n_cpu) for n_cpu in args.n_cpu]
+        if shutil.which("usearch"):
+            runs.append(("usearch", max(args.n_cpu)))
+        else:
+            print(f"{'usearch':>8}: not on the PATH")
+        for backend, n_cpu in runs:
+            elapsed, lines = run_stage(decompress_dir, save_dir, backend, n_cpu)
+            titles, seqs = lines[0::4], lines[1::4]
+            n_correct = sum(seq == amplicons[int(title.split()[0].split(b":")[-1])] for title, seq in zip(titles, seqs) if title)
+            print(f"{backend:>8} (n_cpu={n_cpu}): {elapsed:8.2f} s  {args.pairs / elapsed:10.0f} pairs/s"
+                  f"  merged {len(seqs) - 1}/{args.pairs}, {n_correct} equal to their amplicon")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Benchmark the packed SequenceStore against plain dictionaries of sequences, for samples sharing part of their amplicons.
+Reports the memory allocated to hold the sequences of all the samples (under tracemalloc), the size of the pickled samples,
+and the time to look up every sequence.
+
+Usage:
+    python benchmarks/bench_sequence_store.py --samples 50 --amplicons 20000 --shared 0.5
+"""
+import argparse
+import pickle
+import random
+import time
+import tracemalloc
+
+from analysis_toolkit.runner_exec.sequence_store import SequenceStore
+
+
+def make_samples(n_samples: int, n_amplicons: int, shared: float, seed: int = 0) -> list[dict[str, str]]:
+    """
+    Draw samples of MiFish-sized amplicons: a fraction 'shared' of every sample comes from a pool common to all the samples.
+    """
+    rng = random.Random(seed)
+    pool = ["".join(rng.choices("ACGT", k=rng.randint(160, 180))) for _ in range(n_amplicons)]
+    samples = []
+    for _ in range(n_samples):
+        n_shared = int(n_amplicons * shared)
+        seqs = rng.sample(pool, n_shared) + ["".join(rng.choices("ACGT", k=rng.randint(160, 180))) for _ in range(n_amplicons - n_shared)]
+        samples.append({f"Uniq{i + 1}": seq for i, seq in enumerate(seqs)})
+    return samples
+
+
+def build_dicts(samples: list[dict[str, str]]) -> list[dict[str, str]]:
+    # Sequences read from separate files are separate strings, even when equal.
+    return [{name: "".join(seq) for name, seq in sample.items()} for sample in samples]
+
+
+def build_store(samples: list[dict[str, str]]) -> list:
+    store = SequenceStore()
+    return [store.pack(sample) for sample in samples]
+
+
+def measure(func, samples: list[dict[str, str]]) -> tuple[float, object]:
+    tracemalloc.start()
+    result = func(samples)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return current / (1 << 20), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--samples", type=int, default=50, help="Number of samples.")
+    parser.add_argument("--amplicons", type=int, default=20000, help="Number of amplicons per sample.")
+    parser.add_argument("--shared", type=float, default=0.5, help="Fraction of the amplicons of every sample drawn from a common pool.")
+    args = parser.parse_args()
+
+    samples = make_samples(args.samples, args.amplicons, args.shared)
+    for name, func in [("dict", build_dicts), ("packed", build_store)]:
+        memory_mb, result = measure(func, samples)
+        pickled_mb = len(pickle.dumps(result)) / (1 << 20)
+        start = time.perf_counter()
+        for built, sample in zip(result, samples):
+            for seq_name in sample:
+                built[seq_name]
+        lookup_s = time.perf_counter() - start
+        print(f"{name:>8}: memory {memory_mb:8.1f} MB  pickle {pickled_mb:8.1f} MB  lookups {lookup_s:6.2f} s")
+        if name == "packed":
+            assert all(dict(built.items()) == sample for built, sample in zip(result, samples))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+"""
+Throughput benchmark of every fastq_processor stage and of FastqProcessor end to end, on a synthetic MiFish-like sample.
+
+Each stage runs on the output of the stage before it, once per backend available here: programs that are not on the
+PATH are skipped, and assigntaxa only runs with a BLAST database. For every run, the wall time, reads per second,
+peak memory (over the memory in use before the run, child processes included) and bytes written are recorded. The results are written as JSON together with the commit and the sample
+parameters, so runs of different commits can be compared with --compare.
+
+Usage:
+    python benchmarks/bench_stages.py --n-pairs 200000 --n-cpu 4 --output bench_HEAD.json --compare bench_main.json
+"""
+import argparse
+import dataclasses
+import datetime
+import gzip
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+
+from analysis_toolkit.runner_build.base_logger import logger
+from fastq_processor.run_processor import FastqProcessor
+from fastq_processor.step_build import resource_monitor
+from fastq_processor.step_build.stage_config import StageConfig
+from fastq_processor.step_exec import (decompress, merge, cut_primer, fq_to_fa, dereplicate, denoise, assign_taxa, preprocess)
+
+from synthetic_fastq import SampleSpec, write_sample
+
+PREFIX = "bench"
+# Backends of each stage, with the program they need on the PATH (None: runs in Python).
+STAGE_BACKENDS = {
+    "decompress": [("auto", None)],
+    "merge": [("native", None), ("usearch", "usearch")],
+    "cutprimer": [("native", None), ("cutadapt", "cutadapt")],
+    "fqtofa": [("native", None)],
+    "dereplicate": [("native", None), ("usearch", "usearch")],
+    "denoise": [("usearch", "usearch")],
+    "assigntaxa": [("blastn", "blastn")],
+    "preprocess": [("native", None)],
+}
+# The stage whose output each stage reads.
+STAGE_INPUTS = {
+    "decompress": "fastq",
+    "merge": "decompress",
+    "cutprimer": "merge",
+    "fqtofa": "cutprimer",
+    "dereplicate": "fqtofa",
+    "denoise": "dereplicate",
+    "assigntaxa": "denoise",
+    "preprocess": "decompress",
+}
+
+
+def build_stage(name: str, backend: str, config: StageConfig, dirs: dict, save_dir: str, args):
+    """
+    Build the stage 'name' reading the outputs of the previous stages from 'dirs' and writing into 'save_dir'.
+    """
+    if name == "decompress":
+        return decompress.DecompressStage(config, fastq_dir=dirs["fastq"], save_dir=save_dir, backend=backend)
+    if name == "merge":
+        return merge.MergeStage(config, decompress_dir=dirs["decompress"], save_dir=save_dir, backend=backend)
+    if name == "cutprimer":
+        return cut_primer.CutPrimerStage(config, merge_dir=dirs["merge"], save_dir=save_dir, backend=backend)
+    if name == "fqtofa":
+        return fq_to_fa.FqToFaStage(config, cutprimer_dir=dirs["cutprimer"], save_dir=save_dir)
+    if name == "dereplicate":
+        return dereplicate.DereplicateStage(config, fasta_dir=dirs["fqtofa"], save_dir=save_dir, backend=backend)
+    if name == "denoise":
+        return denoise.DenoiseStage(config, derep_dir=dirs["dereplicate"], save_dir=save_dir)
+    if name == "assigntaxa":
+        return assign_taxa.AssignTaxaStage(config, denoise_dir=dirs["denoise"], save_dir=save_dir,
+                                           db_path=args.db_path, lineage_path=args.lineage_path)
+    return preprocess.PreprocessStage(config, decompress_dir=dirs["decompress"], save_dir=save_dir)
+
+
+def count_records(path: str) -> int:
+    """
+    Number of records of a FASTQ, FASTA or gzipped FASTQ file, from its line count.
+    """
+    if path.endswith(".gz"):
+        with gzip.open(path, "rb") as handle:
+            return sum(1 for _ in handle) // 4
+    with open(path, "rb") as handle:
+        if path.endswith(".fasta"):
+            return sum(line.startswith(b">") for line in handle)
+        return sum(1 for _ in handle) // 4
+
+
+def get_dir_size(path: str) -> int:
+    """
+    Total size of the files under a directory. Symbolic links to directories, like the linked input FASTQ, are not followed.
+    """
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def make_result(name: str, backend: str, n_cpu: int, is_complete: bool, elapsed: float, n_reads: int,
+                peak_rss_mb: float | None, bytes_written: int) -> dict:
+    result = {
+        "stage": name,
+        "backend": backend,
+        "n_cpu": n_cpu,
+        "complete": is_complete,
+        "seconds": round(elapsed, 3),
+        "reads": n_reads,
+        "reads_per_s": round(n_reads / elapsed, 1) if elapsed > 0 else None,
+        "peak_rss_mb": round(peak_rss_mb, 1) if peak_rss_mb is not None else None,
+        "bytes_written": bytes_written,
+    }
+    print(f"{name:>12} {backend:>9} (n_cpu={n_cpu}): {elapsed:8.2f} s  {result['reads_per_s'] or 0:12.0f} reads/s"
+          f"  {result['peak_rss_mb'] or 0:8.1f} MB  {bytes_written / 1e6:9.1f} MB written" + ("" if is_complete else "  FAILED"))
+    return result
+
+
+def get_peak_rss_mb(usage: dict, runners_peak_rss_mb: float = 0.0) -> float:
+    """
+    Peak memory of a run, comparable across commits: the growth of the RSS of this process over its value before the run,
+    plus the child processes, as sampled by 'FunctionMonitor', or the largest peak measured by the runners of a stage
+    (the exact VmHWM of its programs, which a short-lived program can reach between two samples), whichever is larger.
+    """
+    return max(usage["max_rss_mb"], runners_peak_rss_mb)
+
+
+def bench_stages(workdir: str, n_cpu: int, args) -> list[dict]:
+    """
+    Run every stage and backend on the synthetic sample in 'workdir/fastq'.
+    The first backend of each stage writes the directory the next stages read.
+    """
+    config = StageConfig(verbose=False, logger=logger, n_cpu=n_cpu)
+    dirs = {"fastq": os.path.join(workdir, "fastq")}
+    results = []
+    for name, backends in STAGE_BACKENDS.items():
+        for backend, program in backends:
+            if program is not None and shutil.which(program) is None:
+                print(f"{name:>12} {backend:>9}: {program} is not on the PATH")
+                continue
+            if name == "assigntaxa" and not args.db_path:
+                print(f"{name:>12} {backend:>9}: no --db-path")
+                continue
+            previous = STAGE_INPUTS[name]
+            if previous not in dirs:
+                print(f"{name:>12} {backend:>9}: no {previous} output")
+                continue
+            save_dir = os.path.join(workdir, f"{name}_{backend}_{n_cpu}")
+            stage = build_stage(name, backend, config, dirs, save_dir, args)
+            stage.setup(PREFIX)
+            n_reads = count_records(stage.infile)
+            with resource_monitor.FunctionMonitor() as monitor:
+                is_complete = stage.run()
+            results.append(make_result(name, backend, n_cpu, is_complete, monitor.usage["wall_s"], n_reads,
+                                       get_peak_rss_mb(monitor.usage, stage.peak_rss_mb), get_dir_size(save_dir)))
+            if is_complete:
+                dirs.setdefault(name, save_dir)
+    return results
+
+
+def bench_end_to_end(workdir: str, n_cpu: int, args) -> dict:
+    """
+    Run FastqProcessor on the synthetic sample with the native backends and every stage whose programs are available.
+    Peak memory is the growth of the RSS of this process over its value before the run, plus its child processes (see 'get_peak_rss_mb').
+    """
+    parent_dir = os.path.join(workdir, f"end_to_end_{n_cpu}")
+    os.makedirs(parent_dir)
+    os.symlink(os.path.join(workdir, "fastq"), os.path.join(parent_dir, "fastq"))
+    enabled_stages = ["decompress", "merge", "cutprimer", "fqtofa", "dereplicate"]
+    if shutil.which("usearch"):
+        enabled_stages.append("denoise")
+        if args.db_path and shutil.which("blastn"):
+            enabled_stages.append("assigntaxa")
+    with resource_monitor.FunctionMonitor() as monitor:
+        processor = FastqProcessor(parent_dir, "fastq", db_path=args.db_path, lineage_path=args.lineage_path,
+                                   enabled_stages=enabled_stages, verbose=False, n_cpu=n_cpu,
+                                   merge_backend="native", cutprimer_backend="native", derep_backend="native",
+                                   resume=False, record_metrics=False)
+    is_complete = all(result["complete"] for result in processor.summary.values())
+    return make_result("+".join(enabled_stages), "end_to_end", n_cpu, is_complete, monitor.usage["wall_s"], args.n_pairs,
+                       get_peak_rss_mb(monitor.usage), get_dir_size(parent_dir))
+
+
+def get_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: list[dict], previous_path: str):
+    """
+    Print the change in reads per second of every stage, backend and CPU count against a previous results file.
+    """
+    with open(previous_path, "r") as handle:
+        previous = json.load(handle)
+    previous_speed = {(result["stage"], result["backend"], result["n_cpu"]): result["reads_per_s"] for result in previous["results"]}
+    print(f"\nReads/s compared with {previous_path} (commit {previous.get('commit')}):")
+    for result in results:
+        key = (result["stage"], result["backend"], result["n_cpu"])
+        if previous_speed.get(key) and result["reads_per_s"]:
+            print(f"{key[0]:>12} {key[1]:>9} (n_cpu={key[2]}): {100 * (result['reads_per_s'] / previous_speed[key] - 1):+7.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--n-cpu", type=int, nargs="+", default=[1], help="CPU counts to run every stage with.")
+    parser.add_argument("--db-path", default="", help="BLAST database for the assigntaxa stage. Skipped if empty.")
+    parser.add_argument("--lineage-path", default="", help="Lineage table of the BLAST database.")
+    parser.add_argument("--skip-end-to-end", action="store_true", help="Only benchmark the stages one by one.")
+    parser.add_argument("--workdir", default=None, help="Directory for the synthetic files. Default: a temporary directory.")
+    parser.add_argument("--output", default="bench_stages.json", help="Path of the JSON results.")
+    parser.add_argument("--compare", default=None, help="JSON results of a previous run to compare with.")
+    for field in dataclasses.fields(SampleSpec):
+        parser.add_argument(f"--{field.name.replace('_', '-')}", type=type(field.default), default=field.default)
+    args = parser.parse_args()
+    spec = SampleSpec(**{field.name: getattr(args, field.name) for field in dataclasses.fields(SampleSpec)})
+
+    results = []
+    with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+        os.makedirs(os.path.join(workdir, "fastq"))
+        print(f"Writing {spec.n_pairs} synthetic read pairs to {workdir} ...")
+        write_sample(spec, os.path.join(workdir, "fastq"), PREFIX)
+        for n_cpu in args.n_cpu:
+            results += bench_stages(workdir, n_cpu, args)
+            if not args.skip_end_to_end:
+                results.append(bench_end_to_end(workdir, n_cpu, args))
+
+    report = {
+        "commit": get_commit(),
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "sample": dataclasses.asdict(spec),
+        "results": results,
+    }
+    with open(args.output, "w") as handle:
+        json.dump(report, handle, indent=2)
+    print(f"Results written to {args.output}")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""
+Synthetic MiFish-like paired-end samples for the benchmarks.
+
+An amplicon is the MiFish-U forward primer, a 12S insert of one haplotype and the reverse complement of the reverse primer,
+as in the merged reads the pipeline expects. Haplotypes are drawn from a few species with a skewed abundance, so the
+dereplication and denoising stages see realistic duplicate and singleton rates. Reads get Illumina-like qualities that
+drop towards the 3' end, and sequencing errors are substitutions at low quality.
+
+Usage:
+    python benchmarks/synthetic_fastq.py --n-pairs 100000 --out-dir /scratch/bench/fastq --prefix sample1
+"""
+import argparse
+import dataclasses
+import gzip
+import os
+import random
+
+RM_P_5 = "GTCGGTAAAACTCGTGCCAGC"
+RM_P_3 = "CAAACTGGGATTAGATACCCCACTATG"
+COMPLEMENT = str.maketrans("ACGTN", "TGCAN")
+PHRED_OFFSET = 33
+
+
+@dataclasses.dataclass
+class SampleSpec:
+    """
+    Parameters of a synthetic sample.
+
+    Attributes:
+        n_pairs (int): Number of read pairs.
+        read_len (int): Length of R1 and R2. Reads longer than the amplicon (about 220 bases) would be staggered pairs.
+        insert_mean (float): Mean length of the 12S insert between the primers (MiFish: about 170 bases).
+        insert_sd (float): Standard deviation of the insert length across species.
+        error_rate (float): Probability of a substitution at each base, before the quality decay towards the 3' end.
+        n_species (int): Number of species in the sample.
+        haplotypes_per_species (int): Number of haplotypes of each species, a few substitutions from each other.
+        abundance_skew (float): Exponent of the Zipf-like species abundances. 0 makes all species equally abundant.
+        primer_free_rate (float): Fraction of the pairs from off-target products without primers.
+        seed (int): Seed of the random generator. The same spec always gives the same files.
+    """
+    n_pairs: int = 100000
+    read_len: int = 150
+    insert_mean: float = 172.0
+    insert_sd: float = 6.0
+    error_rate: float = 0.002
+    n_species: int = 50
+    haplotypes_per_species: int = 3
+    abundance_skew: float = 1.2
+    primer_free_rate: float = 0.02
+    seed: int = 0
+
+
+def reverse_complement(seq: str) -> str:
+    return seq.translate(COMPLEMENT)[::-1]
+
+
+def make_haplotypes(spec: SampleSpec, rng: random.Random) -> tuple[list[str], list[float]]:
+    """
+    Draw the haplotype inserts of every species and their relative abundances.
+
+    :returns: (inserts, weights), one entry per haplotype.
+    """
+    inserts, weights = [], []
+    for rank in range(1, spec.n_species + 1):
+        length = max(50, round(rng.gauss(spec.insert_mean, spec.insert_sd)))
+        species = "".join(rng.choices("ACGT", k=length))
+        species_weight = 1 / rank ** spec.abundance_skew
+        for n in range(spec.haplotypes_per_species):
+            haplotype = list(species)
+            for pos in rng.sample(range(length), min(n, length)):
+                haplotype[pos] = rng.choice("ACGT".replace(haplotype[pos], ""))
+            inserts.append("".join(haplotype))
+            # The main haplotype of a species dominates its variants.
+            weights.append(species_weight / 4 ** n)
+    return inserts, weights
+
+
+def sequence_read(template: str, read_len: int, error_rate: float, rng: random.Random) -> tuple[str, str]:
+    """
+    Read the first 'read_len' bases of a template, padded with random bases past its end, with substitution errors.
+    The error probability and the qualities decay linearly to four times the start along the read.
+    """
+    seq = list(template[:read_len] + "".join(rng.choices("ACGT", k=max(0, read_len - len(template)))))
+    qual = []
+    for pos in range(read_len):
+        rate = error_rate * (1 + 3 * pos / read_len)
+        if rng.random() < rate:
+            seq[pos] = rng.choice("ACGT".replace(seq[pos], ""))
+            qual.append(chr(PHRED_OFFSET + rng.randint(2, 15)))
+        else:
+            qual.append(chr(PHRED_OFFSET + rng.randint(30, 40) - (8 * pos) // read_len))
+    return "".join(seq), "".join(qual)
+
+
+def get_opener(compress: bool):
+    if compress:
+        return lambda path: gzip.open(path, "wt", compresslevel=1)
+    return lambda path: open(path, "w")
+
+
+def write_sample(spec: SampleSpec, out_dir: str, prefix: str, compress: bool = True) -> tuple[str, str]:
+    """
+    Write the R1 and R2 files of a synthetic sample, named like the pipeline inputs ([prefix]_R1.fastq.gz).
+
+    :param compress: Write gzipped files for the decompress stage. Otherwise write [prefix]_R1.fastq for the later stages.
+    :returns: The paths of R1 and R2.
+    """
+    rng = random.Random(spec.seed)
+    inserts, weights = make_haplotypes(spec, rng)
+    suffix = "fastq.gz" if compress else "fastq"
+    paths = tuple(os.path.join(out_dir, f"{prefix}_{read}.{suffix}") for read in ("R1", "R2"))
+    opener = get_opener(compress)
+    with opener(paths[0]) as r1, opener(paths[1]) as r2:
+        for i in range(spec.n_pairs):
+            if rng.random() < spec.primer_free_rate:
+                amplicon = "".join(rng.choices("ACGT", k=round(spec.insert_mean) + len(RM_P_5) + len(RM_P_3)))
+            else:
+                amplicon = RM_P_5 + rng.choices(inserts, weights)[0] + RM_P_3
+            seq1, qual1 = sequence_read(amplicon, spec.read_len, spec.error_rate, rng)
+            seq2, qual2 = sequence_read(reverse_complement(amplicon), spec.read_len, spec.error_rate, rng)
+            title = f"M00001:1:000000000-A1B2C:1:1101:{i}:1"
+            r1.write(f"@{title} 1:N:0:1\n{seq1}\n+\n{qual1}\n")
+            r2.write(f"@{title} 2:N:0:1\n{seq2}\n+\n{qual2}\n")
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--out-dir", required=True, help="Directory of the FASTQ files.")
+    parser.add_argument("--prefix", default="bench", help="Sample ID of the files.")
+    parser.add_argument("--plain", action="store_true", help="Write uncompressed FASTQ.")
+    for field in dataclasses.fields(SampleSpec):
+        parser.add_argument(f"--{field.name.replace('_', '-')}", type=type(field.default), default=field.default)
+    args = parser.parse_args()
+    spec = SampleSpec(**{field.name: getattr(args, field.name) for field in dataclasses.fields(SampleSpec)})
+    os.makedirs(args.out_dir, exist_ok=True)
+    for path in write_sample(spec, args.out_dir, args.prefix, compress=not args.plain):
+        print(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,16 @@
+import csv
+import os
+
+import numpy as np
+import pandas as pd
+
 from analysis_toolkit.runner_build import base_logger
 
+try:
+    import pyarrow
+except ImportError:  # pyarrow is optional, the C parser of pandas is used without it
+    pyarrow = None
+
 class Reader:
     def __init__(self):
         pass
@@ -11,6 +22,16 @@ class BlastReader(Reader):
     TAX_REPLACMENT = {"Mugil": "Mugilidae"}
                       #"KEY2": "REPLACE2"} # Allow multiple replacements later
 
+    DEFAULT_SPECIFIERS = "qseqid sseqid pident length mismatch gapopen qstart qend sstart send evalue bitscore"
+
+    # Types of the BLAST statistics (outfmt specifiers); the other specifiers are read as strings.
+    # Subject accessions are nearly unique, so they are kept as strings rather than a categorical that would save nothing.
+    STAT_DTYPES = {
+        "pident": "float64", "length": "int32", "mismatch": "int32", "gapopen": "int32", "gaps": "int32",
+        "nident": "int32", "positive": "int32", "qstart": "int32", "qend": "int32", "sstart": "int32", "send": "int32",
+        "qlen": "int32", "slen": "int32", "qcovs": "float64", "qcovhsp": "float64", "evalue": "float64", "bitscore": "float64",
+    }
+
     @staticmethod
     def generate_error_table(error_code:str = ':/\\*?"<>|', replace_symbol: str = '_') -> dict[str, str]:
         """
@@ -25,10 +46,38 @@ class BlastReader(Reader):
         error_symbol = str.maketrans(error_translation)
         return error_symbol
 
-    def __init__(self):
+    def __init__(self, identity_thresholds: dict[str, float] = None, specifiers: str = DEFAULT_SPECIFIERS):
+        """
+        :param identity_thresholds: Minimum percent identity of the hits supporting a name at each level, e.g. {"species": 98, "genus": 95}.
+            Levels not listed have no threshold. Default is None (no thresholds).
+        :param specifiers: The outfmt specifiers the BLAST table was written with (see 'AssignTaxaStage'). Default is the default of 'AssignTaxaStage'.
+        """
         super().__init__()
         self.error_table = BlastReader.generate_error_table()
+        self.identity_thresholds = identity_thresholds or {}
+        unknown = set(self.identity_thresholds) - set(self.DESIRED_LEVEL)
+        if unknown:
+            raise ValueError(f"Invalid levels in identity_thresholds: {sorted(unknown)}. Must be among {self.DESIRED_LEVEL}.")
+        self.hit_columns, self.hit_dtypes = self.get_hit_columns(specifiers)
+        if self.identity_thresholds and "pident" not in self.hit_columns:
+            raise ValueError(f"identity_thresholds need the 'pident' column, which is not in the specifiers: {specifiers}.")
         self.hap2level = {}
+        self.hits = None
+
+    @classmethod
+    def get_hit_columns(cls, specifiers: str) -> tuple[list[str], dict[str, str]]:
+        """
+        Names and types of the columns of the annotated BLAST table: the taxonomic levels are inserted after the second specifier.
+        The first column (the ZOTU IDs) is always named 'qseqid'.
+
+        :param specifiers: The outfmt specifiers the BLAST table was written with.
+        :return: The column names and a dictionary of their dtypes.
+        """
+        fields = specifiers.split()
+        columns = ["qseqid"] + fields[1:2] + cls.DESIRED_LEVEL + fields[2:]
+        dtypes = {column: cls.STAT_DTYPES.get(column, "object") for column in columns}
+        dtypes.update({"qseqid": "category", **dict.fromkeys(cls.DESIRED_LEVEL, "category")})
+        return columns, dtypes
 
     def process_line(self, line: str):
         """
@@ -60,18 +109,99 @@ class BlastReader(Reader):
     def update_hap2level(self, haplotype, hap2level_entry):
         self.hap2level[haplotype] = hap2level_entry
 
+    def read_blast_columns(self, blast_table: str) -> pd.DataFrame:
+        """
+        Parse the BLAST CSV table in bulk into typed columns: the ZOTU IDs and taxonomic names as categoricals, the hit statistics as integers and floats.
+        Illegal characters in the species names are translated and 'TAX_REPLACMENT' is applied to the families, once per distinct name.
+        If the number of fields does not match the specifiers, only the ZOTU IDs, subject IDs and taxonomic names are read.
+
+        :param blast_table: Path to the BLAST CSV table.
+        :return: One row per hit, with the columns of 'hit_columns'.
+        """
+        if os.path.getsize(blast_table) == 0:  # samples without hits, the pyarrow engine cannot read them
+            return self.empty_hits()
+        with open(blast_table, newline="") as f:
+            n_fields = len(next(csv.reader(f)))
+        columns = self.hit_columns
+        if n_fields != len(columns):
+            if self.identity_thresholds:
+                raise ValueError(f"{blast_table} has {n_fields} columns, while the specifiers give {len(columns)}. Cannot apply identity_thresholds.")
+            base_logger.logger.warning(f"{blast_table} has {n_fields} columns, while the specifiers give {len(columns)}. Reading the leading columns only.")
+            columns = columns[:2 + len(self.DESIRED_LEVEL)]
+        try:
+            hits = pd.read_csv(blast_table, header=None, names=columns, usecols=range(len(columns)),
+                               dtype={column: self.hit_dtypes[column] for column in columns}, keep_default_na=False,
+                               engine="pyarrow" if pyarrow is not None else "c")
+        except pd.errors.EmptyDataError:
+            return self.empty_hits()
+        hits["species"] = self.map_names(hits["species"], lambda name: name.translate(self.error_table))
+        hits["family"] = self.map_names(hits["family"], lambda name: self.TAX_REPLACMENT.get(name, name))
+        return hits
+
+    def empty_hits(self) -> pd.DataFrame:
+        return pd.DataFrame({column: pd.Series(dtype=dtype) for column, dtype in self.hit_dtypes.items()})
+
+    @staticmethod
+    def map_names(names: pd.Series, func) -> pd.Series:
+        """
+        Apply 'func' to every distinct name of a categorical column, keeping it categorical.
+        """
+        mapping = {name: func(name) for name in names.cat.categories}
+        return names.map(mapping).astype("category")
+
+    def get_consensus(self, hits: pd.DataFrame) -> pd.DataFrame:
+        """
+        Lowest common ancestor of the hits of every haplotype.
+        The hits are grouped by sorting the haplotype codes once, and each level is resolved for all haplotypes at once:
+        a name is assigned if all the hits of a haplotype passing the identity threshold of that level agree on it, and all the levels above it are assigned.
+        The other levels are left empty. With a single hit per haplotype and no thresholds, this is the hit itself.
+
+        :param hits: Hits as returned by 'read_blast_columns'.
+        :return: One row per haplotype, in order of first appearance, with the haplotype as the index and the columns of 'DESIRED_LEVEL'.
+        """
+        if hits.empty:
+            return pd.DataFrame(columns=self.DESIRED_LEVEL, dtype=object)
+        qseqid = hits["qseqid"].astype("category")
+        order = np.argsort(qseqid.cat.codes.to_numpy(), kind="stable")
+        sorted_codes = qseqid.cat.codes.to_numpy()[order]
+        starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+        first_rows = order[starts]
+        # Without the 'pident' column there are no thresholds (see '__init__'), so all the hits pass.
+        pident = hits["pident"].to_numpy()[order] if "pident" in hits else np.full(len(order), np.inf)
+
+        consensus = {}
+        is_assigned = np.ones(len(starts), dtype=bool)
+        for level in reversed(self.DESIRED_LEVEL):
+            names = hits[level].astype("category")
+            codes = names.cat.codes.to_numpy()[order].astype(np.int64)
+            is_passing = pident >= self.identity_thresholds.get(level, -np.inf)
+            has_passing = np.logical_or.reduceat(is_passing, starts)
+            low = np.minimum.reduceat(np.where(is_passing, codes, np.iinfo(np.int64).max), starts)
+            high = np.maximum.reduceat(np.where(is_passing, codes, -1), starts)
+            is_assigned &= has_passing & (low == high)
+            categories = np.append(names.cat.categories.to_numpy(dtype=object), "")
+            consensus[level] = categories[np.where(is_assigned, low, -1)]
+
+        haplotypes = qseqid.cat.categories.to_numpy(dtype=object)[sorted_codes[starts]]
+        table = pd.DataFrame({level: consensus[level] for level in self.DESIRED_LEVEL}, index=haplotypes)
+        return table.iloc[np.argsort(first_rows, kind="stable")]
+
     def read_blast_table(self, blast_table: str):
         """
         Read the BLAST CSV table and update the dictionary 'self.hap2level' with the corresponding taxonomic names at each level for every haplotype (ZOTU).
         Seven levels are used: species, genus, family, order, class, phylum, kingdom.
+        Haplotypes with several hits (maxhitnum > 1) get the lowest common ancestor of their hits, see 'get_consensus'.
+        All hits, with their statistics, are kept in 'self.hits' (see 'read_blast_columns').
 
         :param blast_table_path: Path to the BLAST CSV table.
         """
         base_logger.logger.info(f"Reading Blast CSV Table: {blast_table}.")
 
-        with open(blast_table, 'r') as file:
-            for line in file.readlines():
-                self.process_line(line)
+        self.hits = self.read_blast_columns(blast_table)
+        consensus = self.get_consensus(self.hits)
+        levels = zip(*(consensus[level] for level in self.DESIRED_LEVEL))
+        for haplotype, level_list in zip(consensus.index, levels):
+            self.update_hap2level(haplotype, dict(zip(self.DESIRED_LEVEL, level_list)))
 
         hap_count = len(self.hap2level)
-        base_logger.logger.info(f"COMPLETE: Assigned {hap_count} haplotypes to species.")
\ No newline at end of file
+        base_logger.logger.info(f"COMPLETE: Assigned {hap_count} haplotypes to species.")
@@ -1,108 +1,313 @@
-import re
+import functools
+
+import numpy as np
+import pandas as pd
 
 from analysis_toolkit.read import read_blast_csv
 from analysis_toolkit.runner_build import base_logger
 
+NEWLINE, TAB, SEMICOLON = ord("\n"), ord("\t"), ord(";")
+# Longest name or size in a -tabbedout report.
+FIELD_WIDTH = 64
+
+
 class DenoiseReportReader(read_blast_csv.Reader):
-    RE_DENOISE_PATTERN = re.compile(r"(Uniq\d*)|size=(\d*)|(amp\d*)|top=(Uniq\d*)")
-    RE_CHFILTER_PATTERN = re.compile(r"(Uniq\d*)|size=(\d*)|(zotu)|(chimera)")
+    """
+    Reader of the -tabbedout report of 'usearch -unoise3'.
+
+    Attributes:
+        amp_names (np.ndarray): Names of the amplicons (unique sequences), as bytes, in report order.
+        amp_sizes (np.ndarray): Sizes of the amplicons (int64).
+        amp_hap (np.ndarray): Index in 'hap_names' of the haplotype of every amplicon (int32).
+        hap_names (list[str]): Haplotype names, 'ZotuXX' or 'ChimeraYY' after the chfilter step. Haplotypes missing from it keep the name of their amplicon.
+        hap_sizes (np.ndarray): Sizes of the haplotypes (int64).
+        hap_size (dict): ZOTU name -> size.
+        amp_size (dict): Amplicon name -> size, built from the arrays on first use.
+        hap2amp (dict): Haplotype name -> amplicon names, built from the arrays on first use.
+    """
+    CHUNK_SIZE = 4 << 20
 
     def __init__(self):
         super().__init__()
-        self.amp_size = {}
-        self.hap2amp = {}
+        self.amp_names = np.zeros(0, dtype="S1")
+        self.amp_sizes = np.zeros(0, dtype=np.int64)
+        self.amp_hap = np.zeros(0, dtype=np.int32)
+        self.hap_names = []
+        self.hap_sizes = np.zeros(0, dtype=np.int64)
         self.hap_size = {}
 
+    @functools.cached_property
+    def amp_size(self) -> dict[str, int]:
+        return DenoiseReportReader.get_amp_size(self.amp_names, self.amp_sizes)
+
+    @functools.cached_property
+    def hap2amp(self) -> dict[str, list[str]]:
+        return DenoiseReportReader.get_hap2amp(self.amp_names, self.amp_hap, self.hap_names)
+
     @staticmethod
-    def read_denoise_line(line: str) -> list[str]:
+    def get_amp_size(amp_names: np.ndarray, amp_sizes: np.ndarray) -> dict[str, int]:
+        """
+        Amplicon name -> size dictionary of the compact report.
         """
-        Read a line containing 'denoise' string and return a list of the values.
+        return dict(zip(amp_names.astype(str).tolist(), amp_sizes.tolist()))
 
-        :param line: one line from the denoise report
-        :return: [Amplicon_id, Size, Top]. e.g. ['Uniq1', '88422', 'amp1'], ['Uniq6', '8126', 'Uniq2']
+    @staticmethod
+    def get_hap2amp(amp_names: np.ndarray, amp_hap: np.ndarray, hap_names: list[str]) -> dict[str, list[str]]:
+        """
+        Haplotype name -> amplicon names dictionary of the compact report, in the order of 'hap_names'.
         """
-        line_list = [
-            "".join(t)
-            for t in DenoiseReportReader.RE_DENOISE_PATTERN.findall(line)
-        ]
+        order = np.argsort(amp_hap, kind="stable")
+        bounds = np.searchsorted(amp_hap[order], np.arange(len(hap_names) + 1))
+        names = amp_names[order].astype(str).tolist()
+        return {hap: names[bounds[i]:bounds[i + 1]] for i, hap in enumerate(hap_names) if bounds[i] < bounds[i + 1]}
 
-        # If Top is "ampXX", it is a true amplicon, otherwise, it is a noise.
-        if 'amp' in line_list[2]:
-            line_list[2] = line_list[0]
+    @staticmethod
+    def gather_fields(windows: np.ndarray, starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+        """
+        Copy the byte ranges [starts, ends) of a buffer into a fixed-width bytes array.
 
-        return line_list
+        :param windows: Sliding windows of 'FIELD_WIDTH' bytes over the buffer.
+        """
+        lengths = ends - starts
+        width = int(lengths.max(initial=1)) or 1
+        if width > FIELD_WIDTH:
+            raise ValueError(f"Field longer than {FIELD_WIDTH} characters in the denoise report.")
+        fields = windows[starts, :width]
+        fields *= np.arange(width) < lengths[:, None]
+        return np.ascontiguousarray(fields).view(f"S{width}").ravel()
 
     @staticmethod
-    def read_chifilter_line(line: str) -> list[str]:
+    def parse_integers(windows: np.ndarray, starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
         """
-        Read a line containing 'chifilter' string and return a list of the values.
+        Parse the decimal integers at the byte ranges [starts, ends) of a buffer.
 
-        :param line: one line from the denoise report
-        :return: [Amplicon_id, Size, Assigned_type]. e.g. ['Uniq1', '88422', 'zotu'], ['Uniq102', '124', 'chimera']
+        :param windows: Sliding windows of 'FIELD_WIDTH' bytes over the buffer.
         """
-        line_list = [
-            "".join(t)
-            for t in DenoiseReportReader.RE_CHFILTER_PATTERN.findall(line)
-        ]
+        lengths = ends - starts
+        width = int(lengths.max(initial=1)) or 1
+        if width > 18 or (lengths < 1).any():
+            raise ValueError("Invalid size in the denoise report.")
+        # Right-align the digits, so the leading zeros do not change the values.
+        values = np.zeros(len(starts), dtype=np.int64)
+        is_aligned = ends >= width
+        digits = windows[ends[is_aligned] - width, :width] - np.uint8(ord("0"))
+        digits *= np.arange(width) >= (width - lengths[is_aligned])[:, None]
+        if (digits > 9).any():
+            raise ValueError("Invalid size in the denoise report.")
+        aligned_values = np.zeros(len(digits), dtype=np.int64)
+        for column in digits.T:
+            aligned_values = aligned_values * 10 + column
+        values[is_aligned] = aligned_values
+        for i in np.flatnonzero(~is_aligned):
+            values[i] = int(windows[starts[i], :lengths[i]].tobytes())
+        return values
 
-        return line_list
-    
-    def process_denoise_line(self, line: str):
+    @staticmethod
+    def hash_names(names: np.ndarray) -> np.ndarray:
         """
-        Process a line containing 'denoise' string and update amp_size and hap2amp dictionaries.
-        This step create relationship between haplotypes(top) and amplicons and record the size of each amplicon (it means unique sequence here).
-        
-        :param line: One line from the denoise report
+        64-bit FNV-1a hash of every name of a fixed-width bytes array. Equal names get equal hashes only within arrays of the same width.
         """
-        amplicon, size, top = DenoiseReportReader.read_denoise_line(line)
-
-        self.amp_size[amplicon] = size
+        codes = np.ascontiguousarray(names).view(np.uint8).reshape(len(names), names.itemsize)
+        hashes = np.full(len(names), 14695981039346656037, dtype=np.uint64)
+        for column in codes.T:
+            hashes ^= column
+            hashes *= np.uint64(1099511628211)
+        return hashes
 
-        if top not in self.hap2amp:
-            self.hap2amp[top] = []
-        self.hap2amp[top].append(amplicon)
+    @staticmethod
+    def lookup_names(keys: np.ndarray, names: np.ndarray) -> np.ndarray:
+        """
+        Position in 'keys', a fixed-width bytes array of distinct names, of every name of 'names', or -1 if it is not among them.
+        The names are matched by their hashes (see 'hash_names') and the matches checked against the names themselves.
+        """
+        if not len(keys):
+            return np.full(len(names), -1, dtype=np.int64)
+        width = max(keys.itemsize, names.itemsize)
+        key_hashes = pd.Index(DenoiseReportReader.hash_names(keys.astype(f"S{width}")))
+        if not key_hashes.is_unique:  # colliding hashes of distinct names
+            return pd.Index(keys.astype(object)).get_indexer(names.astype(object))
+        codes = key_hashes.get_indexer(DenoiseReportReader.hash_names(names.astype(f"S{width}")))
+        codes[(codes >= 0) & (keys[codes] != names)] = -1
+        return codes
 
-    def process_chifilter_line(self, line: str, zotu_count: int, chimera_count: int) -> tuple[int, int]:
+    @staticmethod
+    def parse_chunk(data: bytes) -> dict[str, np.ndarray]:
         """
-        Process a line containing 'chifilter' string and update hap_size and hap2amp dictionaries.
-        This step rename the top from 'UniqXX' to 'ZotuYY' or 'ChimeraZZ' and record the size for each haplotype (it means ZOTU here).
-        
-        :param line: One line from the denoise report
-        :param zotu_count: Current count of zotus
-        :param chimera_count: Current count of chimeras
-        :return: Updated counts of zotus and chimeras
+        Parse complete lines of a -tabbedout report with vectorized byte operations.
+        The positions of the delimiters are extracted once and split into the tabs and the semicolons, each in order with the newlines,
+        so the first delimiters of every line are found by indexing rather than by searching. Lines with less than three tab-separated fields are skipped,
+        like the lines that are neither 'denoise' nor 'chfilter' lines.
+
+        :param data: Lines of the report, ending with a newline.
+        :return: The name, size, and whether it is a true amplicon ('amp') or a ZOTU ('zotu'), and the top amplicon of noise,
+            for the 'denoise' lines (keys prefixed with 'denoise_') and the 'chfilter' lines (prefixed with 'chfilter_').
         """
-        old_top, size, assigned_type = DenoiseReportReader.read_chifilter_line(line)
+        buf = np.frombuffer(data + bytes(FIELD_WIDTH), dtype=np.uint8)
+        windows = np.lib.stride_tricks.sliding_window_view(buf, FIELD_WIDTH)
+        events = np.flatnonzero((buf == NEWLINE) | (buf == TAB) | (buf == SEMICOLON))
+        event_kinds = buf[events]
+
+        # Tabs and newlines in order: the tabs of a line are the events between the newline of the previous line and its own.
+        tab_events = events[event_kinds != SEMICOLON]
+        newline_events = np.flatnonzero(buf[tab_events] == NEWLINE)
+        first_events = np.r_[0, newline_events + 1][:-1]
+        n_tabs = newline_events - first_events
+        ends = tab_events[newline_events]
+        starts = np.r_[0, ends + 1][:-1]
+        tab1 = tab_events[first_events]
+        tab2 = tab_events[first_events + np.minimum(n_tabs, 1)]
+        tab3 = tab_events[first_events + np.minimum(n_tabs, 2)]
+        kind = buf[tab1 + 1]
+        is_denoise = (n_tabs >= 2) & (tab2 - tab1 == len("denoise") + 1) & (kind == ord("d"))
+        is_chfilter = (n_tabs >= 2) & (tab2 - tab1 == len("chfilter") + 1) & (kind == ord("c"))
+        keep = is_denoise | is_chfilter
+        starts, ends, tab1, tab3, label_type = starts[keep], ends[keep], tab1[keep], tab3[keep], buf[tab2 + 1][keep]
+        first_events, n_tabs = first_events[keep], n_tabs[keep]
+        is_denoise, is_chfilter = is_denoise[keep], is_chfilter[keep]
+
+        # Labels are 'name;size=N;': the name ends at the first semicolon, the size at the second one or at the tab.
+        semicolon_events = events[event_kinds != TAB]
+        semicolon_newlines = np.flatnonzero(buf[semicolon_events] == NEWLINE)
+        first_semicolons = np.r_[0, semicolon_newlines + 1][:-1]
+        n_semicolons = semicolon_newlines - first_semicolons
+        first_semicolons, n_semicolons, semicolon_newlines = first_semicolons[keep], n_semicolons[keep], semicolon_newlines[keep]
+        semicolon1 = np.minimum(semicolon_events[first_semicolons], tab1)
+        semicolon2 = np.minimum(semicolon_events[first_semicolons + np.minimum(n_semicolons, 1)], tab1)
+        names = DenoiseReportReader.gather_fields(windows, starts, semicolon1)
+        sizes = DenoiseReportReader.parse_integers(windows, semicolon1 + len(";size="), semicolon2)
 
-        if assigned_type == 'zotu':
-            zotu_count += 1
-            new_top = f'Zotu{zotu_count}'
-            self.hap_size[new_top] = size
-        elif assigned_type == 'chimera':
-            chimera_count += 1
-            new_top = f'Chimera{chimera_count}'
-        
-        if old_top in self.hap2amp:
-            self.hap2amp[new_top] = self.hap2amp.pop(old_top)
-        
-        return zotu_count, chimera_count
+        # The top of noise is a 'top=' field after the third tab, which ends at the next semicolon or tab.
+        # Fields are checked in turn, starting with the one right after the third tab and continuing after every semicolon or tab.
+        tops = names.copy()
+        is_noise = is_denoise & (label_type != ord("a")) & (n_tabs >= 3)
+        if is_noise.any():
+            rows = np.flatnonzero(is_noise)
+            field_starts = tab3[rows] + 1
+            top_starts = np.full(len(rows), -1)
+            # The next tab (or newline) after a top right after the third tab is the fourth tab event of the line.
+            next_tabs = tab_events[first_events[rows] + 3]
+            pending = np.arange(len(rows))
+            while len(pending):
+                is_top = ((windows[field_starts, 0] == ord("t")) & (windows[field_starts, 1] == ord("o"))
+                          & (windows[field_starts, 2] == ord("p")) & (windows[field_starts, 3] == ord("=")))
+                top_starts[pending[is_top]] = field_starts[is_top] + len("top=")
+                pending, field_starts = pending[~is_top], field_starts[~is_top]
+                next_delimiters = np.minimum(semicolon_events[np.searchsorted(semicolon_events, field_starts)],
+                                             tab_events[np.searchsorted(tab_events, field_starts)])
+                next_tabs[pending] = tab_events[np.searchsorted(tab_events, next_delimiters + 1)]
+                has_next = next_delimiters < ends[rows[pending]]
+                pending, field_starts = pending[has_next], next_delimiters[has_next] + 1
+            is_found = top_starts >= 0
+            rows, top_starts, top_ends = rows[is_found], top_starts[is_found], next_tabs[is_found]
+            # Only tops followed by a semicolon in their line can end before the next tab.
+            last_semicolons = np.where(n_semicolons[rows] > 0, semicolon_events[np.maximum(semicolon_newlines[rows] - 1, 0)], -1)
+            has_semicolon = last_semicolons >= top_starts
+            top_ends[has_semicolon] = np.minimum(
+                semicolon_events[np.searchsorted(semicolon_events, top_starts[has_semicolon])], top_ends[has_semicolon])
+            top_fields = DenoiseReportReader.gather_fields(windows, top_starts, top_ends)
+            tops = tops.astype(f"S{max(tops.itemsize, top_fields.itemsize)}")
+            tops[rows] = top_fields
+        return {
+            "denoise_names": names[is_denoise],
+            "denoise_sizes": sizes[is_denoise],
+            "denoise_is_amp": label_type[is_denoise] == ord("a"),
+            "denoise_tops": tops[is_denoise],
+            "chfilter_names": names[is_chfilter],
+            "chfilter_sizes": sizes[is_chfilter],
+            "chfilter_is_zotu": label_type[is_chfilter] == ord("z"),
+        }
+
+    @staticmethod
+    def parse_tabbedout(denoise_report: str, chunk_size: int = CHUNK_SIZE) -> dict[str, np.ndarray]:
+        """
+        Stream a -tabbedout report in chunks of whole lines through 'parse_chunk' and concatenate the results.
+        """
+        parts = []
+        with open(denoise_report, 'rb') as file:
+            rest = b""
+            while True:
+                block = file.read(chunk_size)
+                if not block:
+                    break
+                cut = block.rfind(b"\n") + 1
+                if cut == 0:
+                    rest += block
+                    continue
+                parts.append(DenoiseReportReader.parse_chunk(rest + block[:cut]))
+                rest = block[cut:]
+            if rest:
+                parts.append(DenoiseReportReader.parse_chunk(rest + b"\n"))
+        if not parts:
+            parts.append(DenoiseReportReader.parse_chunk(b""))
+        return {key: np.concatenate([part[key] for part in parts]) for key in parts[0]}
 
     def read_denoise_report(self, denoise_report: str):
         """
-        read a denoise report (.txt) generated from usearch and update amp_size, hap2amp and hap_size dictionaries.
+        read a denoise report (.txt) generated from usearch into the compact arrays (see the class attributes) and the hap_size dictionary.
+        The haplotypes are the amplicons with 'amp' lines and the tops of noise, in order of appearance,
+        except that those in the chfilter step come last, in its order, as 'ZotuXX' or 'ChimeraYY'.
 
         :param denoise_report_path: path to the denoise report
         """
         base_logger.logger.info(f"Reading denoising Report:  {denoise_report}")
 
-        zotu_count = 0
-        chimera_count = 0
+        report = DenoiseReportReader.parse_tabbedout(denoise_report)
+        self.amp_names = report["denoise_names"]
+        self.amp_sizes = report["denoise_sizes"]
+
+        # Every top is looked up among the true amplicons, by a hash table of their hashed names;
+        # tops without an 'amp' line become haplotypes of their own.
+        is_amp = report["denoise_is_amp"]
+        haps = self.amp_names[is_amp]
+        hap_sizes = self.amp_sizes[is_amp]
+        tops = report["denoise_tops"]
+        width = max(haps.itemsize, tops.itemsize)
+        hap_hashes = pd.Index(DenoiseReportReader.hash_names(haps.astype(f"S{width}")))
+        if not hap_hashes.is_unique:
+            is_first = ~hap_hashes.duplicated()
+            haps, hap_sizes, hap_hashes = haps[is_first], hap_sizes[is_first], hap_hashes[is_first]
+        codes = hap_hashes.get_indexer(DenoiseReportReader.hash_names(tops.astype(f"S{width}")))
+        is_found = (codes >= 0) & (haps[codes] == tops) if len(haps) else np.zeros(len(tops), dtype=bool)
+        if not is_found.all():
+            extra, first, inverse = np.unique(tops[~is_found], return_index=True, return_inverse=True)
+            rank = np.empty(len(extra), dtype=np.int64)
+            rank[np.argsort(first, kind="stable")] = np.arange(len(extra))
+            codes[~is_found] = len(haps) + rank[inverse]
+            haps = np.concatenate([haps, extra[np.argsort(first, kind="stable")]])
+            hap_sizes = np.concatenate([hap_sizes, np.zeros(len(extra), dtype=np.int64)])
+
+        # Haplotypes in the chfilter step are renamed by the first chfilter line naming them, and moved to the end in its order.
+        # Every line counts towards the numbering of the ZOTUs or chimeras, whether or not it names a haplotype.
+        chfilter_sizes = report["chfilter_sizes"]
+        is_zotu = report["chfilter_is_zotu"]
+        zotu_numbers = np.cumsum(is_zotu)
+        chimera_numbers = np.cumsum(~is_zotu)
+        zotu_count = int(zotu_numbers[-1]) if len(is_zotu) else 0
+        chimera_count = len(is_zotu) - zotu_count
+        zotu_labels = np.array([f'Zotu{i}' for i in range(1, zotu_count + 1)], dtype=object)
+        self.hap_size = dict(zip(zotu_labels.tolist(), chfilter_sizes[is_zotu].tolist()))
+
+        chfilter_codes = DenoiseReportReader.lookup_names(haps, report["chfilter_names"])
+        named_rows = np.flatnonzero(chfilter_codes >= 0)
+        _, first = np.unique(chfilter_codes[named_rows], return_index=True)
+        renamed_rows = np.sort(named_rows[first])
+        renamed_codes = chfilter_codes[renamed_rows]
+        # The ZOTU names are taken from the labels of 'hap_size', only the chimera names are formatted.
+        new_names = np.empty(len(renamed_rows), dtype=object)
+        renamed_zotu = is_zotu[renamed_rows]
+        new_names[renamed_zotu] = zotu_labels[zotu_numbers[renamed_rows[renamed_zotu]] - 1]
+        new_names[~renamed_zotu] = [f'Chimera{number}' for number in chimera_numbers[renamed_rows[~renamed_zotu]].tolist()]
 
-        with open(denoise_report, 'r') as file:
-            for line in file.readlines():
-                if 'denoise' in line:
-                    self.process_denoise_line(line)
-                elif 'chfilter' in line:
-                    zotu_count, chimera_count = self.process_chifilter_line(line, zotu_count, chimera_count)
+        is_renamed = np.zeros(len(haps), dtype=bool)
+        is_renamed[renamed_codes] = True
+        kept = np.flatnonzero(~is_renamed)
+        order = np.concatenate([kept, renamed_codes])
+        new_index = np.empty(len(haps), dtype=np.int32)
+        new_index[order] = np.arange(len(order), dtype=np.int32)
+        self.hap_names = haps[kept].astype(str).tolist() + new_names.tolist()
+        self.hap_sizes = np.concatenate([hap_sizes[kept], chfilter_sizes[renamed_rows]]).astype(np.int64)
+        self.amp_hap = new_index[codes]
+        self.__dict__.pop("amp_size", None)
+        self.__dict__.pop("hap2amp", None)
 
-        base_logger.logger.info(f"COMPLETE: Total {zotu_count} biological Haplotypes kept; Total {chimera_count} predicted Chimeras removed.")
\ No newline at end of file
+        base_logger.logger.info(f"COMPLETE: Total {zotu_count} biological Haplotypes kept; Total {chimera_count} predicted Chimeras removed.")
@@ -1,8 +1,69 @@
-from Bio import SeqIO
+from collections import OrderedDict
+from collections.abc import Mapping
+import mmap
+import os
+import threading
+
+import numpy as np
 
 from analysis_toolkit.read import read_blast_csv
 from analysis_toolkit.runner_build import base_logger
 
+NEWLINE, HEADER = ord("\n"), ord(">")
+
+# Memory maps of the FASTA files read by 'LazySequences', most recently used last.
+# Every map keeps a file descriptor open, so only the 'MAX_OPEN_MAPS' most recently read files stay mapped, however many samples there are.
+MAX_OPEN_MAPS = 64
+_open_maps = OrderedDict()
+_open_maps_lock = threading.Lock()
+
+
+def read_mapped(path: str, start: int, end: int) -> bytes:
+    """
+    Read the bytes [start, end) of a file through a shared memory map, mapping it if it is not among the open maps.
+    """
+    with _open_maps_lock:
+        data = _open_maps.get(path)
+        if data is None:
+            with open(path, "rb") as handle:
+                data = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+            _open_maps[path] = data
+            if len(_open_maps) > MAX_OPEN_MAPS:
+                _open_maps.popitem(last=False)[1].close()
+        else:
+            _open_maps.move_to_end(path)
+        return data[start:end]
+
+
+class LazySequences(Mapping):
+    """
+    Read-only mapping of sequence name -> sequence over a FASTA file, which slices every sequence from the memory-mapped file on access.
+    The file is mapped on access, and stays mapped while it is among the 'MAX_OPEN_MAPS' most recently read files,
+    so the FASTA file must stay in place for the lifetime of the mapping.
+
+    Attributes:
+        seq_path (str): The path to the FASTA file.
+        names (list[str]): Sequence names, in file order.
+        seq_starts (np.ndarray): Byte offset of the first line of every sequence.
+        seq_ends (np.ndarray): Byte offset of the end of every sequence (the next header, or the end of the file).
+    """
+    def __init__(self, seq_path: str, names: list[str], seq_starts: np.ndarray, seq_ends: np.ndarray):
+        self.seq_path = seq_path
+        self.names = names
+        self.seq_starts = seq_starts
+        self.seq_ends = seq_ends
+        self._index = {name: i for i, name in enumerate(names)}
+
+    def __getitem__(self, name: str) -> str:
+        i = self._index[name]
+        return b"".join(read_mapped(self.seq_path, self.seq_starts[i], self.seq_ends[i]).split()).decode()
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self) -> int:
+        return len(self._index)
+
 
 class FastaReader(read_blast_csv.Reader):
 
@@ -10,31 +71,60 @@ class FastaReader(read_blast_csv.Reader):
         super().__init__()
         self.seq_dict = {}
 
-    def parse_fasta(self, seq_path: str, seq_type: str):
+    @staticmethod
+    def scan_offsets(data) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Find the records of a FASTA buffer: headers are lines starting with '>', and sequences run from the end of a header to the next one.
+
+        :param data: The FASTA file contents, e.g. a memory map.
+        :return: Byte offsets of the header starts (at the '>'), the header ends (at the newline), and the sequence ends.
+        """
+        buf = np.frombuffer(data, dtype=np.uint8)
+        newlines = np.flatnonzero(buf == NEWLINE)
+        after_newlines = newlines[newlines + 1 < len(buf)] + 1
+        header_starts = after_newlines[buf[after_newlines] == HEADER]
+        if len(buf) and buf[0] == HEADER:
+            header_starts = np.r_[0, header_starts]
+        header_ends = np.r_[newlines, len(buf)][np.searchsorted(newlines, header_starts)]
+        seq_ends = np.r_[header_starts[1:], len(buf)]
+        return header_starts, header_ends, seq_ends
+
+    def parse_fasta(self, seq_path: str, seq_type: str, lazy: bool = False):
         """
         Parse the fasta file and return the dictionary 'seq_dict' containing sequence names and sequences.
+        The file is memory-mapped and the records are located with array operations on its bytes, so no object is built per record but the names and sequences.
 
         :param seq_path: The path to the fasta file.
         :param seq_type: The type of sequence, either "Haplotype" or "Amplicon".
+        :param lazy: If True, 'seq_dict' is a 'LazySequences' mapping that only keeps the offsets of the sequences. Default is False.
         :return: A dictionary containing sequence names and sequences.
         """
-        with open(seq_path) as handle:
-            for record in SeqIO.parse(handle, "fasta"):
-                name, seq = record.description, str(record.seq)
-                if seq_type == "Amplicon":
-                    name = name.split(";")[0]
-                self.seq_dict[name] = seq
-
-    def read_fasta(self, seq_path: str, seq_type: str = "Haplotype"):
+        if os.path.getsize(seq_path) == 0:
+            return
+        with open(seq_path, "rb") as handle, mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            header_starts, header_ends, seq_ends = FastaReader.scan_offsets(data)
+            names = [data[start + 1:end].decode().rstrip() for start, end in zip(header_starts.tolist(), header_ends.tolist())]
+            if seq_type == "Amplicon":
+                names = [name.split(";")[0] for name in names]
+            seq_starts = np.minimum(header_ends + 1, seq_ends)
+            if lazy:
+                self.seq_dict = LazySequences(seq_path, names, seq_starts, seq_ends)
+                return
+            # Whitespace is removed from the sequence lines, which also joins wrapped sequences.
+            for name, start, end in zip(names, seq_starts.tolist(), seq_ends.tolist()):
+                self.seq_dict[name] = b"".join(data[start:end].split()).decode()
+
+    def read_fasta(self, seq_path: str, seq_type: str = "Haplotype", lazy: bool = False):
         """
         Read a fasta file and update the dictionary 'seq_dict' with sequence names and sequences.
 
         :param seq_path: The path to the fasta file.
         :param seq_type: The type of sequence,  either "Haplotype" or "Amplicon". Default is "Haplotype".
+        :param lazy: If True, keep only the offsets of the sequences and slice them from the file on access. Default is False.
         """
         base_logger.logger.info(f"Reading {seq_type} FASTA file: {seq_path}.")
 
-        self.parse_fasta(seq_path, seq_type)
+        self.parse_fasta(seq_path, seq_type, lazy=lazy)
 
         read_count = len(self.seq_dict)
         base_logger.logger.info(f"COMPLETE: {seq_type} Sequences Read. Total {read_count} reads.")
@@ -3,11 +3,13 @@ import csv
 import os
 import pickle
 from datetime import date
+import functools
 
 from analysis_toolkit.read import read_blast_csv
 from analysis_toolkit.read import read_denoise_report
 from analysis_toolkit.read import read_fasta
 from analysis_toolkit.runner_build import base_logger
+from analysis_toolkit.runner_exec import sequence_store
 
 
 class OneSampleData():
@@ -20,11 +22,19 @@ class OneSampleData():
     :param zotu_fasta_path: Path to the ZOTU haplotype FASTA file.
     :param denoise_report_path: Path to the denoise report file.
     :param blast_table_path: Path to the BLAST table file.
-
-    :attribute amp_seq: A dictionary containing amplicon sequences from the unique FASTA file.
-    :attribute hap_seq: A dictionary containing haplotype sequences from the ZOTU FASTA file.
-    :attribute amp_size: A dictionary containing amplicon sizes from the denoise report.
-    :attribute hap2amp: A dictionary mapping haplotypes to amplicons from the denoise report.
+    :param identity_thresholds: Minimum percent identity of the BLAST hits supporting a name at each taxonomic level, see 'BlastReader'. Default is None.
+    :param blast_specifiers: The outfmt specifiers the BLAST table was written with, see 'BlastReader'. Default is the default of 'AssignTaxaStage'.
+    :param lazy_fasta: If True, keep only the offsets of the amplicon sequences and slice them from the unique FASTA file on access. Default is False.
+    :param seq_store: The 'SequenceStore' packing the sequences, shared by the samples of a 'SampleData'. Default is None (a store of its own).
+
+    :attribute amp_seq: A mapping of the amplicon sequences from the unique FASTA file, packed in 'seq_store', or a 'LazySequences' mapping if 'lazy_fasta'.
+    :attribute hap_seq: A mapping of the haplotype sequences from the ZOTU FASTA file, packed in 'seq_store'.
+    :attribute amp_names: An array of the amplicon names from the denoise report, as bytes.
+    :attribute amp_sizes: An array of the amplicon sizes from the denoise report.
+    :attribute amp_hap: An array of the index in 'hap_names' of the haplotype of every amplicon.
+    :attribute hap_names: A list of the haplotype names from the denoise report.
+    :attribute amp_size: A dictionary containing amplicon sizes, built from the arrays on first use.
+    :attribute hap2amp: A dictionary mapping haplotypes to amplicons, built from the arrays on first use.
     :attribute hap_size: A dictionary containing haplotype sizes from the denoise report.
     :attribute hap2level: A dictionary mapping haplotypes to taxonomic levels from the BLAST table.
 
@@ -33,26 +43,44 @@ class OneSampleData():
             uniq_fasta: str,
             denoise_fasta: str,
             denoise_report: str,
-            blast_table: str
+            blast_table: str,
+            identity_thresholds: dict[str, float] = None,
+            blast_specifiers: str = read_blast_csv.BlastReader.DEFAULT_SPECIFIERS,
+            lazy_fasta: bool = False,
+            seq_store: sequence_store.SequenceStore = None
         ):
+        if seq_store is None:
+            seq_store = sequence_store.SequenceStore()
+
         ufr = read_fasta.FastaReader()
-        ufr.read_fasta(seq_path=uniq_fasta, seq_type="Amplicon")
-        self.amp_seq = ufr.seq_dict
+        ufr.read_fasta(seq_path=uniq_fasta, seq_type="Amplicon", lazy=lazy_fasta)
+        self.amp_seq = ufr.seq_dict if lazy_fasta else seq_store.pack(ufr.seq_dict)
 
         dfr = read_fasta.FastaReader()
         dfr.read_fasta(seq_path=denoise_fasta, seq_type="Haplotype")
-        self.hap_seq = dfr.seq_dict
+        self.hap_seq = seq_store.pack(dfr.seq_dict)
 
         drr = read_denoise_report.DenoiseReportReader()
         drr.read_denoise_report(denoise_report=denoise_report)
-        self.amp_size = drr.amp_size
-        self.hap2amp = drr.hap2amp
+        self.amp_names = drr.amp_names
+        self.amp_sizes = drr.amp_sizes
+        self.amp_hap = drr.amp_hap
+        self.hap_names = drr.hap_names
         self.hap_size = drr.hap_size
 
-        br = read_blast_csv.BlastReader()
+        br = read_blast_csv.BlastReader(identity_thresholds=identity_thresholds, specifiers=blast_specifiers)
         br.read_blast_table(blast_table=blast_table)
         self.hap2level = br.hap2level
 
+    # Instances pickled before the compact arrays keep their dictionaries in __dict__, which take precedence.
+    @functools.cached_property
+    def amp_size(self) -> dict[str, int]:
+        return read_denoise_report.DenoiseReportReader.get_amp_size(self.amp_names, self.amp_sizes)
+
+    @functools.cached_property
+    def hap2amp(self) -> dict[str, list[str]]:
+        return read_denoise_report.DenoiseReportReader.get_hap2amp(self.amp_names, self.amp_hap, self.hap_names)
+
 
 class SampleData():
     """
@@ -63,6 +91,7 @@ class SampleData():
     :attribute sample_data: A dictionary to store sample data, the key is sample ID, and the value is a OneSampleData instance.
     :attribute sample_info: A dictionary to store sample information, the key is sample ID, and the value is a dictionary containing sample metadata.
     :attribute sample_id_list: A list to store sample IDs.
+    :attribute seq_store: A 'SequenceStore' packing the sequences of all the samples, so a sequence found in several samples is stored once.
     :attribute verbose: A boolean flag to control logging verbosity. Default is True.
     """
     # keys are data type, values are tuples of (child directory, file suffix).
@@ -80,6 +109,7 @@ class SampleData():
         self.sample_data = {}
         self.sample_id_list = []
         self.sample_info = {}
+        self.seq_store = sequence_store.SequenceStore()
         self.verbose = verbose
         self.logger = logger
 
@@ -154,7 +184,18 @@ class SampleData():
         with open(self.save_instance_path, 'wb') as f:
             pickle.dump(self, f)
 
-    def import_data(self, import_dir: str, sample_id_list: list[str] = [], sample_info_path: str = None) -> None:
+    def _repack_sample(self, sample: OneSampleData) -> None:
+        """
+        Move the packed sequences of a sample merged from another instance into 'seq_store'.
+        """
+        for attribute in ("amp_seq", "hap_seq"):
+            seqs = getattr(sample, attribute)
+            if isinstance(seqs, sequence_store.PackedSequences) and seqs.store is not self.seq_store:
+                setattr(sample, attribute, self.seq_store.pack(seqs))
+
+    def import_data(self, import_dir: str, sample_id_list: list[str] = [], sample_info_path: str = None,
+                    identity_thresholds: dict[str, float] = None, blast_specifiers: str = read_blast_csv.BlastReader.DEFAULT_SPECIFIERS,
+                    lazy_fasta: bool = False) -> None:
         """
         Import sample data from the specified parent directory.
         The parent directory is expected to contain four data types recorded in 'DATA_FILE_INFO'.
@@ -163,6 +204,12 @@ class SampleData():
         :param import_dir: Path to the parent directory containing the sample data.
         :param sample_id_list: List of sample IDs to import. If not provided, all available sample IDs will be imported. The sample IDs are extracted from the file names using the provided suffix.
         :param sample_info_path: Path to the sample information CSV file. If provided, sample information will be loaded from this file. Default is None.
+        :param identity_thresholds: Minimum percent identity of the BLAST hits supporting a name at each taxonomic level, e.g. {"species": 98, "genus": 95}.
+            Haplotypes with several hits are assigned the lowest common ancestor of the hits passing these thresholds. Default is None (no thresholds).
+        :param blast_specifiers: The outfmt specifiers the BLAST tables were written with (the 'specifiers' of 'AssignTaxaStage').
+            Default is the default of 'AssignTaxaStage'.
+        :param lazy_fasta: If True, the amplicon sequences are sliced from the unique FASTA files on access rather than read at import,
+            so the files must stay in place while the data, or a saved instance of it, is in use. Default is False.
         """
         self.import_dir = import_dir
 
@@ -183,7 +230,8 @@ class SampleData():
 
         for sample_id in self.sample_id_list:
             self._get_file_paths(sample_id)
-            self.sample_data[sample_id] = OneSampleData(**self.file_paths)
+            self.sample_data[sample_id] = OneSampleData(**self.file_paths, identity_thresholds=identity_thresholds,
+                                                     blast_specifiers=blast_specifiers, lazy_fasta=lazy_fasta, seq_store=self.seq_store)
 
         self.logger.info(f"COMPLETE: {prog_name}")
 
@@ -228,6 +276,9 @@ class SampleData():
         
         with open(load_instance_path,'rb') as file:
             self.__dict__ = pickle.load(file).__dict__
+        # Instances saved before the sequence store keep their sequences as dictionaries.
+        if not hasattr(self, "seq_store"):
+            self.seq_store = sequence_store.SequenceStore()
         self.load_instance_path = load_instance_path
         self.logger.info(f"COMPLETE: {prog_name}")
 
@@ -249,6 +300,7 @@ class SampleData():
                     self.logger.warning(f"WARNING: Sample ID {sample_id} already exists in the current instance. Skipping merge.")
                 else:
                     self.sample_data[sample_id] = object.sample_data[sample_id]
+                    self._repack_sample(self.sample_data[sample_id])
                     self.sample_info[sample_id] = object.sample_info[sample_id]
 
             self.sample_id_list.extend(object.sample_id_list)
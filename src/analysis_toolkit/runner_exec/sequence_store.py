@@ -0,0 +1,235 @@
+from collections.abc import ItemsView, Mapping, ValuesView
+import itertools
+
+import numpy as np
+
+BASES = np.frombuffer(b"ACGT", dtype=np.uint8)
+# Code of every byte: 0-3 for 'ACGT', and 255 for the characters kept as exceptions (IUPAC codes, 'N', lowercase, ...).
+CODES = np.full(256, 255, dtype=np.uint8)
+CODES[BASES] = np.arange(4, dtype=np.uint8)
+# Shifts of the four bases packed in a byte, the first base in the high bits, and the four bases of every byte value.
+SHIFTS = np.array([6, 4, 2, 0], dtype=np.uint8)
+QUADS = [bytes(quad) for quad in itertools.product(b"ACGT", repeat=4)]
+
+
+class SequenceStore():
+    """
+    Store of unique nucleotide sequences, packed 2 bits per base in one contiguous buffer.
+    Every sequence starts at a byte boundary of the buffer; characters other than 'ACGT' are packed as 'A'
+    and recorded in an exception list of (position, character), sorted by position.
+    A sequence added more than once, by any sample sharing the store, is stored once: sequences are looked up by their hash
+    in a sorted array, and compared with the stored sequence when the hash is found.
+    The arrays grow by doubling, so only their first 'n_seqs' (or 'n_bytes', 'n_exceptions') entries are in use.
+
+    :attribute packed: The packed bases of all the sequences (uint8).
+    :attribute offsets: The byte offset of every sequence in 'packed' (int64).
+    :attribute lengths: The number of bases of every sequence (int32).
+    :attribute exception_starts: The index of the first exception of every sequence, and the number of exceptions (int64).
+    :attribute exception_positions: Positions of the exceptions, in bases from the start of 'packed' (int64).
+    :attribute exception_chars: Characters of the exceptions (uint8).
+    """
+    ARRAYS = {"packed": "n_bytes", "offsets": "n_seqs", "lengths": "n_seqs",
+              "exception_positions": "n_exceptions", "exception_chars": "n_exceptions"}
+
+    def __init__(self):
+        self.packed = np.zeros(0, dtype=np.uint8)
+        self.offsets = np.zeros(0, dtype=np.int64)
+        self.lengths = np.zeros(0, dtype=np.int32)
+        self.exception_starts = np.zeros(1, dtype=np.int64)
+        self.exception_positions = np.zeros(0, dtype=np.int64)
+        self.exception_chars = np.zeros(0, dtype=np.uint8)
+        self.n_bytes = 0
+        self.n_seqs = 0
+        self.n_exceptions = 0
+        # Sorted hashes of the sequences, with their IDs. String hashes differ between processes,
+        # so they are not pickled, but rebuilt when sequences are added after loading.
+        self._hashes = np.zeros(0, dtype=np.int64)
+        self._hash_ids = np.zeros(0, dtype=np.int64)
+
+    def __len__(self) -> int:
+        return self.n_seqs
+
+    def __getstate__(self) -> dict:
+        state = {**self.__dict__, "_hashes": None, "_hash_ids": None}
+        for name, size in {**SequenceStore.ARRAYS, "exception_starts": "n_seqs"}.items():
+            state[name] = state[name][:state[size] + (name == "exception_starts")].copy()
+        return state
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Memory used by the sequences of the store, in bytes.
+        """
+        return sum(getattr(self, name)[:getattr(self, size)].nbytes for name, size in SequenceStore.ARRAYS.items())
+
+    @staticmethod
+    def _extend(array: np.ndarray, size: int, values: np.ndarray) -> np.ndarray:
+        """
+        Write 'values' after the first 'size' entries of 'array', doubling its capacity if needed.
+        """
+        if size + len(values) > len(array):
+            grown = np.empty(max(2 * len(array), size + len(values)), dtype=array.dtype)
+            grown[:size] = array[:size]
+            array = grown
+        array[size:size + len(values)] = values
+        return array
+
+    def _append(self, seqs: list[str]):
+        """
+        Pack sequences at the end of the store.
+        """
+        lengths = np.array([len(seq) for seq in seqs], dtype=np.int64)
+        n_bytes = (lengths + 3) // 4
+        offsets = np.r_[0, np.cumsum(n_bytes)]
+        raw = np.frombuffer("".join(seqs).encode("ascii"), dtype=np.uint8)
+        codes = CODES[raw]
+        # Position of every base in the batch, with every sequence starting at a multiple of 4 bases.
+        positions = np.arange(len(raw)) + np.repeat(4 * offsets[:-1] - np.r_[0, np.cumsum(lengths)][:-1], lengths)
+        is_exception = codes == 255
+        expanded = np.zeros(4 * offsets[-1], dtype=np.uint8)
+        expanded[positions] = codes
+        expanded[positions[is_exception]] = 0
+        quads = expanded.reshape(-1, 4)
+        packed = (quads[:, 0] << 6) | (quads[:, 1] << 4) | (quads[:, 2] << 2) | quads[:, 3]
+        exception_positions = 4 * self.n_bytes + positions[is_exception]
+        exception_starts = self.n_exceptions + np.searchsorted(exception_positions, 4 * (self.n_bytes + offsets[1:]))
+
+        self.packed = SequenceStore._extend(self.packed, self.n_bytes, packed)
+        self.offsets = SequenceStore._extend(self.offsets, self.n_seqs, self.n_bytes + offsets[:-1])
+        self.lengths = SequenceStore._extend(self.lengths, self.n_seqs, lengths)
+        self.exception_starts = SequenceStore._extend(self.exception_starts, self.n_seqs + 1, exception_starts)
+        self.exception_positions = SequenceStore._extend(self.exception_positions, self.n_exceptions, exception_positions)
+        self.exception_chars = SequenceStore._extend(self.exception_chars, self.n_exceptions, raw[is_exception])
+        self.n_bytes += len(packed)
+        self.n_seqs += len(seqs)
+        self.n_exceptions += len(exception_positions)
+
+    def add(self, seqs: list[str]) -> np.ndarray:
+        """
+        Add sequences to the store, packing only those not stored yet.
+
+        :param seqs: The sequences, in uppercase IUPAC letters; other ASCII characters are kept as exceptions.
+        :return: The ID of every sequence in the store (int32).
+        """
+        if self._hashes is None:
+            self._hash_ids = np.arange(self.n_seqs, dtype=np.int64)
+            self._hashes = np.array([hash(seq) for seq in self.get_many(self._hash_ids)], dtype=np.int64)
+            order = np.argsort(self._hashes, kind="stable")
+            self._hashes, self._hash_ids = self._hashes[order], self._hash_ids[order]
+        seq_ids = np.full(len(seqs), -1, dtype=np.int32)
+
+        # Stored sequences are found by their hash; a sequence sharing the hash of a different stored one is stored again.
+        hashes = np.array([hash(seq) for seq in seqs], dtype=np.int64)
+        if self.n_seqs:
+            found = np.minimum(np.searchsorted(self._hashes, hashes), self.n_seqs - 1)
+            candidates = np.flatnonzero(self._hashes[found] == hashes)
+            stored_ids = self._hash_ids[found[candidates]]
+            is_equal = np.array([seqs[i] == stored for i, stored in zip(candidates.tolist(), self.get_many(stored_ids))], dtype=bool)
+            seq_ids[candidates[is_equal]] = stored_ids[is_equal]
+
+        new_ids = {}
+        for i in np.flatnonzero(seq_ids < 0).tolist():
+            seq_ids[i] = new_ids.setdefault(seqs[i], self.n_seqs + len(new_ids))
+        if new_ids:
+            new_hashes = np.r_[self._hashes, [hash(seq) for seq in new_ids]]
+            order = np.argsort(new_hashes, kind="stable")
+            self._hashes, self._hash_ids = new_hashes[order], np.r_[self._hash_ids, list(new_ids.values())][order]
+            self._append(list(new_ids))
+        return seq_ids
+
+    def get(self, seq_id: int) -> str:
+        """
+        Unpack one sequence.
+        """
+        offset, length = int(self.offsets[seq_id]), int(self.lengths[seq_id])
+        seq = b"".join(map(QUADS.__getitem__, self.packed[offset:offset + (length + 3) // 4].tobytes()))[:length]
+        low, high = int(self.exception_starts[seq_id]), int(self.exception_starts[seq_id + 1])
+        if low < high:
+            seq = bytearray(seq)
+            for position, char in zip((self.exception_positions[low:high] - 4 * offset).tolist(), self.exception_chars[low:high].tolist()):
+                seq[position] = char
+        return seq.decode("ascii")
+
+    def get_many(self, seq_ids: np.ndarray) -> list[str]:
+        """
+        Unpack several sequences at once.
+        """
+        seq_ids = np.asarray(seq_ids, dtype=np.int64)
+        if not len(seq_ids):
+            return []
+        offsets, lengths = self.offsets[seq_ids], self.lengths[seq_ids].astype(np.int64)
+        n_bytes = (lengths + 3) // 4
+        starts = np.r_[0, np.cumsum(n_bytes)][:-1]
+        byte_positions = np.repeat(offsets - starts, n_bytes) + np.arange(n_bytes.sum())
+        chars = BASES[((self.packed[byte_positions][:, None] >> SHIFTS) & 3).ravel()]
+        # Exceptions of the requested sequences, moved to their positions in 'chars'.
+        low, high = self.exception_starts[seq_ids], self.exception_starts[seq_ids + 1]
+        if (high > low).any():
+            counts = high - low
+            exceptions = np.repeat(low - np.r_[0, np.cumsum(counts)][:-1], counts) + np.arange(counts.sum())
+            chars[self.exception_positions[exceptions] + np.repeat(4 * (starts - offsets), counts)] = self.exception_chars[exceptions]
+        text = chars.tobytes().decode("ascii")
+        return [text[4 * start:4 * start + length] for start, length in zip(starts.tolist(), lengths.tolist())]
+
+    def pack(self, seq_dict: Mapping) -> "PackedSequences":
+        """
+        Add the sequences of a name -> sequence mapping to the store.
+
+        :param seq_dict: The sequences, e.g. 'FastaReader.seq_dict'.
+        :return: A 'PackedSequences' mapping with the same names, backed by this store.
+        """
+        return PackedSequences(self, list(seq_dict), self.add(list(seq_dict.values())))
+
+
+class PackedSequences(Mapping):
+    """
+    Read-only mapping of sequence name -> sequence, with the sequences kept in a 'SequenceStore'.
+    Pickling it also pickles the store, once for all the mappings sharing it.
+
+    :attribute store: The sequence store.
+    :attribute names: The sequence names, in insertion order.
+    :attribute seq_ids: The ID in 'store' of every sequence (int32).
+    """
+    def __init__(self, store: SequenceStore, names: list[str], seq_ids: np.ndarray):
+        self.store = store
+        self.names = names
+        self.seq_ids = seq_ids
+        self._index = None
+
+    def __getitem__(self, name: str) -> str:
+        if self._index is None:
+            self._index = {name: i for i, name in enumerate(self.names)}
+        return self.store.get(self.seq_ids[self._index[name]])
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def __getstate__(self) -> dict:
+        return {**self.__dict__, "_index": None}
+
+    def items(self) -> "PackedItemsView":
+        return PackedItemsView(self)
+
+    def values(self) -> "PackedValuesView":
+        return PackedValuesView(self)
+
+
+class PackedItemsView(ItemsView):
+    """
+    Items view of a 'PackedSequences' mapping, unpacking all the sequences at once when iterated
+    rather than one by one through __getitem__.
+    """
+    def __iter__(self):
+        return zip(self._mapping.names, self._mapping.store.get_many(self._mapping.seq_ids))
+
+
+class PackedValuesView(ValuesView):
+    """
+    Values view of a 'PackedSequences' mapping, unpacking all the sequences at once when iterated
+    rather than one by one through __getitem__.
+    """
+    def __iter__(self):
+        return iter(self._mapping.store.get_many(self._mapping.seq_ids))
@@ -1,14 +1,19 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import functools
 import os
+import time
 
 from analysis_toolkit.runner_build import base_logger
-from fastq_processor.step_build import stage_config
+from fastq_processor.step_build import (stage_config, scheduler)
 from fastq_processor.step_exec import (decompress,
                                        merge,
                                        cut_primer,
+                                       preprocess,
                                        fq_to_fa,
                                        dereplicate,
                                        denoise,
-                                       assign_taxa,)
+                                       assign_taxa,
+                                       assign_taxa_batch,)
 
 class FastqProcessor:
 
@@ -42,10 +47,21 @@ class FastqProcessor:
             max_read_len,
             minsize,
             alpha,
+            maxhitnum,
             evalue,
             qcov_hsp_perc,
             perc_identity,
-            specifiers
+            specifiers,
+            assigntaxa_mode="sample",
+            cache_path="",
+            decompress_backend="auto",
+            decompress_passthrough=False,
+            fqtofa_parallel=False,
+            derep_backend="usearch",
+            denoise_partition_mb=0,
+            denoise_partition_by="abundance",
+            merge_backend="usearch",
+            cutprimer_backend="cutadapt"
         ):
         fastq_dir = os.path.join(stages_parent_dir, fastq_dir_name)
         decompress_dir = os.path.join(stages_parent_dir, decompress_dir_name)
@@ -58,11 +74,25 @@ class FastqProcessor:
 
         stages = dict()
         if "decompress" in enabled_stages:
-            stages["decompress"] = decompress.DecompressStage(config, fastq_dir=fastq_dir, save_dir=decompress_dir)
+            stages["decompress"] = decompress.DecompressStage(config, fastq_dir=fastq_dir, save_dir=decompress_dir,
+                backend=decompress_backend,
+                passthrough=decompress_passthrough
+            )
         if "merge" in enabled_stages:
             stages["merge"] = merge.MergeStage(config, decompress_dir=decompress_dir, save_dir=merge_dir,
                 maxdiff=maxdiff,
-                pctid=pctid
+                pctid=pctid,
+                backend=merge_backend
+            )
+        if "preprocess" in enabled_stages:
+            stages["preprocess"] = preprocess.PreprocessStage(config, decompress_dir=decompress_dir, save_dir=derep_dir,
+                maxdiff=maxdiff,
+                pctid=pctid,
+                rm_p_5=rm_p_5,
+                rm_p_3=rm_p_3,
+                error_rate=error_rate,
+                min_read_len=min_read_len,
+                max_read_len=max_read_len
             )
         if "cutprimer" in enabled_stages:
             stages["cutprimer"] = cut_primer.CutPrimerStage(config, merge_dir=merge_dir, save_dir=cutprimer_dir,
@@ -70,39 +100,201 @@ class FastqProcessor:
                 rm_p_3=rm_p_3,
                 error_rate=error_rate,
                 min_read_len=min_read_len,
-                max_read_len=max_read_len
+                max_read_len=max_read_len,
+                backend=cutprimer_backend
             )
         if "fqtofa" in enabled_stages:
-            stages["fqtofa"] = fq_to_fa.FqToFaStage(config, cutprimer_dir=cutprimer_dir, save_dir=fqtofa_dir)
+            stages["fqtofa"] = fq_to_fa.FqToFaStage(config, cutprimer_dir=cutprimer_dir, save_dir=fqtofa_dir,
+                parallel=fqtofa_parallel
+            )
         if "dereplicate" in enabled_stages:
-            stages["dereplicate"] = dereplicate.DereplicateStage(config, fasta_dir=fqtofa_dir, save_dir=derep_dir)
+            stages["dereplicate"] = dereplicate.DereplicateStage(config, fasta_dir=fqtofa_dir, save_dir=derep_dir,
+                backend=derep_backend
+            )
         if "denoise" in enabled_stages:
             stages["denoise"] = denoise.DenoiseStage(config, derep_dir=derep_dir, save_dir=denoise_dir,
                 minsize=minsize,
-                alpha=alpha
+                alpha=alpha,
+                partition_mb=denoise_partition_mb,
+                partition_by=denoise_partition_by
             )
-        if "assigntaxa" in enabled_stages:
+        if "assigntaxa" in enabled_stages and assigntaxa_mode == "sample":
             stages["assigntaxa"] = assign_taxa.AssignTaxaStage(config, denoise_dir=denoise_dir, save_dir=blast_dir,
                 db_path=db_path,
                 lineage_path=lineage_path,
+                maxhitnum=maxhitnum,
                 evalue=evalue,
                 qcov_hsp_perc=qcov_hsp_perc,
                 perc_identity=perc_identity,
-                specifiers=specifiers
+                specifiers=specifiers,
+                cache_path=cache_path
                 )
 
         return stages
 
     @staticmethod
-    def run_each_data(prefix, stages):
+    def setup_batch_stage(config, stage_params, batch_size):
+        """
+        Build the assign-taxa stage that runs once for all samples, after the per-sample stages.
+
+        :param config: The StageConfig of the run.
+        :param stage_params: Keyword arguments passed to 'setup_stages'. Its 'assigntaxa_mode' selects the stage.
+        :param batch_size: Maximum number of samples per blastn run in "batch" mode. 0 puts all samples into one run.
+        :returns: The BatchAssignTaxaStage ("batch") or PoolAssignTaxaStage ("pool").
+        """
+        denoise_dir = os.path.join(stage_params["stages_parent_dir"], stage_params["denoise_dir_name"])
+        blast_dir = os.path.join(stage_params["stages_parent_dir"], stage_params["blast_dir_name"])
+        if stage_params["assigntaxa_mode"] == "pool":
+            stage_class = assign_taxa_batch.PoolAssignTaxaStage
+        else:
+            stage_class = assign_taxa_batch.BatchAssignTaxaStage
+        return stage_class(config, denoise_dir=denoise_dir, save_dir=blast_dir,
+            batch_size=batch_size,
+            db_path=stage_params["db_path"],
+            lineage_path=stage_params["lineage_path"],
+            maxhitnum=stage_params["maxhitnum"],
+            evalue=stage_params["evalue"],
+            qcov_hsp_perc=stage_params["qcov_hsp_perc"],
+            perc_identity=stage_params["perc_identity"],
+            specifiers=stage_params["specifiers"],
+            cache_path=stage_params["cache_path"]
+            )
+
+    @staticmethod
+    def run_stage(stage, prefix) -> bool:
+        """
+        Set up and run one stage for one sample. The stage is skipped if its manifest shows unchanged inputs and parameters.
+
+        :param stage: The StageBuilder to run.
+        :param prefix: The sample ID, or the list of sample IDs for a stage that runs once for all samples.
+        :returns: True if the stage completed successfully, False otherwise.
+        """
+        stage.setup(prefix)
+        return stage.run_if_changed()
+
+    @staticmethod
+    def run_each_data(prefix, stages) -> dict:
+        """
+        Run every stage in order for one sample, stopping at the first failed stage.
+
+        :param prefix: The sample ID.
+        :param stages: The stages to run, as returned by 'setup_stages'.
+        :returns: A summary dict: {"sample": prefix, "complete": bool, "failed_stage": stage name or None}.
+        """
         print(f"Sample ID: {prefix}")
         for k, s in stages.items():
-            s.setup(prefix)
-            is_complete = s.run()
+            is_complete = FastqProcessor.run_stage(s, prefix)
             if not is_complete:
                 print(f"Error: process errors at stage: {k}\n")
-                break
+                return {"sample": prefix, "complete": False, "failed_stage": k}
             print()
+        return {"sample": prefix, "complete": True, "failed_stage": None}
+
+    @staticmethod
+    def run_each_data_isolated(prefix, config, stage_params) -> dict:
+        """
+        Build a private set of stages and run them for one sample.
+        This is the process pool entry point, so concurrently running samples never share stage state.
+
+        :param prefix: The sample ID.
+        :param config: The StageConfig of this worker.
+        :param stage_params: Keyword arguments passed to 'setup_stages'.
+        :returns: The summary dict from 'run_each_data'.
+        """
+        stages = FastqProcessor.setup_stages(config=config, **stage_params)
+        return FastqProcessor.run_each_data(prefix, stages)
+
+    def run_samples_parallel(self, n_workers: int) -> dict[str, dict]:
+        """
+        Run samples concurrently in a process pool. The 'n_cpu' and 'memory' budget is split evenly across the workers.
+
+        :param n_workers: Number of samples to process at the same time.
+        :returns: A dictionary mapping each sample ID to its summary dict.
+        """
+        worker_config = self.config.get_worker_config(n_workers)
+        self.config.logger.info(
+            f"Running {len(self.data_prefix)} samples with {n_workers} workers, "
+            f"{worker_config.n_cpu} CPU(s) and {worker_config.memory} GB memory per worker."
+        )
+
+        summary = {}
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = {
+                executor.submit(FastqProcessor.run_each_data_isolated, prefix, worker_config, self.stage_params): prefix
+                for prefix in self.data_prefix
+            }
+            for future in as_completed(futures):
+                prefix = futures[future]
+                try:
+                    summary[prefix] = future.result()
+                except Exception as e:
+                    self.config.logger.error(f"FAIL: Sample {prefix}. Exception: {e}")
+                    summary[prefix] = {"sample": prefix, "complete": False, "failed_stage": None}
+        return summary
+
+    def run_samples_dag(self, n_workers: int) -> dict[str, dict]:
+        """
+        Run every (sample, stage) pair as a task of a dependency graph.
+        Each task waits for the previous stage of the same sample and until its CPU and memory footprint fits the
+        'n_cpu' and 'memory' budget, so CPU-light stages of one sample overlap with CPU-heavy stages of another
+        without oversubscribing the node. Memory footprints are learned from the measured peak RSS of finished stages.
+        Multithreaded stages use an 'n_cpu / n_workers' share of the cores; the critical path is logged at the end.
+
+        :param n_workers: Number of shares the 'n_cpu' budget is split into for multithreaded stages.
+        :returns: A dictionary mapping each sample ID to its summary dict.
+        """
+        worker_config = self.config.get_worker_config(n_workers)
+        self.scheduler = scheduler.DagScheduler(n_cpu=self.config.n_cpu, logger=self.config.logger, memory=self.config.memory)
+        for prefix in self.data_prefix:
+            stages = FastqProcessor.setup_stages(config=worker_config, **self.stage_params)
+            previous_task = []
+            for stage_name, stage in stages.items():
+                task = self.scheduler.add_task(
+                    (prefix, stage_name),
+                    functools.partial(FastqProcessor.run_stage, stage, prefix),
+                    n_cpu=stage.get_n_cpu(),
+                    depends_on=previous_task,
+                    memory=stage.get_memory(),
+                    kind=stage_name,
+                    get_peak_memory=stage.get_peak_memory
+                )
+                previous_task = [task.name]
+
+        task_status = self.scheduler.run()
+        self.scheduler.log_critical_path()
+
+        summary = {prefix: {"sample": prefix, "complete": True, "failed_stage": None} for prefix in self.data_prefix}
+        for (prefix, stage_name), status in task_status.items():
+            if status == "FAIL":
+                summary[prefix] = {"sample": prefix, "complete": False, "failed_stage": stage_name}
+        return summary
+
+    def run_assign_taxa_batch(self, batch_size: int):
+        """
+        Assign taxonomy to all samples that completed the per-sample stages with batched or pooled blastn runs,
+        and mark them as failed at "assigntaxa" if the batch fails.
+
+        :param batch_size: Maximum number of samples per blastn run. 0 puts all samples into one run.
+        """
+        prefixes = [prefix for prefix in self.data_prefix if self.summary[prefix]["complete"]]
+        if not prefixes:
+            return
+        self.config.logger.info(f"Assigning taxonomy to {len(prefixes)} samples in {self.stage_params['assigntaxa_mode']} mode.")
+        stage = FastqProcessor.setup_batch_stage(self.config, self.stage_params, batch_size)
+        is_complete = FastqProcessor.run_stage(stage, prefixes)
+        if not is_complete:
+            for prefix in prefixes:
+                self.summary[prefix] = {"sample": prefix, "complete": False, "failed_stage": "assigntaxa"}
+
+    def log_summary(self):
+        """
+        Log how many samples completed and which stage each failed sample stopped at.
+        """
+        n_complete = sum(result["complete"] for result in self.summary.values())
+        self.config.logger.info(f"COMPLETE: {n_complete}/{len(self.summary)} samples processed successfully.")
+        for prefix, result in self.summary.items():
+            if not result["complete"]:
+                self.config.logger.error(f"FAIL: Sample {prefix} stopped at stage: {result['failed_stage']}.")
 
     def __init__(self,
         stages_parent_dir: str,
@@ -126,6 +318,7 @@ class FastqProcessor:
         max_read_len: int = 254,
         minsize: int = 8,
         alpha: int = 2,
+        maxhitnum: int = 1,
         evalue: float = 0.00001,
         qcov_hsp_perc: int = 90,
         perc_identity: int = 90,
@@ -133,14 +326,39 @@ class FastqProcessor:
         verbose: bool=True,
         n_cpu: int = 1,
         memory: int = 8,
+        n_workers: int = 1,
+        scheduler_type: str = "sample",
+        assigntaxa_mode: str = "sample",
+        blast_batch_size: int = 0,
+        taxonomy_cache_path: str = "",
+        decompress_backend: str = "auto",
+        decompress_passthrough: bool = False,
+        fqtofa_parallel: bool = False,
+        derep_backend: str = "usearch",
+        denoise_partition_mb: float = 0,
+        denoise_partition_by: str = "abundance",
+        merge_backend: str = "usearch",
+        cutprimer_backend: str = "cutadapt",
+        programs: dict[str, str] = None,
+        resume: bool = True,
+        record_metrics: bool = True,
         ):
+        if scheduler_type not in ("sample", "dag"):
+            raise ValueError(f"Invalid scheduler_type: {scheduler_type}. Must be 'sample' or 'dag'.")
+        if assigntaxa_mode not in ("sample", "batch", "pool"):
+            raise ValueError(f"Invalid assigntaxa_mode: {assigntaxa_mode}. Must be 'sample', 'batch' or 'pool'.")
+        if "preprocess" in enabled_stages and {"merge", "cutprimer", "fqtofa", "dereplicate"} & set(enabled_stages):
+            raise ValueError("The 'preprocess' stage replaces the 'merge', 'cutprimer', 'fqtofa' and 'dereplicate' stages, which cannot be enabled with it.")
+        if decompress_passthrough and not ("decompress" in enabled_stages and {"merge", "preprocess"} & set(enabled_stages)):
+            raise ValueError("decompress_passthrough needs the 'decompress' stage and the 'merge' or 'preprocess' stage, which read the streams in the same run.")
         fp_fh = base_logger._get_file_handler(os.path.join(stages_parent_dir, "stages.log"))
         base_logger.logger.addHandler(fp_fh)
-        self.config = stage_config.StageConfig(verbose=verbose, logger=base_logger.logger, n_cpu=n_cpu, memory=memory) # TODO(SW): Expand this class, so you only need to pass one parameters.
+        metrics_path = os.path.join(stages_parent_dir, f"metrics_{time.strftime('%Y%m%d_%H%M%S')}.jsonl") if record_metrics else None
+        self.config = stage_config.StageConfig(verbose=verbose, logger=base_logger.logger, n_cpu=n_cpu, memory=memory, resume=resume,
+                                               metrics_path=metrics_path, programs=programs) # TODO(SW): Expand this class, so you only need to pass one parameters.
         self.parent_dir = stages_parent_dir
         self.input_dir = os.path.join(stages_parent_dir, fastq_dir_name)
-        self.stages = FastqProcessor.setup_stages(
-            config=self.config,
+        self.stage_params = dict(
             enabled_stages=enabled_stages,
             stages_parent_dir=stages_parent_dir,
             fastq_dir_name=fastq_dir_name,
@@ -162,15 +380,37 @@ class FastqProcessor:
             max_read_len=max_read_len,
             minsize=minsize,
             alpha=alpha,
+            maxhitnum=maxhitnum,
             evalue=evalue,
             qcov_hsp_perc=qcov_hsp_perc,
             perc_identity=perc_identity,
-            specifiers=specifiers
+            specifiers=specifiers,
+            assigntaxa_mode=assigntaxa_mode,
+            cache_path=taxonomy_cache_path,
+            decompress_backend=decompress_backend,
+            decompress_passthrough=decompress_passthrough,
+            fqtofa_parallel=fqtofa_parallel,
+            derep_backend=derep_backend,
+            denoise_partition_mb=denoise_partition_mb,
+            denoise_partition_by=denoise_partition_by,
+            merge_backend=merge_backend,
+            cutprimer_backend=cutprimer_backend
         )
         self.data_prefix = FastqProcessor.get_prefix_with_suffix(self.input_dir, "_R1.fastq.gz")
 
-        for prefix in self.data_prefix:
-            FastqProcessor.run_each_data(prefix, self.stages)
+        n_workers = max(1, min(n_workers, len(self.data_prefix)))
+        if scheduler_type == "dag":
+            self.summary = self.run_samples_dag(n_workers)
+        elif n_workers > 1:
+            self.summary = self.run_samples_parallel(n_workers)
+        else:
+            self.stages = FastqProcessor.setup_stages(config=self.config, **self.stage_params)
+            self.summary = {}
+            for prefix in self.data_prefix:
+                self.summary[prefix] = FastqProcessor.run_each_data(prefix, self.stages)
+        if "assigntaxa" in enabled_stages and assigntaxa_mode != "sample":
+            self.run_assign_taxa_batch(blast_batch_size)
+        self.log_summary()
 
 def main():
     FastqProcessor(
@@ -0,0 +1,28 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+
+def map_chunks(func, chunks, n_workers: int = 1, max_pending: int = 0):
+    """
+    Apply a function to a stream of chunks in worker processes, yielding the results in input order.
+    At most 'max_pending' chunks are in flight, so memory stays bounded however long the stream is.
+
+    :param func: A picklable (module-level) function taking one chunk.
+    :param chunks: Iterable of chunks. It is consumed lazily.
+    :param n_workers: Number of worker processes. 1 runs everything in this process.
+    :param max_pending: Maximum number of submitted chunks without a collected result. Default is twice 'n_workers'.
+    :returns: Generator of the results.
+    """
+    if n_workers <= 1:
+        yield from map(func, chunks)
+        return
+
+    max_pending = max_pending or 2 * n_workers
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(func, chunk))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
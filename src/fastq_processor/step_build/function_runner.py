@@ -1,8 +1,11 @@
-from fastq_processor.step_build import runner
+from fastq_processor.step_build import (runner, resource_monitor)
 from fastq_processor.step_build.stage_config import StageConfig
 
 
 class FunctionRunner(runner.Runner):
+    # The function runs in this process, so its peak RSS also counts the other tasks running at the same time.
+    MEASURES_OWN_MEMORY = False
+
     def __init__(self, prog_name, function, config):
         super().__init__(prog_name, config)
         self.function = function
@@ -17,10 +20,14 @@ class FunctionRunner(runner.Runner):
             self.logger.info(self.message)
         
         if not self.dry:
+            monitor = resource_monitor.FunctionMonitor()
             try:
-                self.function()
+                with monitor:
+                    self.function()
+                self.record_usage(monitor.usage, True)
                 self.logger.info(f"COMPLETE: {self.prog_name}.")
                 return True
             except Exception as e:
-                self.logger.error(f"FAIL: {self.prog_name}. Exception: {e.stderr}")
+                self.record_usage(monitor.usage, False)
+                self.logger.error(f"FAIL: {self.prog_name}. Exception: {e}")
                 return False
\ No newline at end of file
@@ -0,0 +1,169 @@
+from importlib import metadata
+import hashlib
+import json
+import os
+import subprocess
+
+# Tool versions are looked up once per program and process.
+TOOL_VERSION_CACHE = {}
+
+
+def hash_file(file_path: str, block_size: int = 1 << 20) -> str | None:
+    """
+    Compute the SHA-256 digest of a regular file.
+
+    :param file_path: Path to the file.
+    :param block_size: Number of bytes read at a time.
+    :returns: The hex digest, or None if the path is missing or not a regular file (e.g. a named pipe).
+    """
+    if not os.path.isfile(file_path):
+        return None
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as handle:
+        while block := handle.read(block_size):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def stat_file(file_path: str) -> list[int] | None:
+    """
+    Get the size and modification time of a regular file, recorded next to its digest so unchanged files are not hashed again.
+
+    :param file_path: Path to the file.
+    :returns: [size in bytes, modification time in nanoseconds], or None if the path is missing or not a regular file.
+    """
+    if not os.path.isfile(file_path):
+        return None
+    stat = os.stat(file_path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def get_tool_version(command: list[str] | None = None) -> str:
+    """
+    Get the version string of an external tool, or of this package when no command is given.
+
+    :param command: The command printing the version, e.g. ["usearch", "--version"].
+    :returns: The first non-empty line printed by the command, or "unknown" if it cannot be run.
+    """
+    key = tuple(command) if command else None
+    if key in TOOL_VERSION_CACHE:
+        return TOOL_VERSION_CACHE[key]
+
+    if command is None:
+        try:
+            version = f"edna_bp {metadata.version('edna_bp')}"
+        except metadata.PackageNotFoundError:
+            version = "edna_bp unknown"
+    else:
+        try:
+            result = subprocess.run(command, capture_output=True, text=True, timeout=60)
+            lines = [line.strip() for line in (result.stdout + result.stderr).splitlines() if line.strip()]
+            version = lines[0] if lines else "unknown"
+        except (OSError, subprocess.SubprocessError):
+            version = "unknown"
+
+    TOOL_VERSION_CACHE[key] = version
+    return version
+
+
+class StageManifest:
+    """
+    Record of what produced the outputs of one stage for one sample: the stage, its parameter string,
+    the tool version and the SHA-256 of every input file. It is saved as JSON next to the outputs.
+
+    Attributes:
+        manifest_path (str): Path to the manifest JSON file.
+        stage (str): Heading of the stage.
+        params (str): The parameter string of the stage.
+        get_tool_version (callable): Returns the version of the tool running the stage. Only called when the manifest is checked or written.
+        inputs (list): Input file paths.
+        outputs (list): Output file paths.
+    """
+    def __init__(self, manifest_path: str, stage: str, params: str, get_tool_version,
+                 inputs: list[str], outputs: list[str]):
+        self.manifest_path = manifest_path
+        self.stage = stage
+        self.params = params
+        self.get_tool_version = get_tool_version
+        self.inputs = inputs
+        self.outputs = outputs
+        self._input_hashes = None
+        self._input_stats = None
+
+    def get_input_hashes(self, previous: dict | None = None) -> dict[str, str | None]:
+        """
+        SHA-256 of every input file, keyed by file name. Inputs are only hashed when their size or modification time
+        differ from those recorded in the previous manifest.
+
+        :param previous: The previous manifest record, if any.
+        :returns: The digest of every input, or None for inputs that are not regular files.
+        """
+        if self._input_hashes is None:
+            previous = previous or {}
+            known_hashes, known_stats = previous.get("inputs", {}), previous.get("input_stats", {})
+            self._input_stats, self._input_hashes = {}, {}
+            for path in self.inputs:
+                name, stats = os.path.basename(path), stat_file(path)
+                self._input_stats[name] = stats
+                if stats is not None and known_stats.get(name) == stats and known_hashes.get(name):
+                    self._input_hashes[name] = known_hashes[name]
+                else:
+                    self._input_hashes[name] = hash_file(path)
+        return self._input_hashes
+
+    def build_record(self) -> dict:
+        return {
+            "stage": self.stage,
+            "params": self.params,
+            "tool_version": self.get_tool_version(),
+            "inputs": self.get_input_hashes(),
+            "input_stats": self._input_stats,
+            "outputs": [os.path.basename(path) for path in self.outputs],
+        }
+
+    def is_up_to_date(self) -> bool:
+        """
+        Check whether a previous run recorded the same stage, parameters, tool version and input contents, and all outputs still exist.
+        Inputs that are not regular files (e.g. named pipes) cannot be hashed, so such stages are never up to date.
+        If an input was touched but its content is unchanged, the manifest is rewritten with its new size and modification time.
+
+        :returns: True if the stage can be skipped, False otherwise.
+        """
+        if not os.path.isfile(self.manifest_path):
+            return False
+        try:
+            with open(self.manifest_path, "r") as handle:
+                previous = json.load(handle)
+        except (OSError, ValueError):
+            return False
+        if not isinstance(previous, dict):
+            return False
+
+        # Digests recorded by the previous run are reused, also by 'write' if the stage has to run again.
+        input_hashes = self.get_input_hashes(previous)
+        if not all(os.path.isfile(path) for path in self.outputs):
+            return False
+        if None in input_hashes.values():
+            return False
+
+        record = self.build_record()
+        # Manifests written before the sizes and modification times were recorded are compared on the digests alone.
+        if {**previous, "input_stats": None} != {**record, "input_stats": None}:
+            return False
+        if previous.get("input_stats") != record["input_stats"]:
+            self.write()
+        return True
+
+    def write(self):
+        """
+        Save the manifest after the stage completed successfully.
+        """
+        with open(self.manifest_path, "w") as handle:
+            json.dump(self.build_record(), handle, indent=2)
+
+    def remove(self):
+        """
+        Delete a stale manifest, so a failed rerun is never mistaken for a completed one.
+        """
+        if os.path.isfile(self.manifest_path):
+            os.remove(self.manifest_path)
@@ -0,0 +1,89 @@
+import threading
+
+
+class ResourceBroker:
+    """
+    Admit jobs only while their CPU and memory footprint fits the remaining budget.
+    A job larger than the whole budget is only admitted when nothing else is running, so it can never deadlock the queue.
+    A waiting job can hold back its footprint, so that later jobs are not admitted into the resources it is waiting for.
+    Memory footprints are learned from the observed peak RSS of earlier jobs of the same kind and replace the declared ones.
+    Only jobs whose memory is measured on their own (see 'StageBuilder.get_peak_memory') are observed; the others keep their declared footprint.
+
+    Attributes:
+        n_cpu (int): Total number of CPU cores.
+        memory (float): Total memory in GB. None means memory is not limited.
+        logger (Logger): Logger object for logging messages.
+        learned_memory (dict): Largest observed peak memory (GB) for each job kind.
+        margin (float): Factor applied to learned memory, to leave headroom for larger inputs.
+    """
+    def __init__(self, n_cpu: int, memory: float = None, logger=None, margin: float = 1.2):
+        self.n_cpu = max(1, n_cpu)
+        self.memory = memory
+        self.logger = logger
+        self.margin = margin
+        self.learned_memory = {}
+        self.free_cpu = self.n_cpu
+        self.free_memory = memory
+        self.n_running = 0
+        self._lock = threading.Lock()
+
+    def estimate_memory(self, kind: str, declared: float) -> float:
+        """
+        Expected memory footprint of a job in GB: the learned peak of its kind if any, otherwise the declared value.
+
+        :param kind: The kind of the job, e.g. the stage name.
+        :param declared: The footprint declared by the job.
+        """
+        if kind in self.learned_memory:
+            return self.learned_memory[kind] * self.margin
+        return declared
+
+    def observe(self, kind: str, peak_memory: float):
+        """
+        Record the observed peak memory of a finished job.
+
+        :param kind: The kind of the job, e.g. the stage name.
+        :param peak_memory: The observed peak memory in GB.
+        """
+        if peak_memory <= 0:
+            return
+        with self._lock:
+            self.learned_memory[kind] = max(self.learned_memory.get(kind, 0.0), peak_memory)
+
+    def try_acquire(self, n_cpu: int, memory: float, reserved_cpu: int = 0, reserved_memory: float = 0.0) -> bool:
+        """
+        Reserve resources for a job if they are available.
+
+        :param n_cpu: CPU cores requested by the job.
+        :param memory: Memory in GB requested by the job.
+        :param reserved_cpu: CPU cores held back for an earlier job that is waiting, which this job must not take.
+        :param reserved_memory: Memory in GB held back for an earlier job that is waiting.
+        :returns: True if the job is admitted, False if it has to stay queued.
+        """
+        with self._lock:
+            fits_cpu = n_cpu <= self.free_cpu - reserved_cpu
+            fits_memory = self.memory is None or memory <= max(0.0, self.free_memory - reserved_memory)
+            oversized = n_cpu > self.n_cpu or (self.memory is not None and memory > self.memory)
+            if not (fits_cpu and fits_memory) and not (oversized and self.n_running == 0):
+                return False
+            if oversized and self.logger:
+                self.logger.warning(f"WARNING: Job needs {n_cpu} CPU / {memory:.1f} GB, more than the budget "
+                                    f"{self.n_cpu} CPU / {self.memory} GB. Running it alone.")
+            self.free_cpu -= n_cpu
+            if self.memory is not None:
+                self.free_memory -= memory
+            self.n_running += 1
+            return True
+
+    def release(self, n_cpu: int, memory: float):
+        """
+        Return the resources of a finished job.
+
+        :param n_cpu: CPU cores the job was admitted with.
+        :param memory: Memory in GB the job was admitted with.
+        """
+        with self._lock:
+            self.free_cpu += n_cpu
+            if self.memory is not None:
+                self.free_memory += memory
+            self.n_running -= 1
@@ -0,0 +1,270 @@
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Serialises writes to the metrics file from threads of one process. Lines from different processes are written with O_APPEND.
+METRICS_LOCK = threading.Lock()
+
+# ru_maxrss is reported in kilobytes on Linux and in bytes on macOS.
+MAXRSS_TO_MB = 1 / (1024 * 1024) if sys.platform == "darwin" else 1 / 1024
+
+BLOCK_SIZE = 512
+
+
+def empty_usage(wall_s: float = 0.0) -> dict:
+    return {
+        "wall_s": wall_s,
+        "user_s": 0.0,
+        "sys_s": 0.0,
+        "max_rss_mb": 0.0,
+        "read_bytes": 0,
+        "write_bytes": 0,
+    }
+
+
+def rusage_to_usage(rusage, wall_s: float) -> dict:
+    """
+    Convert a 'resource.struct_rusage' of a child process into a usage dict.
+    Bytes read and written are the block I/O counts of the child, i.e. data actually read from or written to disk.
+    """
+    return {
+        "wall_s": wall_s,
+        "user_s": rusage.ru_utime,
+        "sys_s": rusage.ru_stime,
+        "max_rss_mb": rusage.ru_maxrss * MAXRSS_TO_MB,
+        "read_bytes": rusage.ru_inblock * BLOCK_SIZE,
+        "write_bytes": rusage.ru_oublock * BLOCK_SIZE,
+    }
+
+
+def combine_usage(usages: list[dict], wall_s: float) -> dict:
+    """
+    Combine the usage of processes that ran at the same time, e.g. the commands of a pipeline.
+    CPU time, peak memory and I/O are summed, since the processes were alive together.
+    """
+    combined = empty_usage(wall_s)
+    for usage in usages:
+        for key in ("user_s", "sys_s", "max_rss_mb", "read_bytes", "write_bytes"):
+            combined[key] += usage[key]
+    return combined
+
+
+def read_peak_rss_mb(pid: int) -> float:
+    """
+    Peak resident set size of a process since its last exec, in MB, read from /proc/[pid]/status (VmHWM).
+    Returns 0.0 where /proc is not available or the process has exited.
+    """
+    try:
+        with open(f"/proc/{pid}/status", "r") as handle:
+            for line in handle:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return 0.0
+
+
+class ProcessMonitor:
+    """
+    Collect the resource usage of a child process: wait4 reports CPU time, block I/O and peak RSS when the child is reaped.
+    The ru_maxrss of a child also counts the memory of this process it was forked from, so the peak RSS after exec
+    is sampled from /proc by a background thread while the child runs, and ru_maxrss is only used where /proc is not available.
+
+    Attributes:
+        process (subprocess.Popen): The child process to monitor.
+        start_time (float): The time.perf_counter() value when the process was started.
+    """
+    def __init__(self, process, start_time: float = None, interval: float = 0.05):
+        self.process = process
+        self.start_time = time.perf_counter() if start_time is None else start_time
+        self.interval = interval
+        self._stop = threading.Event()
+        self._peak_rss_mb = 0.0
+        self._sampler = threading.Thread(target=self._sample_rss, daemon=True)
+        self._sampler.start()
+
+    def _sample_rss(self):
+        while not self._stop.is_set():
+            self._peak_rss_mb = max(self._peak_rss_mb, read_peak_rss_mb(self.process.pid))
+            self._stop.wait(self.interval)
+
+    def wait(self) -> tuple[int, dict]:
+        """
+        Wait for the child process with wait4. Falls back to a plain wait, recording only the wall-clock time and sampled RSS, where wait4 is not available.
+
+        :returns: A tuple of (return code, usage dict).
+        """
+        if not hasattr(os, "wait4") or self.process.returncode is not None:
+            self.process.wait()
+            usage = empty_usage(time.perf_counter() - self.start_time)
+        else:
+            _, status, rusage = os.wait4(self.process.pid, 0)
+            self.process.returncode = os.waitstatus_to_exitcode(status)
+            usage = rusage_to_usage(rusage, time.perf_counter() - self.start_time)
+        self._stop.set()
+        self._sampler.join()
+        if self._peak_rss_mb > 0:
+            usage["max_rss_mb"] = self._peak_rss_mb
+        return self.process.returncode, usage
+
+    def communicate(self) -> tuple[bytes, bytes, dict]:
+        """
+        Read the stdout and stderr pipes of the child process until it exits, then collect its resource usage.
+        Popen.communicate() cannot be used because it reaps the child before wait4 can report on it.
+
+        :returns: A tuple of (stdout, stderr, usage dict).
+        """
+        buffers = {}
+
+        def read_pipe(name, pipe):
+            buffers[name] = pipe.read() if pipe else b""
+
+        readers = [
+            threading.Thread(target=read_pipe, args=("stdout", self.process.stdout)),
+            threading.Thread(target=read_pipe, args=("stderr", self.process.stderr)),
+        ]
+        for reader in readers:
+            reader.start()
+        for reader in readers:
+            reader.join()
+        _, usage = self.wait()
+        return buffers["stdout"], buffers["stderr"], usage
+
+
+def read_self_rss_mb() -> float:
+    """
+    Current resident set size of this process in MB, read from /proc. Returns 0.0 where /proc is not available.
+    """
+    try:
+        with open("/proc/self/statm", "r") as handle:
+            resident_pages = int(handle.read().split()[1])
+        return resident_pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, IndexError, AttributeError):
+        return 0.0
+
+
+def read_self_io() -> tuple[int, int]:
+    """
+    Bytes this process has read from and written to storage so far, from /proc/self/io.
+    Falls back to the block I/O counts of getrusage, and to (0, 0) where neither is available.
+    """
+    try:
+        with open("/proc/self/io", "r") as handle:
+            counters = dict(line.split(": ") for line in handle.read().splitlines())
+        return int(counters["read_bytes"]), int(counters["write_bytes"])
+    except (OSError, ValueError, KeyError):
+        if resource is None:
+            return 0, 0
+        rusage = resource.getrusage(resource.RUSAGE_SELF)
+        return rusage.ru_inblock * BLOCK_SIZE, rusage.ru_oublock * BLOCK_SIZE
+
+
+def list_children(pid: str = "self") -> list[int]:
+    """
+    PIDs of the live descendants of a process, from /proc/[pid]/task/*/children. Returns [] where /proc is not available.
+    """
+    children = []
+    try:
+        for task in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{task}/children", "r") as handle:
+                children.extend(int(child) for child in handle.read().split())
+    except (OSError, ValueError):
+        return children
+    return children + [grandchild for child in children for grandchild in list_children(child)]
+
+
+def read_private_rss_mb(pid: int) -> float:
+    """
+    Resident memory of a process that is not shared with others (Private_Clean + Private_Dirty), in MB, from /proc/[pid]/smaps_rollup.
+    Pages a forked worker still shares with its parent are left out, since the parent already counts them.
+    Returns 0.0 where /proc is not available or the process has exited.
+    """
+    private_kb = 0
+    try:
+        with open(f"/proc/{pid}/smaps_rollup", "r") as handle:
+            for line in handle:
+                if line.startswith(("Private_Clean:", "Private_Dirty:")):
+                    private_kb += int(line.split()[1])
+    except (OSError, ValueError, IndexError):
+        return 0.0
+    return private_kb / 1024
+
+
+def read_children_rss_mb() -> float:
+    """
+    Private resident memory of all the live descendants of this process, in MB.
+    """
+    return sum(read_private_rss_mb(child) for child in list_children())
+
+
+class FunctionMonitor:
+    """
+    Measure an in-process function: wall-clock time, CPU time and I/O deltas of this process,
+    and the peak memory sampled by a background thread while the function runs.
+    The peak memory is the growth of the RSS of this process over its value when the function started,
+    plus the private RSS of the child processes, e.g. the workers of a process pool.
+    CPU time, I/O and memory are process-wide, so they include other threads (and their children) running at the same time.
+
+    Usage:
+        with FunctionMonitor() as monitor:
+            function()
+        monitor.usage
+    """
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.usage = None
+        self._stop = threading.Event()
+        self._peak_rss_mb = 0.0
+
+    def _read_rss_mb(self) -> float:
+        return max(0.0, read_self_rss_mb() - self._start_rss_mb) + read_children_rss_mb()
+
+    def _sample_rss(self):
+        while not self._stop.is_set():
+            self._peak_rss_mb = max(self._peak_rss_mb, self._read_rss_mb())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._start_time = time.perf_counter()
+        self._start_cpu = os.times()
+        self._start_io = read_self_io()
+        self._start_rss_mb = read_self_rss_mb()
+        self._peak_rss_mb = self._read_rss_mb()
+        self._sampler = threading.Thread(target=self._sample_rss, daemon=True)
+        self._sampler.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stop.set()
+        self._sampler.join()
+        end_cpu = os.times()
+        end_io = read_self_io()
+        self.usage = {
+            "wall_s": time.perf_counter() - self._start_time,
+            "user_s": end_cpu.user - self._start_cpu.user,
+            "sys_s": end_cpu.system - self._start_cpu.system,
+            "max_rss_mb": max(self._peak_rss_mb, self._read_rss_mb()),
+            "read_bytes": end_io[0] - self._start_io[0],
+            "write_bytes": end_io[1] - self._start_io[1],
+        }
+        return False
+
+
+def record_metrics(metrics_path: str, entry: dict):
+    """
+    Append one JSON line to the metrics file.
+
+    :param metrics_path: Path to the JSON lines metrics file.
+    :param entry: The record to write, e.g. {"sample": ..., "stage": ..., "program": ..., "wall_s": ...}.
+    """
+    line = json.dumps(entry) + "\n"
+    with METRICS_LOCK:
+        with open(metrics_path, "a") as handle:
+            handle.write(line)
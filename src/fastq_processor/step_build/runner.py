@@ -1,6 +1,6 @@
 from abc import ABC, abstractmethod
 
-from fastq_processor.step_build import stage_config
+from fastq_processor.step_build import (stage_config, resource_monitor)
 
 
 class Runner(ABC):
@@ -15,8 +15,14 @@ class Runner(ABC):
         verbose (bool): Indicates if verbose logging is enabled.
         dry (bool): Indicates if the runner should perform a dry run (no actual execution).
         logger (Logger): Logger object for logging messages.
+        metrics_path (str): JSON lines file the resource usage of each run is appended to. None disables recording.
+        tags (dict): Keys identifying the run in the metrics file, e.g. {"sample": ..., "stage": ...}.
+        usage (dict): Resource usage of the last run: wall/user/sys time, peak RSS and bytes read/written.
+        MEASURES_OWN_MEMORY (bool): Whether the peak RSS in 'usage' belongs to this run alone, e.g. measured on its own child process.
     """
 
+    MEASURES_OWN_MEMORY = True
+
     MSG_LOG = "==LOG=="
     MSG_DEBUG = "===DEBUG==="
 
@@ -24,13 +30,28 @@ class Runner(ABC):
         self.prog_name = prog_name  # for debug/naming only
         self.message = f"Program: {self.prog_name}."
         self.capture_output = None
+        self.tags = {}
+        self.usage = None
         try:
             self.verbose = config.verbose
             self.dry = config.dry
             self.logger = config.logger
+            self.metrics_path = config.metrics_path
         except AttributeError as e:
             print(e)
 
+    def record_usage(self, usage: dict, is_complete: bool):
+        """
+        Keep the resource usage of the last run and append it to the metrics file.
+
+        :param usage: The usage dict collected by 'resource_monitor'.
+        :param is_complete: Whether the run was successful.
+        """
+        self.usage = usage
+        if getattr(self, "metrics_path", None):
+            entry = {**self.tags, "program": self.prog_name, "complete": is_complete, **usage}
+            resource_monitor.record_metrics(self.metrics_path, entry)
+
 
     @abstractmethod
     def run(self):
@@ -0,0 +1,182 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import time
+
+from fastq_processor.step_build import resource_broker
+
+
+class Task:
+    """
+    A unit of work for the DAG scheduler, usually one stage of one sample.
+
+    Attributes:
+        name (tuple): Unique name of the task, e.g. (sample ID, stage name).
+        func (callable): The function to execute. Returns True/False for success/failure.
+        n_cpu (int): Number of CPU cores the task occupies while it is running.
+        memory (float): Declared memory footprint in GB. Replaced by the learned footprint of its kind once one has been observed.
+        kind (str): Tasks of the same kind share learned memory footprints, e.g. the stage name.
+        get_peak_memory (callable): Returns the peak memory (GB) of the finished task, or None if it is not measured.
+        depends_on (list): Names of the tasks that must complete before this task can start.
+        status (str): One of "PENDING", "RUNNING", "COMPLETE", "FAIL" or "SKIP".
+        start_time (float): Time when the task started, in seconds since the run started.
+        end_time (float): Time when the task finished, in seconds since the run started.
+    """
+    def __init__(self, name: tuple, func, n_cpu: int = 1, memory: float = 0.0, kind: str = None,
+                 get_peak_memory=None, depends_on: list = []):
+        self.name = name
+        self.func = func
+        self.n_cpu = max(1, n_cpu)
+        self.memory = memory
+        self.kind = kind
+        self.get_peak_memory = get_peak_memory
+        self.admitted_memory = 0.0
+        self.depends_on = list(depends_on)
+        self.status = "PENDING"
+        self.start_time = None
+        self.end_time = None
+
+    @property
+    def duration(self) -> float:
+        if self.start_time is None or self.end_time is None:
+            return 0.0
+        return self.end_time - self.start_time
+
+
+class DagScheduler:
+    """
+    Run tasks as soon as their dependencies are complete and the resource broker admits their CPU and memory footprint.
+    Tasks are started in the order they were added, and smaller tasks backfill the resources left over by larger ones,
+    so light stages of the next sample overlap with heavy stages of the current one. Tasks that do not fit stay queued;
+    the oldest of them reserves its footprint, so later tasks cannot delay it indefinitely.
+
+    Attributes:
+        n_cpu (int): Total number of CPU cores shared by all running tasks.
+        memory (float): Total memory in GB shared by all running tasks. None means memory is not limited.
+        logger (Logger): Logger object for logging messages.
+        broker (ResourceBroker): Admission control for the CPU and memory budget.
+        tasks (dict): Tasks keyed by name, in insertion order.
+    """
+    def __init__(self, n_cpu: int, logger, memory: float = None):
+        self.n_cpu = max(1, n_cpu)
+        self.memory = memory
+        self.logger = logger
+        self.broker = resource_broker.ResourceBroker(self.n_cpu, memory, logger=logger)
+        self.tasks = {}
+
+    def add_task(self, name: tuple, func, n_cpu: int = 1, depends_on: list = [],
+                 memory: float = 0.0, kind: str = None, get_peak_memory=None) -> Task:
+        """
+        Add a task to the graph. Dependencies must be added before the tasks that depend on them, which keeps the graph acyclic.
+
+        :param name: Unique name of the task.
+        :param func: The function to execute. Returns True/False for success/failure.
+        :param n_cpu: Number of CPU cores the task occupies. Capped at the scheduler's 'n_cpu'.
+        :param depends_on: Names of the tasks that must complete first.
+        :param memory: Declared memory footprint in GB.
+        :param kind: Tasks of the same kind share learned memory footprints.
+        :param get_peak_memory: Returns the peak memory (GB) of the finished task, used to learn the footprint of its kind.
+        :returns: The added Task.
+        """
+        if name in self.tasks:
+            raise ValueError(f"Duplicate task: {name}.")
+        for dependency in depends_on:
+            if dependency not in self.tasks:
+                raise ValueError(f"Task {name} depends on unknown task: {dependency}.")
+        task = Task(name, func, n_cpu=min(n_cpu, self.n_cpu), memory=memory, kind=kind,
+                    get_peak_memory=get_peak_memory, depends_on=depends_on)
+        self.tasks[name] = task
+        return task
+
+    def _ready_tasks(self) -> list[Task]:
+        """
+        Find pending tasks whose dependencies are all complete. Tasks depending on a failed or skipped task are marked "SKIP".
+        """
+        ready = []
+        for task in self.tasks.values():
+            if task.status != "PENDING":
+                continue
+            dependency_status = [self.tasks[dependency].status for dependency in task.depends_on]
+            if any(status in ("FAIL", "SKIP") for status in dependency_status):
+                task.status = "SKIP"
+                self.logger.warning(f"SKIP: {task.name}. A dependency did not complete.")
+            elif all(status == "COMPLETE" for status in dependency_status):
+                ready.append(task)
+        return ready
+
+    def run(self) -> dict[tuple, str]:
+        """
+        Execute all tasks.
+
+        :returns: A dictionary mapping each task name to its final status.
+        """
+        running = {}
+        run_start = time.perf_counter()
+
+        with ThreadPoolExecutor(max_workers=self.n_cpu) as executor:
+            while True:
+                # The oldest ready task that does not fit reserves its footprint, so the tasks after it cannot
+                # keep taking the resources it waits for. Later tasks only backfill what is left beyond it.
+                reserved_cpu, reserved_memory = 0, 0.0
+                for task in self._ready_tasks():
+                    memory = self.broker.estimate_memory(task.kind, task.memory)
+                    if not self.broker.try_acquire(task.n_cpu, memory, reserved_cpu, reserved_memory):
+                        if not reserved_cpu:
+                            reserved_cpu, reserved_memory = task.n_cpu, memory
+                        continue
+                    task.admitted_memory = memory
+                    task.status = "RUNNING"
+                    task.start_time = time.perf_counter() - run_start
+                    running[executor.submit(task.func)] = task
+
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task = running.pop(future)
+                    task.end_time = time.perf_counter() - run_start
+                    self.broker.release(task.n_cpu, task.admitted_memory)
+                    try:
+                        is_complete = future.result()
+                    except Exception as e:
+                        self.logger.error(f"FAIL: {task.name}. Exception: {e}")
+                        is_complete = False
+                    task.status = "COMPLETE" if is_complete else "FAIL"
+                    if is_complete and task.get_peak_memory is not None:
+                        self.broker.observe(task.kind, task.get_peak_memory() or 0.0)
+
+        return {name: task.status for name, task in self.tasks.items()}
+
+    def critical_path(self) -> tuple[list[tuple], float]:
+        """
+        Find the longest chain of dependent tasks, measured by the recorded task durations.
+
+        :returns: A tuple of (task names along the path, total duration in seconds).
+        """
+        finish = {}
+        previous = {}
+        for name, task in self.tasks.items():
+            best_dependency = max(task.depends_on, key=lambda d: finish[d], default=None)
+            finish[name] = task.duration + (finish[best_dependency] if best_dependency else 0.0)
+            previous[name] = best_dependency
+
+        if not finish:
+            return [], 0.0
+
+        name = max(finish, key=finish.get)
+        total = finish[name]
+        path = []
+        while name is not None:
+            path.append(name)
+            name = previous[name]
+        return path[::-1], total
+
+    def log_critical_path(self):
+        """
+        Log the makespan of the run and the tasks along the critical path.
+        """
+        makespan = max((task.end_time for task in self.tasks.values() if task.end_time is not None), default=0.0)
+        path, total = self.critical_path()
+        self.logger.info(f"Makespan: {makespan:.1f} s. Critical path: {total:.1f} s.")
+        for name in path:
+            task = self.tasks[name]
+            self.logger.info(f"  {name}: {task.duration:.1f} s ({task.status}, {task.n_cpu} CPU).")
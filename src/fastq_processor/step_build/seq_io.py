@@ -0,0 +1,25 @@
+def read_fasta(fasta_path: str):
+    """
+    Iterate over the records of a FASTA file.
+
+    :param fasta_path: Path to the FASTA file.
+    :returns: Generator of (sequence ID, sequence). The ID is the first word of the header, as blastn reports it as 'qseqid'.
+    """
+    seq_id, seq_parts = None, []
+    with open(fasta_path, "r") as handle:
+        for line in handle:
+            line = line.strip()
+            if line.startswith(">"):
+                if seq_id is not None:
+                    yield seq_id, "".join(seq_parts)
+                seq_id, seq_parts = line[1:].split()[0], []
+            elif line:
+                seq_parts.append(line)
+    if seq_id is not None:
+        yield seq_id, "".join(seq_parts)
+
+
+def write_fasta(records: list[tuple[str, str]], fasta_path: str):
+    with open(fasta_path, "w") as handle:
+        for seq_id, seq in records:
+            handle.write(f">{seq_id}\n{seq}\n")
@@ -1,7 +1,7 @@
 from abc import ABC, abstractmethod
 import os
 
-from fastq_processor.step_build import (stage_config, subproces_runner, function_runner)
+from fastq_processor.step_build import (stage_config, subproces_runner, function_runner, manifest, stream_feeder)
 
 
 class StageBuilder(ABC):
@@ -13,13 +13,25 @@ class StageBuilder(ABC):
         config (StageConfig): The configuration for the stage.
         runners (list of Runner): List of runners to execute.
         output (list): List of outputs from the executed runners.
+        manifest (StageManifest): Record of the inputs, parameters and tool version of the current sample, used to skip unchanged reruns.
+        prefix (str): The sample ID the runners were set up for. Used to tag resource metrics.
+        peak_rss_mb (float): Largest peak RSS (MB) measured among the runners of the last run.
+        own_peak_rss_mb (float): Largest peak RSS (MB) among the runners of the last run that measure their own memory (see 'Runner.MEASURES_OWN_MEMORY').
+        MEMORY_GB (float): Declared memory footprint (GB) of one run, used for admission control until a footprint is learned.
     """
 
+    MANIFEST_SUFFIX = "manifest.json"
+    MEMORY_GB = 1.0
+
     def __init__(self, heading: str, config: stage_config.StageConfig):
         self.heading = heading
         self.config = config
         self.runners = []
         self.output = []
+        self.manifest = None
+        self.prefix = None
+        self.peak_rss_mb = 0.0
+        self.own_peak_rss_mb = 0.0
 
     def add_stage(self, prog_name: str, command: str, shell=False):
         """
@@ -43,6 +55,19 @@ class StageBuilder(ABC):
         rd_stage = subproces_runner.RedirectOutputRunner(prog_name, self.runners[stage], outfile_name, errfile_name, self.config)
         self.runners.append(rd_stage)
 
+    def add_stage_stream_to_file(self, prog_name: str, command: str | list[str], outfile_name: str, errfile_name: str, shell=False):
+        """
+        Adds a stage whose output is streamed to files while it runs, instead of being captured in memory.
+
+        :param prog_name: The name of the program to run.
+        :param command: The command to execute, or a list of commands to connect with pipes.
+        :param outfile_name: The name of the file to write the stdout to.
+        :param errfile_name: The name of the file to write the stderr to. May be the same as 'outfile_name'.
+        :param shell: Whether to execute the command through the shell.
+        """
+        stage = subproces_runner.StreamOutputRunner(prog_name, command, outfile_name, errfile_name, self.config, shell=shell)
+        self.runners.append(stage)
+
     def add_stage_function(self, prog_name: str, func):
         """
         Adds a stage that executes a function.
@@ -61,6 +86,80 @@ class StageBuilder(ABC):
     def check_savedir(self):
         os.makedirs(self.save_dir, exist_ok=True)
 
+    def get_tool_version(self) -> str:
+        """
+        Version of the tool running the stage, recorded in the manifest. Stages running external programs override this.
+        """
+        return manifest.get_tool_version()
+
+    def set_manifest(self, prefix: str, inputs: list[str], outputs: list[str]):
+        """
+        Record the current sample ID and declare its input and output files, so reruns with unchanged inputs and parameters can be skipped.
+
+        :param prefix: The sample ID.
+        :param inputs: Paths of the files the stage reads.
+        :param outputs: Paths of the files the stage writes.
+        """
+        self.prefix = prefix
+        self.manifest = manifest.StageManifest(
+            manifest_path=os.path.join(self.save_dir, f"{prefix}_{self.MANIFEST_SUFFIX}"),
+            stage=self.heading,
+            params=getattr(self, "params", ""),
+            get_tool_version=self.get_tool_version,
+            inputs=inputs,
+            outputs=outputs
+        )
+
+    def is_up_to_date(self) -> bool:
+        """
+        Check whether the outputs of the current sample were produced from the same inputs, parameters and tool version.
+
+        :returns: True if resuming is enabled and the stage can be skipped, False otherwise.
+        """
+        if not self.config.resume or self.config.dry or self.manifest is None:
+            return False
+        return self.manifest.is_up_to_date()
+
+    def run_if_changed(self) -> bool:
+        """
+        Run the stage unless it is up to date, and record the manifest after a successful run.
+
+        :returns: True if the stage was skipped or completed successfully, False otherwise.
+        """
+        if self.is_up_to_date():
+            self.config.logger.info(f"SKIP: {self.heading}. Inputs and parameters unchanged.")
+            self.runners = []
+            return True
+
+        if self.manifest is not None and not self.config.dry:
+            self.manifest.remove()
+        is_complete = self.run()
+        if is_complete and self.manifest is not None and not self.config.dry:
+            self.manifest.write()
+        return is_complete
+
+    def get_n_cpu(self) -> int:
+        """
+        Number of CPU cores the stage occupies while running. Used by the DAG scheduler.
+        """
+        return self.config.n_cpu
+
+    def get_memory(self) -> float:
+        """
+        Declared memory footprint (GB) of the stage. Used by the resource broker until a footprint is learned.
+        """
+        return self.MEMORY_GB
+
+    def get_peak_memory(self) -> float | None:
+        """
+        Peak memory (GB) measured during the last run, or None if nothing was measured.
+        Only runners measuring their own memory, i.e. subprocesses, count: the memory of in-process functions cannot be told apart
+        from the other tasks running at the same time, so stages doing all their work in-process keep their declared footprint.
+        """
+        if self.own_peak_rss_mb <= 0:
+            return None
+        return self.own_peak_rss_mb / 1024
+
     def summary(self) -> list[str]:
         """
         Provides a summary of the stages.
@@ -81,9 +180,21 @@ class StageBuilder(ABC):
         """
         self.config.logger.info(f"Running: {self.heading}")
         self.output = []
+        self.peak_rss_mb = 0.0
+        self.own_peak_rss_mb = 0.0
         for i, runner in enumerate(self.runners):
+            runner.tags = {"sample": self.prefix, "stage": self.heading}
             out = runner.run()
             self.output.append(out)
+            if runner.usage:
+                self.peak_rss_mb = max(self.peak_rss_mb, runner.usage["max_rss_mb"])
+                if runner.MEASURES_OWN_MEMORY:
+                    self.own_peak_rss_mb = max(self.own_peak_rss_mb, runner.usage["max_rss_mb"])
+        if self.manifest is not None:
+            # Inputs streamed through named pipes are only complete if their feeders delivered everything.
+            for error in stream_feeder.wait_feeders(self.manifest.inputs):
+                self.config.logger.error(f"FAIL: {self.heading}. {error}")
+                self.output.append(False)
         # self.config.logger.flush()
         self.runners = []
         return all(self.output)
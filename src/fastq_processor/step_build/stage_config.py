@@ -11,16 +11,25 @@ class StageConfig:
         logger (Logger): Logger object for logging messages.
         n_cpu (int): Number of CPU cores allocated for the stage.
         memory (int): Amount of memory (in GB) allocated for the stage.
+        resume (bool): Indicates if stages whose inputs and parameters are unchanged since the last run should be skipped.
+        metrics_path (str): JSON lines file to record the resource usage of every runner in. None disables recording.
+        programs (dict[str, str]): Executable to run for each external program ("usearch", "cutadapt", "blastn", "pigz"),
+            e.g. a full path or a stand-in from 'tool_simulator'. Programs not listed are looked up on the PATH by name.
     """
     def __init__(self,
         verbose: bool = False, dry: bool = False,
-        logger = sys.stdout, n_cpu: int = 1, memory: int = 8
+        logger = sys.stdout, n_cpu: int = 1, memory: int = 8,
+        resume: bool = False, metrics_path: str = None,
+        programs: dict[str, str] = None
         ):
         self.verbose = verbose
         self.dry = dry
         self.logger = logger
         self.n_cpu = n_cpu
         self.memory = memory
+        self.resume = resume
+        self.metrics_path = metrics_path
+        self.programs = programs or {}
 
     def get_machine_info(self) -> dict[str, int]:
         """
@@ -32,6 +41,31 @@ class StageConfig:
                 "memory": self.memory
                 }
 
+    def get_worker_config(self, n_workers: int) -> "StageConfig":
+        """
+        Creates a copy of this configuration whose CPU and memory budget is one share of 'n_workers' concurrent workers.
+
+        :param n_workers: Number of samples processed at the same time.
+        :returns: StageConfig: A configuration with 'n_cpu' and 'memory' divided across the workers (at least 1 each).
+        """
+        n_workers = max(1, n_workers)
+        return StageConfig(verbose=self.verbose, dry=self.dry, logger=self.logger,
+                           n_cpu=max(1, self.n_cpu // n_workers),
+                           memory=max(1, self.memory // n_workers),
+                           resume=self.resume,
+                           metrics_path=self.metrics_path,
+                           programs=self.programs
+                           )
+
+    def get_program(self, name: str) -> str:
+        """
+        Executable to run for an external program.
+
+        :param name: The name of the program, e.g. "usearch".
+        :returns: The executable mapped to it in 'programs', or the name itself.
+        """
+        return self.programs.get(name, name)
+
     def get_basic_configuration(self) -> dict:
         """
         Retrieves the basic configuration settings.
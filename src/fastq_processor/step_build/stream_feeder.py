@@ -0,0 +1,98 @@
+import os
+import threading
+
+# Feeders that have been started and not yet waited for, keyed by FIFO path.
+FEEDERS = {}
+FEEDERS_LOCK = threading.Lock()
+
+
+def is_supported() -> bool:
+    """
+    Named pipes are only available on POSIX systems.
+    """
+    return hasattr(os, "mkfifo")
+
+
+def make_fifo(fifo_path: str):
+    """
+    Create a named pipe, replacing any file or pipe left at the path by an earlier run.
+    """
+    if os.path.lexists(fifo_path):
+        os.remove(fifo_path)
+    os.mkfifo(fifo_path)
+
+
+class FifoFeeder(threading.Thread):
+    """
+    Background thread writing data into a named pipe. Opening the pipe blocks until the consuming program opens it for reading.
+
+    Attributes:
+        fifo_path (str): Path to the named pipe.
+        write (callable): Writes the data into the binary file handle it receives.
+        error (Exception): The exception raised while feeding, or None.
+    """
+    def __init__(self, fifo_path: str, write):
+        super().__init__(daemon=True)
+        self.fifo_path = fifo_path
+        self.write = write
+        self.error = None
+
+    def run(self):
+        try:
+            with open(self.fifo_path, "wb") as handle:
+                self.write(handle)
+        except Exception as e:
+            self.error = e
+
+    def release(self):
+        """
+        Unblock a feeder whose pipe was never opened by the consumer: briefly open the read end,
+        so the feeder's open returns and its next write fails with a broken pipe.
+        """
+        try:
+            fd = os.open(self.fifo_path, os.O_RDONLY | os.O_NONBLOCK)
+            os.close(fd)
+        except OSError:
+            pass
+
+
+def start_feeder(fifo_path: str, write) -> FifoFeeder:
+    """
+    Create a named pipe and start feeding it in the background.
+
+    :param fifo_path: Path to the named pipe.
+    :param write: Writes the data into the binary file handle it receives.
+    :returns: The started FifoFeeder.
+    """
+    make_fifo(fifo_path)
+    feeder = FifoFeeder(fifo_path, write)
+    with FEEDERS_LOCK:
+        FEEDERS[fifo_path] = feeder
+    feeder.start()
+    return feeder
+
+
+def wait_feeders(paths: list[str], poll_interval: float = 1.0) -> list[str]:
+    """
+    Wait for the feeders of the given paths after their consumer has exited. Paths without a feeder are ignored.
+
+    :param paths: Input paths of the consuming stage.
+    :returns: An error message for every feeder that did not deliver all of its data.
+    """
+    errors = []
+    for path in paths:
+        with FEEDERS_LOCK:
+            feeder = FEEDERS.pop(path, None)
+        if feeder is None:
+            continue
+        feeder.join(poll_interval)
+        if feeder.is_alive():
+            # The consumer has exited, so whatever the feeder still has to write is never read. Releasing it may even
+            # let a small remainder fit into the pipe buffer without an error, so the stream is failed here.
+            feeder.error = BrokenPipeError("the consumer exited before reading all of the stream")
+        while feeder.is_alive():
+            feeder.release()
+            feeder.join(poll_interval)
+        if feeder.error is not None:
+            errors.append(f"Streaming into {path} failed: {feeder.error}")
+    return errors
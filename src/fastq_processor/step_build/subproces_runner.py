@@ -1,8 +1,25 @@
+import contextlib
+import os
 import shlex
 import subprocess
 import sys
+import time
 
-from fastq_processor.step_build import runner
+from fastq_processor.step_build import (runner, resource_monitor)
+
+
+def split_command(command: str, shell: bool = False):
+    """
+    Split a command string into arguments, unless it is executed through the shell.
+
+    :param command: The command to split.
+    :param shell: Whether the command is executed through the shell.
+    :returns: The command string if 'shell' is True, otherwise a list of arguments.
+    """
+    if shell:
+        return command
+    args = shlex.split(command, posix="win" not in sys.platform)
+    return [arg.replace("\"", "") for arg in args]
 
 
 class SubprocessRunner(runner.Runner):
@@ -30,31 +47,32 @@ class SubprocessRunner(runner.Runner):
         if self.verbose:
             self.logger.info(self.message)
 
-        if self.shell:
-            args = self.command
-        else:
-            args = shlex.split(self.command, posix="win" not in sys.platform)
-            args = [arg.replace("\"", "") for arg in args]
+        args = split_command(self.command, self.shell)
 
         if not self.dry:
             try:
-                self.capture_output = subprocess.run(args,
-                                                   capture_output=False,
-                                                   shell=self.shell,
-                                                   check=True,
-                                                   text=True,
-                                                   stdout=subprocess.PIPE,
-                                                   stderr=subprocess.PIPE)
+                start_time = time.perf_counter()
+                process = subprocess.Popen(args,
+                                           shell=self.shell,
+                                           stdout=subprocess.PIPE,
+                                           stderr=subprocess.PIPE)
+                stdout, stderr, usage = resource_monitor.ProcessMonitor(process, start_time).communicate()
+                self.capture_output = subprocess.CompletedProcess(args, process.returncode,
+                                                                  stdout.decode(errors="replace"),
+                                                                  stderr.decode(errors="replace"))
+                self.capture_output.check_returncode()
+                self.record_usage(usage, True)
                 self.logger.info(f"COMPLETE: {self.prog_name}.")
                 return True
             except subprocess.CalledProcessError as e:
+                self.record_usage(usage, False)
                 self.logger.error(f"FAIL: {self.prog_name}. SubprocessError: {e.stderr}.")
                 return False
             except FileNotFoundError as e:
-                self.logger.error(f"FAIL: {self.prog_name}. FileNotFoundError: {e.stderr}.")
+                self.logger.error(f"FAIL: {self.prog_name}. FileNotFoundError: {e}.")
                 return False
             except Exception as e:
-                self.logger.error(f"FAIL: {self.prog_name}. Other Exception: {e.stderr}.")
+                self.logger.error(f"FAIL: {self.prog_name}. Other Exception: {e}.")
                 return False
 
 
@@ -102,3 +120,87 @@ class RedirectOutputRunner(runner.Runner):
             except AttributeError as e:
                 self.logger.error(f"FAIL: {self.prog_name}. Error: {e}.")
                 return False
+
+
+class StreamOutputRunner(runner.Runner):
+    """
+    Runner class for executing a command, or a pipeline of commands, with the output streamed straight to files.
+    The output is never held in memory or decoded, so memory use stays bounded however large the output is.
+
+    Attributes:
+        commands (list of str): The commands to execute. The stdout of each command is piped into the stdin of the next one.
+        command (str): The commands joined with " | ", for logging.
+        stdout_file (str): The file the stdout of the last command is written to.
+        stderr_file (str): The file the stderr of all commands is written to. May be the same file as 'stdout_file'.
+        shell (bool): Whether to execute the commands through the shell.
+    """
+    def __init__(self, prog_name: str, commands: str | list[str], stdout_file: str, stderr_file: str, config, shell: bool = False):
+        super().__init__(prog_name, config)
+
+        self.commands = [commands] if isinstance(commands, str) else list(commands)
+        self.command = " | ".join(self.commands)
+        self.stdout_file = stdout_file
+        self.stderr_file = stderr_file
+        self.shell = shell
+
+    def _start_processes(self, out_f, err_f) -> list[subprocess.Popen]:
+        """
+        Start every command, connecting the stdout of each one to the stdin of the next one.
+        If a command cannot be started, the ones already started are killed and reaped before the error is raised.
+        """
+        processes = []
+        stdin = None
+        try:
+            for i, command in enumerate(self.commands):
+                is_last = i == len(self.commands) - 1
+                process = subprocess.Popen(split_command(command, self.shell),
+                                           shell=self.shell,
+                                           stdin=stdin,
+                                           stdout=out_f if is_last else subprocess.PIPE,
+                                           stderr=err_f)
+                if stdin is not None:
+                    stdin.close()  # Only the child keeps the read end, so an upstream writer gets SIGPIPE if it exits.
+                stdin = process.stdout
+                processes.append(process)
+        except BaseException:
+            if stdin is not None:
+                stdin.close()
+            for process in processes:
+                process.kill()
+                process.wait()
+            raise
+        return processes
+
+    def run(self) -> bool:
+        """
+        Executes the commands with stdout and stderr streamed to the specified files.
+
+        :returns: True if all commands exit successfully, False otherwise.
+        """
+        if self.verbose:
+            self.logger.info(self.message)
+
+        if self.dry:
+            return True
+
+        same_file = os.path.abspath(self.stdout_file) == os.path.abspath(self.stderr_file)
+        try:
+            with contextlib.ExitStack() as stack:
+                out_f = stack.enter_context(open(self.stdout_file, "wb"))
+                err_f = out_f if same_file else stack.enter_context(open(self.stderr_file, "wb"))
+                start_time = time.perf_counter()
+                monitors = [resource_monitor.ProcessMonitor(process, start_time) for process in self._start_processes(out_f, err_f)]
+                results = [monitor.wait() for monitor in monitors]
+        except (OSError, subprocess.SubprocessError) as e:
+            self.logger.error(f"FAIL: {self.prog_name}. {type(e).__name__}: {e}.")
+            return False
+
+        return_codes = [return_code for return_code, _ in results]
+        usage = resource_monitor.combine_usage([usage for _, usage in results], time.perf_counter() - start_time)
+        if any(return_codes):
+            self.record_usage(usage, False)
+            self.logger.error(f"FAIL: {self.prog_name}. Exit status: {return_codes}. See: {self.stderr_file}.")
+            return False
+        self.record_usage(usage, True)
+        self.logger.info(f"COMPLETE: {self.prog_name}.")
+        return True
@@ -0,0 +1,82 @@
+import json
+import sqlite3
+
+# Number of hashes per SELECT, below SQLite's limit on host parameters.
+LOOKUP_CHUNK = 500
+
+
+class TaxonomyCache:
+    """
+    Persistent SQLite cache of annotated BLAST hits, keyed by sequence hash and a fingerprint of the database and parameters.
+    Sequences without hits are stored with an empty hit list, so they are not searched again either.
+    A new connection is opened for every operation, so the cache can be shared by threads and processes.
+
+    Attributes:
+        cache_path (str): Path to the SQLite file.
+        fingerprint (str): Digest of the BLAST database, parameters and lineage file the hits were produced with.
+        n_lookups (int): Number of sequences looked up so far.
+        n_hits (int): Number of looked-up sequences found in the cache.
+    """
+    def __init__(self, cache_path: str, fingerprint: str):
+        self.cache_path = cache_path
+        self.fingerprint = fingerprint
+        self.n_lookups = 0
+        self.n_hits = 0
+        connection = self._connect()
+        with connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS hits ("
+                "fingerprint TEXT NOT NULL, seq_hash TEXT NOT NULL, rows TEXT NOT NULL, "
+                "PRIMARY KEY (fingerprint, seq_hash))"
+            )
+        connection.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.cache_path, timeout=60)
+
+    def lookup(self, seq_hashes: list[str]) -> dict[str, list[list[str]]]:
+        """
+        Find the cached hits of sequences.
+
+        :param seq_hashes: Hashes of the sequences to look up.
+        :returns: A dictionary mapping each cached hash to its hit rows (an empty list for sequences without hits).
+        """
+        seq_hashes = list(dict.fromkeys(seq_hashes))
+        found = {}
+        connection = self._connect()
+        try:
+            for start in range(0, len(seq_hashes), LOOKUP_CHUNK):
+                chunk = seq_hashes[start:start + LOOKUP_CHUNK]
+                placeholders = ",".join("?" * len(chunk))
+                cursor = connection.execute(
+                    f"SELECT seq_hash, rows FROM hits WHERE fingerprint = ? AND seq_hash IN ({placeholders})",
+                    [self.fingerprint] + chunk
+                )
+                for seq_hash, rows in cursor:
+                    found[seq_hash] = json.loads(rows)
+        finally:
+            connection.close()
+
+        self.n_lookups += len(seq_hashes)
+        self.n_hits += len(found)
+        return found
+
+    def store(self, entries: dict[str, list[list[str]]]):
+        """
+        Save the hits of newly searched sequences.
+
+        :param entries: A dictionary mapping each sequence hash to its hit rows.
+        """
+        connection = self._connect()
+        with connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO hits (fingerprint, seq_hash, rows) VALUES (?, ?, ?)",
+                [(self.fingerprint, seq_hash, json.dumps(rows)) for seq_hash, rows in entries.items()]
+            )
+        connection.close()
+
+    @property
+    def hit_rate(self) -> float:
+        if self.n_lookups == 0:
+            return 0.0
+        return self.n_hits / self.n_lookups
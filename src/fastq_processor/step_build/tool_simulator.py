@@ -0,0 +1,345 @@
+"""
+Deterministic stand-ins for the external programs of the pipeline (usearch, cutadapt, blastn and pigz), for testing the
+scheduling, concurrency and caching of FastqProcessor at scale without the real tools.
+
+Every simulated tool accepts the command line the stages build, writes the output files and reports the stages read,
+in the formats of the real tool, and always gives the same output for the same input. The results are rough: reads are
+merged and trimmed on exact matches only, denoising merges substitution variants with the UNOISE abundance skew, and
+BLAST hits are picked by a hash of the query. On top of that, each run burns CPU time and holds memory in proportion to
+the size of its input, so it loads the machine like the real tool would.
+
+Use 'write_executables' to create the stand-ins and pass the mapping it returns to StageConfig(programs=...).
+This module only imports the standard library, so the stand-ins start quickly.
+"""
+import gzip
+import hashlib
+import os
+import shutil
+import stat
+import sys
+import time
+
+TOOLS = ("usearch", "cutadapt", "blastn", "pigz")
+VERSIONS = {
+    "usearch": "usearch v11.0.667_i86linux32 (simulated)",
+    "cutadapt": "4.4 (simulated)",
+    "blastn": "blastn: 2.14.0+ (simulated)",
+    "pigz": "pigz 2.7 (simulated)",
+}
+COMPLEMENT = str.maketrans("ACGTNacgtn", "TGCANtgcan")
+# Length of the end of R1 that is looked up in R2 to find the overlap of a pair.
+SEED_LEN = 16
+PAGE_SIZE = 4096
+
+
+def burn(input_bytes: int, cpu_s_per_mb: float, memory_mb_per_mb: float):
+    """
+    Hold 'memory_mb_per_mb' and burn 'cpu_s_per_mb' seconds of CPU time per MB of input.
+    The memory is written to, so it is resident, and the CPU time is measured with the process clock, so it does not
+    depend on how busy the machine is.
+    """
+    input_mb = input_bytes / (1 << 20)
+    memory = bytearray(int(input_mb * memory_mb_per_mb * (1 << 20)))
+    memory[::PAGE_SIZE] = b"\x01" * len(range(0, len(memory), PAGE_SIZE))
+    deadline = time.process_time() + input_mb * cpu_s_per_mb
+    digest = b""
+    while time.process_time() < deadline:
+        for _ in range(1000):
+            digest = hashlib.sha256(digest).digest()
+    del memory
+
+
+def get_arg(args: list[str], flag: str, default: str = None) -> str:
+    if flag in args and args.index(flag) + 1 < len(args):
+        return args[args.index(flag) + 1]
+    return default
+
+
+def get_size(paths: list[str]) -> int:
+    return sum(os.path.getsize(path) for path in paths if os.path.isfile(path))
+
+
+def stable_hash(text: str) -> int:
+    return int.from_bytes(hashlib.md5(text.encode()).digest()[:8], "big")
+
+
+def reverse_complement(seq: str) -> str:
+    return seq.translate(COMPLEMENT)[::-1]
+
+
+def read_fastq(path: str):
+    with open(path, "r") as handle:
+        while True:
+            lines = [handle.readline() for _ in range(4)]
+            if not lines[0]:
+                return
+            yield lines[0].rstrip()[1:], lines[1].rstrip(), lines[3].rstrip()
+
+
+def read_fasta(path: str):
+    label, seq = None, []
+    with open(path, "r") as handle:
+        for line in handle:
+            line = line.rstrip()
+            if line.startswith(">"):
+                if label is not None:
+                    yield label, "".join(seq)
+                label, seq = line[1:], []
+            elif line:
+                seq.append(line)
+    if label is not None:
+        yield label, "".join(seq)
+
+
+def get_size_annotation(label: str) -> int:
+    for field in label.split(";"):
+        if field.startswith("size="):
+            return int(field[5:])
+    return 1
+
+
+def merge_pair(seq1: str, qual1: str, seq2: str, qual2: str) -> tuple[str, str] | None:
+    """
+    Merge a read pair on the first exact occurrence of the last SEED_LEN bases of R1 in the reverse-complemented R2.
+    """
+    rc_seq2, rc_qual2 = reverse_complement(seq2), qual2[::-1]
+    pos = rc_seq2.find(seq1[-SEED_LEN:]) if len(seq1) >= SEED_LEN else -1
+    if pos < 0:
+        return None
+    overlap = pos + SEED_LEN
+    return seq1 + rc_seq2[overlap:], qual1 + rc_qual2[overlap:]
+
+
+def usearch_mergepairs(args: list[str]) -> list[str]:
+    r1_path = get_arg(args, "-fastq_mergepairs")
+    r2_path = get_arg(args, "-reverse", r1_path.replace("R1", "R2"))
+    n_pairs, n_merged = 0, 0
+    with open(get_arg(args, "-fastqout"), "w") as out:
+        for (title, seq1, qual1), (_, seq2, qual2) in zip(read_fastq(r1_path), read_fastq(r2_path)):
+            n_pairs += 1
+            merged = merge_pair(seq1, qual1, seq2, qual2)
+            if merged is not None:
+                n_merged += 1
+                out.write(f"@{title}\n{merged[0]}\n+\n{merged[1]}\n")
+    report = (
+        "Totals:\n"
+        f"{n_pairs:>10}  Pairs\n"
+        f"{n_merged:>10}  Merged ({100 * n_merged / max(n_pairs, 1):.1f}%)\n"
+        f"{n_pairs - n_merged:>10}  Not merged\n"
+    )
+    with open(get_arg(args, "-report", os.devnull), "w") as handle:
+        handle.write(report)
+    return [r1_path, r2_path]
+
+
+def usearch_uniques(args: list[str]) -> list[str]:
+    infile = get_arg(args, "-fastx_uniques")
+    counts = {}
+    for n, (label, seq) in enumerate(read_fasta(infile)):
+        entry = counts.setdefault(seq.upper(), [0, n, label.split()[0]])
+        entry[0] += 1
+    relabel = get_arg(args, "-relabel")
+    with open(get_arg(args, "-fastaout"), "w") as out:
+        for n, (seq, (count, _, label)) in enumerate(sorted(counts.items(), key=lambda item: (-item[1][0], item[1][1])), start=1):
+            header = f"{relabel}{n}" if relabel else label
+            if "-sizeout" in args:
+                header += f";size={count}"
+            out.write(f">{header}\n{seq}\n")
+    n_seqs = sum(entry[0] for entry in counts.values())
+    n_singletons = sum(entry[0] == 1 for entry in counts.values())
+    print(f"{n_seqs} seqs, {len(counts)} uniques, {n_singletons} singletons", file=sys.stderr)
+    return [infile]
+
+
+def usearch_unoise3(args: list[str]) -> list[str]:
+    """
+    Denoise like unoise3 without chimera detection: a unique sequence is noise of the most abundant amplicon of the same
+    length that it differs from by d <= 2 substitutions, if its abundance skew is at most 1 / 2^(alpha * d + 1).
+    """
+    infile = get_arg(args, "-unoise3")
+    minsize = int(get_arg(args, "-minsize", "8"))
+    alpha = float(get_arg(args, "-unoise_alpha", "2"))
+    amplicons, lines = [], []
+    for label, seq in read_fasta(infile):
+        name, size = label.split(";")[0], get_size_annotation(label)
+        if size < minsize:
+            continue
+        top = None
+        for amp_name, amp_size, amp_seq in amplicons:
+            if len(amp_seq) != len(seq):
+                continue
+            dist = sum(a != b for a, b in zip(amp_seq, seq))
+            if 0 < dist <= 2 and size / amp_size <= 1 / 2 ** (alpha * dist + 1):
+                top = amp_name
+                break
+        if top is None:
+            amplicons.append((name, size, seq))
+            lines.append(f"{name};size={size};\tdenoise\tamp{len(amplicons)}")
+        else:
+            lines.append(f"{name};size={size};\tdenoise\tnoise\ttop={top}")
+    lines += [f"{name};size={size};\tchfilter\tzotu" for name, size, _ in amplicons]
+    with open(get_arg(args, "-tabbedout", os.devnull), "w") as handle:
+        handle.write("".join(line + "\n" for line in lines))
+    with open(get_arg(args, "-zotus"), "w") as handle:
+        handle.writelines(f">Zotu{n}\n{seq}\n" for n, (_, _, seq) in enumerate(amplicons, start=1))
+    print(f"{len(amplicons)} amplicons, 0 chimeras, {len(amplicons)} zotus", file=sys.stderr)
+    return [infile]
+
+
+def simulate_usearch(args: list[str]) -> list[str]:
+    if "-fastq_mergepairs" in args:
+        return usearch_mergepairs(args)
+    if "-fastx_uniques" in args:
+        return usearch_uniques(args)
+    if "-unoise3" in args:
+        return usearch_unoise3(args)
+    raise ValueError(f"Unsupported usearch command: {' '.join(args)}")
+
+
+def simulate_cutadapt(args: list[str]) -> list[str]:
+    """
+    Trim linked primers ('-g FRONT...BACK', with optional ';' settings) on exact matches and write the trimmed reads to
+    stdout and the summary to stderr, like 'cutadapt --discard-untrimmed' without '-o'.
+    """
+    infile = args[0]
+    front, back = [primer.split(";")[0] for primer in get_arg(args, "-g").split("...")]
+    min_len = int(get_arg(args, "--minimum-length", "0"))
+    max_len = int(get_arg(args, "--maximum-length", str(sys.maxsize)))
+    counts = dict.fromkeys(["processed", "with_primers", "too_short", "too_long", "untrimmed", "written"], 0)
+    for title, seq, qual in read_fastq(infile):
+        counts["processed"] += 1
+        start, end = seq.find(front), seq.rfind(back)
+        if start < 0 or end < start + len(front):
+            counts["untrimmed"] += 1
+            continue
+        counts["with_primers"] += 1
+        start += len(front)
+        if end - start < min_len:
+            counts["too_short"] += 1
+        elif end - start > max_len:
+            counts["too_long"] += 1
+        else:
+            counts["written"] += 1
+            sys.stdout.write(f"@{title}\n{seq[start:end]}\n+\n{qual[start:end]}\n")
+    processed = max(counts["processed"], 1)
+    sys.stderr.write(
+        "=== Summary ===\n\n"
+        f"Total reads processed:           {counts['processed']:>15,}\n"
+        f"Reads with adapters:             {counts['with_primers']:>15,} ({100 * counts['with_primers'] / processed:.1f}%)\n\n"
+        "== Read fate breakdown ==\n"
+        f"Reads that were too short:       {counts['too_short']:>15,} ({100 * counts['too_short'] / processed:.1f}%)\n"
+        f"Reads that were too long:        {counts['too_long']:>15,} ({100 * counts['too_long'] / processed:.1f}%)\n"
+        f"Reads discarded as untrimmed:    {counts['untrimmed']:>15,} ({100 * counts['untrimmed'] / processed:.1f}%)\n"
+        f"Reads written (passing filters): {counts['written']:>15,} ({100 * counts['written'] / processed:.1f}%)\n"
+    )
+    return [infile]
+
+
+def get_subjects(db_path: str) -> list[str]:
+    """
+    Subject IDs of a simulated database: the labels of '[db_path].fasta' if it exists, else generic 'Genus_species' names.
+    """
+    if os.path.isfile(f"{db_path}.fasta"):
+        return [label.split()[0] for label, _ in read_fasta(f"{db_path}.fasta")]
+    return [f"sim|Simgenus{n // 4}_species{n % 4}" for n in range(100)]
+
+
+def simulate_blastn(args: list[str]) -> list[str]:
+    """
+    Write up to '-max_target_seqs' hits per query in the '-outfmt' columns: every subject is picked by a hash of the query
+    sequence, so the same sequence always gets the same hits, and the identity drops by one per hit.
+    """
+    query = get_arg(args, "-query")
+    db_path = get_arg(args, "-db", "")
+    outfmt = get_arg(args, "-outfmt", "6").split()
+    separator = "," if outfmt[0] == "10" else "\t"
+    specifiers = outfmt[1:] or "qseqid sseqid pident length mismatch gapopen qstart qend sstart send evalue bitscore".split()
+    max_hits = int(get_arg(args, "-max_target_seqs", "1"))
+    subjects = get_subjects(db_path)
+    with open(get_arg(args, "-out"), "w") as out:
+        for label, seq in read_fasta(query):
+            seq_hash = stable_hash(seq)
+            for n in range(min(max_hits, len(subjects))):
+                length = len(seq)
+                mismatch = (seq_hash >> (4 * n)) % 5 + n
+                values = {
+                    "qseqid": label.split()[0],
+                    "sseqid": subjects[(seq_hash + n) % len(subjects)],
+                    "sscinames": subjects[(seq_hash + n) % len(subjects)].split("|")[-1].replace("_", " "),
+                    "pident": f"{100 * (length - mismatch) / max(length, 1):.3f}",
+                    "length": length,
+                    "mismatch": mismatch,
+                    "gapopen": 0,
+                    "qstart": 1,
+                    "qend": length,
+                    "sstart": 1,
+                    "send": length,
+                    "evalue": f"{10.0 ** -(length // 4):.2e}",
+                    "bitscore": f"{1.8 * (length - 2 * mismatch):.1f}",
+                }
+                out.write(separator.join(str(values.get(specifier, 0)) for specifier in specifiers) + "\n")
+    return [query]
+
+
+def simulate_pigz(args: list[str]) -> list[str]:
+    infile = args[-1]
+    with gzip.open(infile, "rb") as handle:
+        shutil.copyfileobj(handle, sys.stdout.buffer, 1 << 20)
+    return [infile]
+
+
+SIMULATORS = {
+    "usearch": simulate_usearch,
+    "cutadapt": simulate_cutadapt,
+    "blastn": simulate_blastn,
+    "pigz": simulate_pigz,
+}
+
+
+def main(tool: str, args: list[str], cpu_s_per_mb: float = 0.0, memory_mb_per_mb: float = 0.0) -> int:
+    """
+    Run a simulated tool.
+
+    :param tool: One of TOOLS.
+    :param args: The command line arguments of the tool.
+    :param cpu_s_per_mb: CPU seconds burnt per MB of input.
+    :param memory_mb_per_mb: MB of memory held per MB of input.
+    :returns: The exit code: 0 on success, 1 on an error, which is printed to stderr as the real tools do.
+    """
+    if not args or args[0] in ("--version", "-version"):
+        print(VERSIONS[tool])
+        return 0
+    try:
+        inputs = SIMULATORS[tool](args)
+    except (OSError, ValueError, TypeError, AttributeError) as e:
+        print(f"---Fatal error--- {tool} (simulated): {e}", file=sys.stderr)
+        return 1
+    burn(get_size(inputs), cpu_s_per_mb, memory_mb_per_mb)
+    return 0
+
+
+def write_executables(bin_dir: str, cpu_s_per_mb: float = 0.0, memory_mb_per_mb: float = 0.0) -> dict[str, str]:
+    """
+    Write an executable stand-in for every tool into 'bin_dir'. Each runs this module with the current Python interpreter.
+
+    :param cpu_s_per_mb: CPU seconds every run burns per MB of input.
+    :param memory_mb_per_mb: MB of memory every run holds per MB of input.
+    :returns: The path of every stand-in, keyed by tool name, as expected by StageConfig(programs=...).
+    """
+    os.makedirs(bin_dir, exist_ok=True)
+    programs = {}
+    for tool in TOOLS:
+        path = os.path.join(bin_dir, tool)
+        with open(path, "w") as handle:
+            handle.write(
+                f"#!{sys.executable}\n"
+                "import importlib.util\n"
+                "import sys\n"
+                f"spec = importlib.util.spec_from_file_location('tool_simulator', {os.path.abspath(__file__)!r})\n"
+                "tool_simulator = importlib.util.module_from_spec(spec)\n"
+                "spec.loader.exec_module(tool_simulator)\n"
+                f"sys.exit(tool_simulator.main({tool!r}, sys.argv[1:], cpu_s_per_mb={cpu_s_per_mb!r}, memory_mb_per_mb={memory_mb_per_mb!r}))\n"
+            )
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+        programs[tool] = path
+    return programs
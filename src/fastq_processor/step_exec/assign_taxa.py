@@ -1,12 +1,36 @@
 import csv
-import numpy as np
+import functools
+import glob
+import hashlib
+import json
 import os
 import pandas as pd
 
-from fastq_processor.step_build import stage_builder
+from fastq_processor.step_build import (stage_builder, manifest, seq_io, taxonomy_cache)
+
+
+def hash_sequence(seq: str) -> str:
+    """
+    Key of a sequence shared by all samples and runs: the SHA-1 digest of its upper-case bases.
+    """
+    return hashlib.sha1(seq.upper().encode()).hexdigest()
+
+
+def write_hit_rows(rows: list[list[str]], csv_path: str):
+    with open(csv_path, "w", newline="") as handle:
+        csv.writer(handle, lineterminator="\n").writerows(rows)
 
 
 class AssignTaxaStage(stage_builder.StageBuilder):
+    """
+    Assign taxonomy to the ZOTUs of one sample with blastn.
+    With a taxonomy cache, only ZOTU sequences not searched before (with the same database and parameters) are sent to blastn.
+
+    Attributes:
+        cache (TaxonomyCache): Persistent cache of annotated hits. None disables caching.
+    """
+    MEMORY_GB = 2.0
+
 
     def __init__(self, config, heading="stage_blastn_assign_taxa.py", denoise_dir="", save_dir="",
                  db_path: str = "",
@@ -16,19 +40,27 @@ class AssignTaxaStage(stage_builder.StageBuilder):
                  qcov_hsp_perc: int = 90,
                  perc_identity: int = 90,
                  outfmt: str = "10",
-                 specifiers: str = "qseqid sseqid pident length mismatch gapopen qstart qend sstart send evalue bitscore"
+                 specifiers: str = "qseqid sseqid pident length mismatch gapopen qstart qend sstart send evalue bitscore",
+                 cache_path: str = ""
         ):
         super().__init__(heading=heading, config=config)
-        self.BLAST_PROG = "blastn"
+        self.BLAST_PROG = config.get_program("blastn")
         self.in_suffix = "denoise.fasta"
         self.out_suffix = "blast.csv"
         self.denoise_dir = denoise_dir
         self.save_dir = save_dir
         self.blast_outfile = None
         self.lineage_path = lineage_path
+        self.specifiers = specifiers
         self.parse_params(db_path, maxhitnum, evalue, qcov_hsp_perc, perc_identity, outfmt, specifiers)
         if os.path.isfile(lineage_path):
             self.parse_genus2otherlv(lineage_path)
+        self.cache = None
+        if cache_path:
+            if specifiers.split()[0] != "qseqid":
+                raise ValueError("The taxonomy cache needs 'qseqid' as the first BLAST specifier.")
+            fingerprint = self.get_fingerprint(db_path, maxhitnum, evalue, qcov_hsp_perc, perc_identity, outfmt, specifiers)
+            self.cache = taxonomy_cache.TaxonomyCache(cache_path, fingerprint)
 
     def parse_params(self, db_path, maxhitnum, evalue, qcov_hsp_perc, perc_identity, outfmt, specifiers):
         if db_path == "nt":
@@ -45,7 +77,13 @@ class AssignTaxaStage(stage_builder.StageBuilder):
             self.params += f" -num_threads {self.config.n_cpu}"
 
     def parse_genus2otherlv(self, lineage_path: str):
+        """
+        Read the lineage table into a genus -> [family, order, class, phylum, kingdom] dictionary,
+        plus family and order indices for hits only identified to those levels. The first genus of a family or order defines its lineage.
+        """
         self.genus2otherlv = {}
+        self.family2otherlv = {}
+        self.order2otherlv = {}
         with open(lineage_path) as in_handle:
             reader = csv.DictReader(in_handle)
             for row in reader:
@@ -58,12 +96,40 @@ class AssignTaxaStage(stage_builder.StageBuilder):
                     row['kingdom_name'],
                 ]
                 self.genus2otherlv[genus_name] = otherlv
+                self.family2otherlv.setdefault(otherlv[0], otherlv)
+                self.order2otherlv.setdefault(otherlv[1], otherlv[1:])
+
+    def get_tool_version(self):
+        return manifest.get_tool_version([self.BLAST_PROG, "-version"])
+
+    def get_fingerprint(self, db_path, maxhitnum, evalue, qcov_hsp_perc, perc_identity, outfmt, specifiers) -> str:
+        """
+        Digest of everything the annotated hits depend on: the database files (name, size, modification time),
+        the search parameters, the BLAST version and the lineage file. The number of threads is left out, since it does not change the hits.
+        """
+        db_files = sorted(glob.glob(f"{db_path}.*"))
+        record = {
+            "db_path": db_path,
+            "db_files": [[os.path.basename(path), os.path.getsize(path), os.path.getmtime(path)] for path in db_files],
+            "params": [maxhitnum, evalue, qcov_hsp_perc, perc_identity, outfmt, specifiers],
+            "tool_version": self.get_tool_version(),
+            "lineage": manifest.hash_file(self.lineage_path) if self.lineage_path else None,
+        }
+        return hashlib.sha256(json.dumps(record, sort_keys=True).encode()).hexdigest()
 
     def setup(self, prefix):
         self.infile = os.path.join(self.denoise_dir, f"{prefix}_{self.in_suffix}")
         self.blast_outfile = os.path.join(self.save_dir, f"{prefix}_{self.out_suffix}")
         self.check_infile()
         self.check_savedir()
+        inputs = [self.infile, self.lineage_path] if os.path.isfile(self.lineage_path) else [self.infile]
+        self.set_manifest(prefix, inputs=inputs, outputs=[self.blast_outfile])
+        if self.cache is not None:
+            query_file = os.path.join(self.save_dir, f"{prefix}_query.fasta")
+            hits_file = os.path.join(self.save_dir, f"{prefix}_query_{self.out_suffix}")
+            write_hits = functools.partial(write_hit_rows, csv_path=self.blast_outfile)
+            self.add_assignment_runners(list(seq_io.read_fasta(self.infile)), query_file, hits_file, write_hits)
+            return
         cmd = (
             f"{self.BLAST_PROG} -query {self.infile}"
             f" {self.params}"
@@ -71,39 +137,158 @@ class AssignTaxaStage(stage_builder.StageBuilder):
         )
         super().add_stage("Taxonomic assignment", cmd)
 
-    def add_taxonomy(self):
-        blast_result = pd.read_csv(self.blast_outfile, header=None)
-        taxa_matrix = []
-        for sseqid in blast_result[1]:
-            species = sseqid.split('|')[-1]
-            genus = species.split('_')[0]
-            if genus in self.genus2otherlv.keys():
-                taxonomy_levels = [species, genus] + self.genus2otherlv[genus]
-            elif genus.endswith("idae") or genus.endswith("inae"): # only identified to family level
-                for _, otherlv in self.genus2otherlv.items():
-                    if otherlv[0] == genus:
-                        taxonomy_levels = [species, ''] + otherlv
-                        break
-            elif genus.endswith("iformes") or genus.endswith("oidea"): # only identified to order level
-                for _, otherlv in self.genus2otherlv.items():
-                    if otherlv[1] == genus:
-                        taxonomy_levels = [species, '', ''] + otherlv[1:]
-                        break
+    def lookup_cache(self, queries: list[tuple[str, str]]) -> tuple[dict[str, list[list[str]]], list[tuple[str, str]]]:
+        """
+        Split queries into those with cached hits and those that have to be searched, and log the cache hit rate.
+
+        :param queries: (query ID, sequence) pairs.
+        :returns: A tuple of (cached hit rows keyed by query ID, the (query ID, sequence) pairs not in the cache).
+        """
+        if self.cache is None:
+            return {}, queries
+        seq_hashes = [hash_sequence(seq) for _, seq in queries]
+        found = self.cache.lookup(seq_hashes)
+        cached, missed = {}, []
+        for (query_id, seq), seq_hash in zip(queries, seq_hashes):
+            if seq_hash in found:
+                cached[query_id] = [[query_id] + row[1:] for row in found[seq_hash]]
             else:
-                print(f"genus {genus} not found in: {self.lineage_path}")
-            taxa_matrix.append(taxonomy_levels)
+                missed.append((query_id, seq))
+        n_unique = len(set(seq_hashes))
+        n_found = len(found)
+        self.config.logger.info(
+            f"Taxonomy cache: {n_found}/{n_unique} sequences found ({n_found / max(1, n_unique):.1%}), "
+            f"{self.cache.hit_rate:.1%} over this run."
+        )
+        return cached, missed
+
+    def add_assignment_runners(self, queries: list[tuple[str, str]], query_file: str, hits_file: str, write_hits):
+        """
+        Add the runners assigning taxonomy to arbitrary queries: write the queries missing from the cache,
+        BLAST them (skipped when every query is cached), then merge the annotated new hits with the cached ones.
+
+        :param queries: (query ID, sequence) pairs. Query IDs must be unique.
+        :param query_file: Path to the temporary query FASTA file.
+        :param hits_file: Path to the temporary BLAST result.
+        :param write_hits: Function receiving all annotated hit rows, in query order, with the query ID in the first column.
+        """
+        cached, missed = self.lookup_cache(queries)
+        first_step = len(self.runners)
+        if missed:
+            cmd = (
+                f"{self.BLAST_PROG} -query {query_file}"
+                f" {self.params}"
+                f" -out {hits_file}"
+            )
+            super().add_stage_function("Write queries", functools.partial(seq_io.write_fasta, missed, query_file))
+            super().add_stage("Taxonomic assignment", cmd)
+        query_ids = [query_id for query_id, _ in queries]
+        search_steps = range(first_step, len(self.runners))
+        super().add_stage_function("Merge hits", functools.partial(self.merge_hits, query_ids, cached, missed, query_file, hits_file, write_hits, search_steps))
+
+    def read_annotated(self, hits_file: str) -> pd.DataFrame | None:
+        """
+        Read a BLAST result as text, so the values are written back exactly as blastn wrote them, and add the taxonomy when a lineage file is given.
 
-        taxa_matrix_trans = np.array(taxa_matrix).T
-        for i, lv in enumerate(taxa_matrix_trans):
-            blast_result.insert(i+2, f"_{i}", lv)
+        :returns: The hits, or None if the result is empty.
+        """
+        try:
+            hits = pd.read_csv(hits_file, header=None, dtype=str, keep_default_na=False)
+        except pd.errors.EmptyDataError:
+            return None
+        if hasattr(self, 'genus2otherlv'):
+            hits = self.annotate_taxonomy(hits)
+        return hits
 
-        blast_result.to_csv(self.blast_outfile, index=False, header=None)
+    def read_hits(self, hits_file: str) -> dict[str, list[list[str]]]:
+        """
+        Read and annotate a BLAST result (see 'read_annotated'), and group the rows by query ID.
+        """
+        hits = self.read_annotated(hits_file)
+        if hits is None:
+            return {}
+        qseqid_col = self.specifiers.split().index("qseqid")
+        grouped = {}
+        for row in hits.values.tolist():
+            grouped.setdefault(row[qseqid_col], []).append(row)
+        return grouped
+
+    def merge_hits(self, query_ids: list[str], cached: dict, missed: list[tuple[str, str]],
+                   query_file: str, hits_file: str, write_hits, search_steps: range = range(0)):
+        """
+        Combine cached and new hits in query order, save the new ones (including queries without hits) to the cache,
+        and remove the temporary query and hit files.
+        If writing the queries or blastn failed, nothing is cached or written, since the hits of the missed queries may be incomplete.
+
+        :param search_steps: Positions in 'self.runners' of the runners writing and searching the missed queries.
+        """
+        if not all(self.output[step] for step in search_steps):
+            raise RuntimeError("The BLAST search did not complete. No hits were cached or written.")
+        new_hits = self.read_hits(hits_file) if missed else {}
+        if self.cache is not None and missed:
+            self.cache.store({hash_sequence(seq): [[""] + row[1:] for row in new_hits.get(query_id, [])] for query_id, seq in missed})
+
+        hits = cached | new_hits
+        write_hits([row for query_id in query_ids for row in hits.get(query_id, [])])
+
+        for path in (query_file, hits_file):
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def resolve_lineage(self, name: str) -> list[str] | None:
+        """
+        Find the [genus, family, order, class, phylum, kingdom] of a genus name, or of a family or order name
+        for hits only identified to those levels (the levels below are left empty).
+
+        :returns: The lineage, or None if the name is not in the lineage table.
+        """
+        if name in self.genus2otherlv:
+            return [name] + self.genus2otherlv[name]
+        if name.endswith(("idae", "inae")) and name in self.family2otherlv: # only identified to family level
+            return [''] + self.family2otherlv[name]
+        if name.endswith(("iformes", "oidea")) and name in self.order2otherlv: # only identified to order level
+            return ['', ''] + self.order2otherlv[name]
+        return None
+
+    def annotate_taxonomy(self, blast_result: pd.DataFrame) -> pd.DataFrame:
+        """
+        Insert the species, genus, family, order, class, phylum and kingdom of every hit after the 'sseqid' column.
+        Each distinct genus is resolved once and the lineages are joined to the hits column-wise.
+        Levels of names missing from the lineage table are left empty.
+
+        :param blast_result: BLAST hits, in the column order of the default specifiers.
+        :returns: The annotated hits.
+        """
+        species = blast_result[1].astype(str).str.split('|').str[-1]
+        genus = species.str.split('_').str[0]
+
+        lineages = {}
+        for name in genus.unique():
+            lineage = self.resolve_lineage(name)
+            if lineage is None:
+                print(f"genus {name} not found in: {self.lineage_path}")
+                lineage = [''] * 6
+            lineages[name] = lineage
+        lineage_table = pd.DataFrame.from_dict(lineages, orient="index", columns=range(6), dtype=str)
+        hit_lineages = lineage_table.reindex(genus.to_numpy())
+
+        blast_result.insert(2, "_0", species.to_numpy())
+        for i in range(6):
+            blast_result.insert(i+3, f"_{i+1}", hit_lineages[i].to_numpy())
+
+        return blast_result
+
+    def add_taxonomy(self):
+        # Written the same way as the hits merged with the cache, so the table does not depend on whether the cache is used.
+        blast_result = self.read_annotated(self.blast_outfile)
+        if blast_result is not None:
+            write_hit_rows(blast_result.values.tolist(), self.blast_outfile)
 
         return True
 
     def run(self):
         super().run()
-        if not self.config.dry and hasattr(self, 'genus2otherlv'):
+        if not self.config.dry and hasattr(self, 'genus2otherlv') and self.cache is None:
             self.output.append(self.add_taxonomy())
         return all(self.output)
 
@@ -0,0 +1,148 @@
+import functools
+import os
+
+from fastq_processor.step_build import (stage_builder, seq_io)
+from fastq_processor.step_exec import assign_taxa
+
+
+class BatchAssignTaxaStage(assign_taxa.AssignTaxaStage):
+    """
+    Assign taxonomy to the ZOTUs of many samples with a few large blastn runs, so the database is loaded once per batch
+    instead of once per sample. The queries of a batch are concatenated with sample-tagged IDs ('S{index}_{zotu}'),
+    and the hits are split back into the per-sample '_blast.csv' files with the original query IDs.
+
+    Attributes:
+        batch_size (int): Maximum number of samples per blastn run. 0 puts all samples into one run.
+        prefixes (list): Sample IDs of the current run. The tag index of a sample is its position in this list.
+        infiles (list): Denoised FASTA file of each sample.
+        blast_outfiles (list): Per-sample BLAST result file of each sample.
+    """
+    BATCH_NAME = "batch"
+
+    def __init__(self, config, heading="stage_blastn_assign_taxa_batch.py", denoise_dir="", save_dir="",
+                 batch_size: int = 0,
+                 **kwargs
+        ):
+        super().__init__(config, heading=heading, denoise_dir=denoise_dir, save_dir=save_dir, **kwargs)
+        if self.specifiers.split()[0] != "qseqid":
+            raise ValueError("Batched assignment needs 'qseqid' as the first BLAST specifier to split hits per sample.")
+        self.batch_size = batch_size
+        self.prefixes = []
+        self.infiles = []
+        self.blast_outfiles = []
+
+    def setup(self, prefixes: list[str]):
+        self.prefixes = list(prefixes)
+        self.infiles = [os.path.join(self.denoise_dir, f"{prefix}_{self.in_suffix}") for prefix in self.prefixes]
+        self.blast_outfiles = [os.path.join(self.save_dir, f"{prefix}_{self.out_suffix}") for prefix in self.prefixes]
+        for self.infile in self.infiles:
+            self.check_infile()
+        self.check_savedir()
+        inputs = self.infiles + [self.lineage_path] if os.path.isfile(self.lineage_path) else self.infiles
+        self.set_manifest(self.BATCH_NAME, inputs=inputs, outputs=self.blast_outfiles)
+        self.add_batch_runners()
+
+    def add_batch_runners(self):
+        """
+        Add the runners of every batch: concatenate the tagged queries, run blastn, split the hits per sample.
+        """
+        batch_size = self.batch_size if self.batch_size > 0 else max(1, len(self.prefixes))
+        for n, start in enumerate(range(0, len(self.prefixes), batch_size)):
+            sample_index = list(range(start, min(start + batch_size, len(self.prefixes))))
+            query_file = os.path.join(self.save_dir, f"{self.BATCH_NAME}{n}_query.fasta")
+            hits_file = os.path.join(self.save_dir, f"{self.BATCH_NAME}{n}_{self.out_suffix}")
+            queries = [
+                (f"S{i}_{zotu_id}", seq)
+                for i in sample_index
+                for zotu_id, seq in seq_io.read_fasta(self.infiles[i])
+            ]
+            self.add_assignment_runners(queries, query_file, hits_file, functools.partial(self.split_hits, sample_index))
+
+    def split_hits(self, sample_index: list[int], rows: list[list[str]]):
+        """
+        Split the annotated hits of one batch into the per-sample BLAST result files, restoring the original query IDs.
+        Samples without hits get an empty file, as blastn would write.
+
+        :param sample_index: Positions of the samples in 'prefixes'.
+        :param rows: Hit rows with the sample-tagged query ID in the first column.
+        """
+        sample_rows = {i: [] for i in sample_index}
+        for row in rows:
+            tag, zotu_id = row[0].split("_", 1)
+            sample_rows[int(tag[1:])].append([zotu_id] + row[1:])
+        for i in sample_index:
+            assign_taxa.write_hit_rows(sample_rows[i], self.blast_outfiles[i])
+
+    def run(self):
+        # Hits are annotated while they are merged, so the per-file annotation of AssignTaxaStage is bypassed.
+        return stage_builder.StageBuilder.run(self)
+
+
+class PoolAssignTaxaStage(BatchAssignTaxaStage):
+    """
+    Assign taxonomy to every distinct ZOTU sequence of all samples exactly once.
+    ZOTUs are keyed by the hash of their sequence, the unique sequences are sent to a single blastn run,
+    and the annotated hits are fanned out to every sample and ZOTU carrying that sequence.
+    BLAST work scales with the number of unique sequences instead of samples x ZOTUs.
+
+    Attributes:
+        sample_queries (list): For each sample, its (ZOTU ID, sequence hash) pairs in file order.
+    """
+    BATCH_NAME = "pool"
+
+    def __init__(self, config, heading="stage_blastn_assign_taxa_pool.py", denoise_dir="", save_dir="", **kwargs):
+        super().__init__(config, heading=heading, denoise_dir=denoise_dir, save_dir=save_dir, **kwargs)
+        self.sample_queries = []
+
+    def add_batch_runners(self):
+        query_file = os.path.join(self.save_dir, f"{self.BATCH_NAME}_query.fasta")
+        hits_file = os.path.join(self.save_dir, f"{self.BATCH_NAME}_{self.out_suffix}")
+        unique_seqs = self.pool_sequences()
+        self.add_assignment_runners(list(unique_seqs.items()), query_file, hits_file, self.fan_out_hits)
+
+    def pool_sequences(self) -> dict[str, str]:
+        """
+        Collect the ZOTUs of all samples and record which sequence each of them carries.
+
+        :returns: A dictionary mapping each sequence hash to its sequence, in order of first appearance.
+        """
+        unique_seqs = {}
+        self.sample_queries = []
+        for infile in self.infiles:
+            queries = []
+            for zotu_id, seq in seq_io.read_fasta(infile):
+                seq_hash = assign_taxa.hash_sequence(seq)
+                unique_seqs.setdefault(seq_hash, seq)
+                queries.append((zotu_id, seq_hash))
+            self.sample_queries.append(queries)
+
+        n_zotus = sum(len(queries) for queries in self.sample_queries)
+        self.config.logger.info(f"Pooled {n_zotus} ZOTUs of {len(self.infiles)} samples into {len(unique_seqs)} unique sequences.")
+        return unique_seqs
+
+    def fan_out_hits(self, rows: list[list[str]]):
+        """
+        Copy the annotated hits of every unique sequence to every sample and ZOTU carrying it, in the ZOTU order of each sample.
+
+        :param rows: Hit rows with the sequence hash in the first column.
+        """
+        hash_rows = {}
+        for row in rows:
+            hash_rows.setdefault(row[0], []).append(row[1:])
+        for queries, blast_outfile in zip(self.sample_queries, self.blast_outfiles):
+            sample_rows = [[zotu_id] + row for zotu_id, seq_hash in queries for row in hash_rows.get(seq_hash, [])]
+            assign_taxa.write_hit_rows(sample_rows, blast_outfile)
+
+
+def assign_taxa_batch_demo(config, prefixes, denoise_dir="", save_dir="", db_path="", lineage_path="", batch_size=0):
+    stage = BatchAssignTaxaStage(config, denoise_dir=denoise_dir, save_dir=save_dir, db_path=db_path, lineage_path=lineage_path, batch_size=batch_size)
+    stage.setup(prefixes)
+    is_complete = stage.run()
+    return is_complete
+
+
+def assign_taxa_pool_demo(config, prefixes, denoise_dir="", save_dir="", db_path="", lineage_path=""):
+    stage = PoolAssignTaxaStage(config, denoise_dir=denoise_dir, save_dir=save_dir, db_path=db_path, lineage_path=lineage_path)
+    stage.setup(prefixes)
+    is_complete = stage.run()
+    return is_complete
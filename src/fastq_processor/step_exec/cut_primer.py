@@ -1,23 +1,287 @@
+import functools
+import itertools
 import os
+from typing import override
 
-from fastq_processor.step_build import stage_builder
+from fastq_processor.step_build import (stage_builder, manifest, chunk_pool)
+
+BACKENDS = ("cutadapt", "native")
+# FASTQ records trimmed per chunk by one worker.
+CHUNK_READS = 20000
+# Minimum length of a partial primer match at the end of a read (cutadapt's default --overlap).
+MIN_OVERLAP = 3
+
+IUPAC = {
+    "A": "A", "C": "C", "G": "G", "T": "T", "U": "T",
+    "R": "AG", "Y": "CT", "S": "CG", "W": "AT", "K": "GT", "M": "AC",
+    "B": "CGT", "D": "AGT", "H": "ACT", "V": "ACG", "N": "ACGT",
+}
+
+
+class PrimerMatcher:
+    """
+    Find a primer in reads, allowing substitutions and indels up to an error rate, like a non-anchored cutadapt 5' adapter:
+    the primer may occur anywhere in the read, or partially at its start.
+    Full matches are located with an exact-seed prefilter: by the pigeonhole principle, a match with at most k errors
+    contains one of k + 1 disjoint pieces of the primer without error. Only the windows around seed hits are aligned,
+    with Myers' bit-parallel edit distance.
+
+    Attributes:
+        primer (bytes): The primer, upper-case. IUPAC wildcards in the primer match any of their bases.
+        max_errors (int): Maximum number of errors in a full match.
+        peq (dict): Bit mask of the primer positions matching each read base.
+        seeds (list): (piece, offset in the primer) of the seeds. Empty if the primer has wildcards, so every read is aligned in full.
+    """
+    def __init__(self, primer: str, error_rate: float):
+        primer = primer.upper()
+        self.primer = primer.encode()
+        self.error_rate = error_rate
+        self.max_errors = int(error_rate * len(primer))
+        self.peq = {}
+        for i, char in enumerate(primer):
+            for base in IUPAC.get(char, char):
+                for code in (ord(base), ord(base.lower())):
+                    self.peq[code] = self.peq.get(code, 0) | (1 << i)
+        self.seeds = []
+        if set(primer) <= set("ACGT"):
+            n_pieces = self.max_errors + 1
+            bounds = [len(primer) * i // n_pieces for i in range(n_pieces + 1)]
+            self.seeds = [(self.primer[start:end], start) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+    def align(self, text: bytes, offset: int = 0, pad: int = 0):
+        """
+        Myers' bit-parallel semi-global alignment of the primer against every end position of 'text'.
+
+        :param text: The read, or a window of it.
+        :param offset: Position of the window in the read, added to the end positions.
+        :param pad: Number of wildcard positions assumed before 'text', so the start of the primer may hang over the read.
+        :returns: Generator of (end position in the read, number of errors) for every position of 'text'.
+        """
+        m = len(self.primer)
+        full = (1 << m) - 1
+        high = 1 << (m - 1)
+        pv, mv, score = full, 0, m
+        for j, code in enumerate(itertools.chain(itertools.repeat(None, pad), text)):
+            eq = full if code is None else self.peq.get(code, 0)
+            xv = eq | mv
+            xh = (((eq & pv) + pv) ^ pv) | eq
+            ph = mv | (~(xh | pv) & full)
+            mh = pv & xh
+            if ph & high:
+                score += 1
+            elif mh & high:
+                score -= 1
+            ph = (ph << 1) & full
+            mh = (mh << 1) & full
+            pv = mh | (~(xv | ph) & full)
+            mv = ph & xv
+            if j >= pad:
+                yield offset + j - pad, score
+
+    def get_windows(self, seq: bytes) -> list[tuple[int, int]]:
+        """
+        Windows of the read that may contain a full match, from the hits of the seeds. Overlapping windows are merged.
+        """
+        if not self.seeds:
+            return [(0, len(seq))]
+        m, k = len(self.primer), self.max_errors
+        windows = []
+        for piece, piece_offset in self.seeds:
+            hit = seq.find(piece)
+            while hit != -1:
+                start = hit - piece_offset - k
+                windows.append((max(start, 0), min(start + m + 2 * k, len(seq))))
+                hit = seq.find(piece, hit + 1)
+        windows.sort()
+        merged = []
+        for start, end in windows:
+            if merged and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        return merged
+
+    def score_end(self, seq: bytes, end: int) -> int:
+        """
+        Best score of the primer aligned to the read up to 'end' (match +1, mismatch -1, indel -2), as cutadapt scores alignments.
+        """
+        m = len(self.primer)
+        text = seq[max(0, end - m - self.max_errors):end]
+        prev = [0] * (len(text) + 1)
+        for i in range(1, m + 1):
+            mask = 1 << (i - 1)
+            cur = [-2 * i]
+            for j, code in enumerate(text, start=1):
+                diagonal = prev[j - 1] + (1 if self.peq.get(code, 0) & mask else -1)
+                cur.append(max(diagonal, prev[j] - 2, cur[j - 1] - 2))
+            prev = cur
+        return prev[-1]
+
+    def find_end(self, seq: bytes) -> int | None:
+        """
+        Locate the primer in a read.
+
+        :param seq: The read.
+        :returns: The position after the end of the best match, or None if the primer was not found.
+            The best full match has the fewest errors; partial matches at the start are only used without a full match.
+        """
+        hit = seq.find(self.primer)
+        if hit != -1:
+            return hit + len(self.primer)
+
+        best_errors, best_ends = self.max_errors + 1, []
+        for start, end in self.get_windows(seq):
+            for pos, errors in self.align(seq[start:end], offset=start):
+                if errors < best_errors:
+                    best_errors, best_ends = errors, [pos]
+                elif errors == best_errors and pos not in best_ends:
+                    best_ends.append(pos)
+        if len(best_ends) > 1:
+            # Ends with as few errors are resolved like cutadapt: by the score of their alignment, then the leftmost one.
+            best_ends.sort(key=lambda pos: (-self.score_end(seq, pos + 1), pos))
+        if best_ends:
+            return best_ends[0] + 1
+
+        # Partial match: a suffix of the primer at the start of the read, with the error rate applied to the overlap length.
+        m = len(self.primer)
+        window = seq[:m - 1]
+        best_matches, best_end = 0, None
+        for pos, errors in self.align(window, pad=m):
+            overlap = pos + 1
+            if overlap >= MIN_OVERLAP and errors <= int(self.error_rate * overlap) and overlap - errors > best_matches:
+                best_matches, best_end = overlap - errors, overlap
+        return best_end
+
+
+class LinkedPrimerTrimmer:
+    """
+    Locate a linked primer pair like 'cutadapt -g [rm_p_5]...[rm_p_3]'.
+    Both primers are optional and not anchored: the read is cut after the 5' primer and before the 3' primer found after it.
+    Reads with neither primer are discarded.
+
+    Attributes:
+        front (PrimerMatcher): Matcher of the 5' primer.
+        back (PrimerMatcher): Matcher of the reversed 3' primer, applied to the reversed read.
+    """
+    def __init__(self, rm_p_5: str, rm_p_3: str, error_rate: float):
+        self.front = PrimerMatcher(rm_p_5, error_rate)
+        self.back = PrimerMatcher(rm_p_3[::-1], error_rate)
+
+    def trim(self, seq: bytes) -> tuple[int, int] | None:
+        """
+        :returns: The (start, end) of the read between the primers, or None if neither primer was found.
+        """
+        start = self.front.find_end(seq)
+        rest = seq[start or 0:]
+        back_end = self.back.find_end(rest[::-1])
+        if start is None and back_end is None:
+            return None
+        start = start or 0
+        return start, start + len(rest) - (back_end or 0)
+
+
+@functools.lru_cache(maxsize=4)
+def get_trimmer(rm_p_5: str, rm_p_3: str, error_rate: float) -> LinkedPrimerTrimmer:
+    """
+    The trimmer of a worker process, built once per primer pair.
+    """
+    return LinkedPrimerTrimmer(rm_p_5, rm_p_3, error_rate)
+
+
+def read_fastq_chunk(handle, n_reads: int = CHUNK_READS) -> list[bytes]:
+    """
+    Read the lines of the next FASTQ records from a file opened in binary mode. Empty at the end of the file.
+    """
+    lines = list(itertools.islice(handle, 4 * n_reads))
+    if len(lines) % 4 != 0:
+        raise ValueError("Input ends with an incomplete FASTQ record.")
+    return lines
+
+
+def trim_chunk(lines: list[bytes], rm_p_5: str, rm_p_3: str, error_rate: float, min_len: int, max_len: int) -> tuple[bytes, dict]:
+    """
+    Trim the primers of a chunk of FASTQ records and apply the length bounds, like 'cutadapt --discard-untrimmed'
+    with '--minimum-length' and '--maximum-length'. Reads with neither primer are discarded.
+
+    :returns: (FASTQ text of the reads kept, counts of the reads processed, with primers, too short, too long, untrimmed and written).
+    """
+    trimmer = get_trimmer(rm_p_5, rm_p_3, error_rate)
+    if not all(line.startswith(b"@") for line in lines[0::4]) or not all(line.startswith(b"+") for line in lines[2::4]):
+        raise ValueError("Input is not a FASTQ file with 4 lines per record.")
+    counts = dict.fromkeys(["processed", "with_primers", "too_short", "too_long", "untrimmed", "written"], 0)
+    out = []
+    for title, seq, qual in zip(lines[0::4], lines[1::4], lines[3::4]):
+        seq, qual = seq.rstrip(), qual.rstrip()
+        counts["processed"] += 1
+        trimmed = trimmer.trim(seq)
+        if trimmed is not None:
+            counts["with_primers"] += 1
+            start, end = trimmed
+        else:
+            start, end = 0, len(seq)
+        if end - start < min_len:
+            counts["too_short"] += 1
+        elif end - start > max_len:
+            counts["too_long"] += 1
+        elif trimmed is None:
+            counts["untrimmed"] += 1
+        else:
+            counts["written"] += 1
+            out.append(title.rstrip() + b"\n" + seq[start:end] + b"\n+\n" + qual[start:end] + b"\n")
+    return b"".join(out), counts
+
+
+def write_report(report_path: str, counts: dict):
+    """
+    Write the read counts in the words of the cutadapt summary.
+    """
+    processed = max(counts["processed"], 1)
+    with open(report_path, "w") as handle:
+        handle.write(
+            "=== Summary ===\n\n"
+            f"Total reads processed:           {counts['processed']:>15,}\n"
+            f"Reads with adapters:             {counts['with_primers']:>15,} ({100 * counts['with_primers'] / processed:.1f}%)\n\n"
+            "== Read fate breakdown ==\n"
+            f"Reads that were too short:       {counts['too_short']:>15,} ({100 * counts['too_short'] / processed:.1f}%)\n"
+            f"Reads that were too long:        {counts['too_long']:>15,} ({100 * counts['too_long'] / processed:.1f}%)\n"
+            f"Reads discarded as untrimmed:    {counts['untrimmed']:>15,} ({100 * counts['untrimmed'] / processed:.1f}%)\n"
+            f"Reads written (passing filters): {counts['written']:>15,} ({100 * counts['written'] / processed:.1f}%)\n"
+        )
 
 
 class CutPrimerStage(stage_builder.StageBuilder):
+    """
+    Trim the primers of the merged reads of a sample and keep the reads within the length bounds.
+
+    Attributes:
+        backend (str): "cutadapt" runs cutadapt. "native" trims chunks of reads in 'n_cpu' worker processes with a
+            LinkedPrimerTrimmer, with the same linked primers, error rate and length bounds.
+    """
     def __init__(self, config, heading="stage_cutadapt_cut_primer.py", merge_dir="", save_dir="",
                  rm_p_5="GTCGGTAAAACTCGTGCCAGC",
                  rm_p_3="CAAACTGGGATTAGATACCCCACTATG",
                  error_rate=0.15,
                  min_read_len=204,
                  max_read_len=254,
+                 backend: str = "cutadapt"
                  ):
         super().__init__(heading=heading, config=config)
-        self.CUTADAPT_PROG = "cutadapt"
+        if backend not in BACKENDS:
+            raise ValueError(f"Invalid primer trimming backend: {backend}. Must be one of {BACKENDS}.")
+        self.CUTADAPT_PROG = config.get_program("cutadapt")
         self.in_suffix = "merge.fastq"
         self.out_suffix = "cut.fastq"
         self.report_suffix = "report.txt"
         self.merge_dir = merge_dir
         self.save_dir = save_dir
+        self.backend = backend
+        self.trim_params = dict(
+            rm_p_5=rm_p_5,
+            rm_p_3=rm_p_3,
+            error_rate=error_rate,
+            min_len=min_read_len - len(rm_p_5) - len(rm_p_3),
+            max_len=max_read_len - len(rm_p_5) - len(rm_p_3)
+        )
         self.parse_params(rm_p_5, rm_p_3, min_read_len, max_read_len, error_rate)
 
     def parse_params(self, rm_p_5, rm_p_3, min_read_len, max_read_len, error_rate):
@@ -27,6 +291,30 @@ class CutPrimerStage(stage_builder.StageBuilder):
             f" --minimum-length {min_read_len - adapter_length}"
             f" --maximum-length {max_read_len - adapter_length}"
         )
+        if self.backend == "native":
+            self.params += " --backend native"
+
+    def get_tool_version(self):
+        if self.backend == "native":
+            return super().get_tool_version()
+        return manifest.get_tool_version([self.CUTADAPT_PROG, "--version"])
+
+    @override
+    def get_memory(self) -> float:
+        if self.backend == "native":
+            return 0.25 * (self.config.n_cpu + 1)
+        return self.MEMORY_GB
+
+    def cut_primer_native(self, outfile: str, report: str):
+        totals = {}
+        with open(self.infile, "rb") as in_handle, open(outfile, "wb") as out_handle:
+            chunks = iter(functools.partial(read_fastq_chunk, in_handle), [])
+            trim = functools.partial(trim_chunk, **self.trim_params)
+            for trimmed, counts in chunk_pool.map_chunks(trim, chunks, self.config.n_cpu):
+                out_handle.write(trimmed)
+                for key, count in counts.items():
+                    totals[key] = totals.get(key, 0) + count
+        write_report(report, totals or dict.fromkeys(["processed", "with_primers", "too_short", "too_long", "untrimmed", "written"], 0))
 
     def setup(self, prefix):
         self.infile = os.path.join(self.merge_dir, f"{prefix}_{self.in_suffix}")
@@ -34,21 +322,25 @@ class CutPrimerStage(stage_builder.StageBuilder):
         report = os.path.join(self.save_dir, f"{prefix}_{self.report_suffix}")
         self.check_infile()
         self.check_savedir()
+        self.set_manifest(prefix, inputs=[self.infile], outputs=[cutprimer_outfile, report])
+        if self.backend == "native":
+            super().add_stage_function("Cut primers for merged sequences",
+                                       functools.partial(self.cut_primer_native, cutprimer_outfile, report))
+            return
         cmd = (
             f"{self.CUTADAPT_PROG} {self.infile}"
             f" {self.params}"
             f" --discard-untrimmed -j {self.config.n_cpu}"
         )
-        super().add_stage("Cut primers for merged sequences", cmd)
-        super().add_stage_output_to_file("Write cutadapt output, report", 0, cutprimer_outfile, report)
+        super().add_stage_stream_to_file("Cut primers for merged sequences", cmd, cutprimer_outfile, report)
 
     def run(self):
         super().run()
         return all(self.output)
 
 
-def cutadapt_demo(config, prefix, merge_dir="", save_dir=""):
-    stage = CutPrimerStage(config, merge_dir=merge_dir, save_dir=save_dir)
+def cutadapt_demo(config, prefix, merge_dir="", save_dir="", backend="cutadapt"):
+    stage = CutPrimerStage(config, merge_dir=merge_dir, save_dir=save_dir, backend=backend)
     stage.setup(prefix)
     is_complete = stage.run()
     return is_complete
@@ -1,29 +1,118 @@
+from concurrent.futures import ThreadPoolExecutor
+import functools
 import os
 import gzip
+import shutil
+import subprocess
 from typing import override
 
-from fastq_processor.step_build import stage_builder
+from fastq_processor.step_build import (stage_builder, stream_feeder)
+
+try:
+    from isal import igzip
+except ImportError:  # python-isal is optional
+    igzip = None
+
+# Bytes copied per read/write call.
+COPY_BLOCK_SIZE = 4 << 20
+
+BACKENDS = ("auto", "isal", "pigz", "python")
 
 
 class DecompressStage(stage_builder.StageBuilder):
+    """
+    Decompress the R1 and R2 FASTQ.GZ files of a sample. Both files are decompressed at the same time in threads,
+    copying large blocks instead of lines.
+
+    In passthrough mode the outputs are named pipes instead: background threads decompress into them while the next stage
+    reads, so no uncompressed copy is written to disk. The consuming stage waits for the threads and fails if they did.
+
+    Attributes:
+        backend (str): Decompression engine: "isal" (python-isal), "pigz" (external program) or "python" (gzip module).
+            "auto" picks the first one available in that order.
+        passthrough (bool): Stream into named pipes instead of writing files. Falls back to files where named pipes are not supported.
+    """
     def __init__(self, config, heading="stage_gzip_decompress.py", fastq_dir="", save_dir="",
+                 backend: str = "auto",
+                 passthrough: bool = False
         ):
         super().__init__(heading=heading, config=config)
+        self.PIGZ_PROG = config.get_program("pigz")
         self.insuffix_list = ["R1.fastq.gz", "R2.fastq.gz"]
         self.outsuffix_list = ["R1.fastq", "R2.fastq"]
         self.infile_list = []
         self.outfile_list = []
         self.fastq_dir = fastq_dir
         self.save_dir = save_dir
+        self.backend = self.resolve_backend(backend)
+        self.passthrough = passthrough
+        if passthrough and not stream_feeder.is_supported():
+            self.config.logger.warning("WARNING: Named pipes are not supported on this system. Decompressing to files.")
+            self.passthrough = False
 
-    def gunzip(self):
+    def resolve_backend(self, backend: str) -> str:
+        """
+        Check that the requested backend is available, falling back to the gzip module otherwise.
+
+        :param backend: One of "auto", "isal", "pigz" or "python".
+        :returns: The backend that will be used.
+        """
+        if backend not in BACKENDS:
+            raise ValueError(f"Invalid decompression backend: {backend}. Must be one of {BACKENDS}.")
+        available = {
+            "isal": igzip is not None,
+            "pigz": shutil.which(self.PIGZ_PROG) is not None,
+            "python": True,
+        }
+        if backend == "auto":
+            return next(name for name, is_available in available.items() if is_available)
+        if not available[backend]:
+            self.config.logger.warning(f"WARNING: Decompression backend {backend} is not available. Using the gzip module.")
+            return "python"
+        return backend
+
+    def decompress_to(self, infile: str, out_handler):
+        """
+        Decompress one file with the selected backend into an open binary file handle.
+
+        :param infile: Path to the FASTQ.GZ file.
+        :param out_handler: Handle of the decompressed FASTQ file or named pipe.
+        """
+        if self.backend == "pigz":
+            subprocess.run([self.PIGZ_PROG, "-dc", infile], stdout=out_handler, stderr=subprocess.PIPE, check=True)
+            return
+        opener = igzip.open if self.backend == "isal" else gzip.open
+        with opener(infile, 'rb') as in_handler:
+            shutil.copyfileobj(in_handler, out_handler, COPY_BLOCK_SIZE)
+
+    def decompress_file(self, infile: str, outfile: str):
+        with open(outfile, 'wb') as out_handler:
+            self.decompress_to(infile, out_handler)
+
+    def start_feeders(self):
         for infile, outfile in zip(self.infile_list, self.outfile_list):
-            with gzip.open(infile, 'rb')as in_handler, open(outfile, 'wb') as out_handler:
-                for line in in_handler:
-                    out_handler.write(line)
+            stream_feeder.start_feeder(outfile, functools.partial(self.decompress_to, infile))
+
+    def gunzip(self):
+        # zlib, isal and pigz all run outside the GIL, so R1 and R2 are decompressed in parallel.
+        with ThreadPoolExecutor(max_workers=len(self.infile_list)) as executor:
+            futures = [
+                executor.submit(self.decompress_file, infile, outfile)
+                for infile, outfile in zip(self.infile_list, self.outfile_list)
+            ]
+            for future in futures:
+                future.result()
+
+    @override
+    def get_n_cpu(self) -> int:
+        if self.passthrough:  # the feeders only start working once the next stage reads
+            return 1
+        return min(len(self.insuffix_list), self.config.n_cpu)
 
     def setup(self, prefix):
         self.check_savedir()
+        self.infile_list = []
+        self.outfile_list = []
         for in_suffix in self.insuffix_list:
             self.infile = os.path.join(self.fastq_dir, f"{prefix}_{in_suffix}")
             self.check_infile()
@@ -32,15 +121,19 @@ class DecompressStage(stage_builder.StageBuilder):
         for out_suffix in self.outsuffix_list:
             self.outfile = os.path.join(self.save_dir, f"{prefix}_{out_suffix}")
             self.outfile_list.append(self.outfile)
-        super().add_stage_function("Decompress FASTQ.GZ to FASTQ", self.gunzip)
+        self.set_manifest(prefix, inputs=self.infile_list, outputs=self.outfile_list)
+        if self.passthrough:
+            super().add_stage_function("Stream FASTQ.GZ into named pipes", self.start_feeders)
+        else:
+            super().add_stage_function("Decompress FASTQ.GZ to FASTQ", self.gunzip)
 
     def run(self):
         super().run()
         return all(self.output)
 
 
-def decompress_demo(config, prefix, fastq_dir="", save_dir=""):
-    stage = DecompressStage(config, fastq_dir, save_dir)
+def decompress_demo(config, prefix, fastq_dir="", save_dir="", backend="auto"):
+    stage = DecompressStage(config, fastq_dir=fastq_dir, save_dir=save_dir, backend=backend)
     stage.setup(prefix)
     is_complete = stage.run()
     return is_complete
\ No newline at end of file
@@ -1,27 +1,251 @@
+from concurrent.futures import ThreadPoolExecutor
+import functools
 import os
+import re
+import shutil
+from typing import override
 
-from fastq_processor.step_build import stage_builder
+from fastq_processor.step_build import (stage_builder, manifest, seq_io, subproces_runner)
+
+PARTITION_MODES = ("abundance", "length")
+RE_SIZE = re.compile(r"size=(\d+)")
+RE_TOP = re.compile(r"top=([^;\s]+)")
+
+
+def parse_label(label: str) -> tuple[str, int]:
+    """
+    Split a usearch label like 'Uniq12;size=345;' into its name and size.
+    """
+    size = RE_SIZE.search(label)
+    return label.split(";")[0], int(size.group(1)) if size else 0
+
+
+def get_uniq_index(name: str) -> int:
+    """
+    Number of a unique sequence name like 'Uniq12'. Dereplication numbers sequences by decreasing abundance,
+    so this orders sequences of equal size as in the input.
+    """
+    return int(re.sub(r"\D", "", name) or 0)
+
+
+def read_tabbedout(report_path: str) -> tuple[dict, list]:
+    """
+    Read the -tabbedout report of 'usearch -unoise3'.
+
+    :param report_path: Path to the report.
+    :returns: (denoised, chfilter). 'denoised' maps every unique sequence name, in report order, to (size, top),
+        where top is None for amplicons and the name of the amplicon for noise. 'chfilter' is the list of
+        (name, size, "zotu" or "chimera") of the amplicons, in report order.
+    """
+    denoised, chfilter = {}, []
+    with open(report_path, "r") as handle:
+        for line in handle:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < 3:
+                continue
+            name, size = parse_label(fields[0])
+            if fields[1] == "denoise":
+                top = None if fields[2].startswith("amp") else RE_TOP.search(line).group(1)
+                denoised[name] = (size, top)
+            elif fields[1] == "chfilter":
+                chfilter.append((name, size, "zotu" if fields[2].startswith("zotu") else "chimera"))
+    return denoised, chfilter
+
+
+def partition_uniques(infile: str, part_prefix: str, budget: int, partition_by: str, minsize: int = 1) -> list[str]:
+    """
+    Split an abundance-sorted FASTA of unique sequences into partitions of at most 'budget' bytes.
+    Sequences below 'minsize' are dropped, as unoise3 would discard them. Every partition stays sorted by abundance.
+
+    :param infile: Path to the dereplicated FASTA with ';size=' labels.
+    :param part_prefix: Path prefix of the partition files.
+    :param budget: Maximum size (bytes) of a partition. A single sequence larger than this gets a partition of its own.
+    :param partition_by: "abundance" cuts the input into consecutive chunks. "length" groups sequences of similar lengths,
+        so length variants of the same amplicon stay together.
+    :returns: Paths of the partition files.
+    """
+    def read_records():
+        return ((label, seq) for label, seq in seq_io.read_fasta(infile) if parse_label(label)[1] >= minsize)
+
+    length2group = {}
+    if partition_by == "length":
+        length_bytes = {}
+        for label, seq in read_records():
+            length_bytes[len(seq)] = length_bytes.get(len(seq), 0) + len(label) + len(seq) + 3
+        group, group_bytes = 0, 0
+        for length in sorted(length_bytes):
+            if group_bytes and group_bytes + length_bytes[length] > budget:
+                group, group_bytes = group + 1, 0
+            length2group[length] = group
+            group_bytes += length_bytes[length]
+
+    part_files = []
+    writers = {}  # group -> [handle, bytes written]
+    try:
+        for label, seq in read_records():
+            record = f">{label}\n{seq}\n"
+            group = length2group.get(len(seq), 0)
+            writer = writers.get(group)
+            if writer is None or (writer[1] and writer[1] + len(record) > budget):
+                if writer is not None:
+                    writer[0].close()
+                part_files.append(f"{part_prefix}{len(part_files)}.fasta")
+                writer = writers[group] = [open(part_files[-1], "w"), 0]
+            writer[0].write(record)
+            writer[1] += len(record)
+    finally:
+        for handle, _ in writers.values():
+            handle.close()
+    return part_files
+
+
+def reconcile_reports(part_reports: list[str], reconcile_report: str, denoise_report: str):
+    """
+    Combine the reports of the partitions and of the reconciliation run over their ZOTUs into one -tabbedout report.
+    Noise is assigned to the amplicon its partition amplicon was merged into, so the result reads like a single unoise3 run.
+
+    :param part_reports: Paths to the -tabbedout reports of the partitions.
+    :param reconcile_report: Path to the -tabbedout report of the reconciliation run.
+    :param denoise_report: Path to write the combined report to.
+    """
+    reconciled, reconciled_chfilter = read_tabbedout(reconcile_report)
+    denoised, chimeras = {}, []
+    for part_report in part_reports:
+        part_denoised, part_chfilter = read_tabbedout(part_report)
+        denoised.update(part_denoised)
+        chimeras.extend(entry for entry in part_chfilter if entry[2] == "chimera")
+
+    def resolve(name):
+        top = reconciled.get(name, (0, None))[1]
+        return name if top is None else top
+
+    lines, n_amp = [], 0
+    for name, (size, top) in sorted(denoised.items(), key=lambda item: (-item[1][0], get_uniq_index(item[0]))):
+        top = resolve(name if top is None else top)
+        if top == name:
+            n_amp += 1
+            lines.append(f"{name};size={size};\tdenoise\tamp{n_amp}")
+        else:
+            lines.append(f"{name};size={size};\tdenoise\tnoise\ttop={top}")
+    for name, size, kind in reconciled_chfilter + chimeras:
+        lines.append(f"{name};size={size};\tchfilter\t{kind}")
+    with open(denoise_report, "w") as handle:
+        handle.write("\n".join(lines) + "\n")
 
 
 class DenoiseStage(stage_builder.StageBuilder):
+    """
+    Denoise the unique sequences of a sample with 'usearch -unoise3'.
+
+    In partitioned mode, inputs larger than 'partition_mb' are split into partitions that are denoised independently and
+    in parallel, each within the 4 GB of 32-bit usearch. The ZOTUs of all partitions are then denoised once more together,
+    which merges ZOTUs that are noise of one another across partitions and checks them for chimeras with all parents present.
+
+    Attributes:
+        partition_mb (float): Maximum size (MB) of a partition. 0 disables partitioning.
+        partition_by (str): "abundance" or "length". See 'partition_uniques'.
+    """
+    MEMORY_GB = 4.0  # 32-bit usearch is capped at 4 GB
+
     def __init__(self, config, heading="stage_usearch_denoise.py", derep_dir="", save_dir="",
                  minsize=8,
-                 alpha=2
+                 alpha=2,
+                 partition_mb: float = 0,
+                 partition_by: str = "abundance"
         ):
         super().__init__(heading=heading, config=config)
-        self.USEARCH_PROG = "usearch" # TODO(SW): Don't use `.exe`, doesn't make sense in docker/ubuntu
+        if partition_by not in PARTITION_MODES:
+            raise ValueError(f"Invalid partition_by: {partition_by}. Must be one of {PARTITION_MODES}.")
+        self.USEARCH_PROG = config.get_program("usearch") # TODO(SW): Don't use `.exe`, doesn't make sense in docker/ubuntu
         self.in_suffix = "uniq.fasta"
         self.out_suffix = "denoise.fasta"
         self.denoise_report_suffix = "denoise_report.txt"
         self.report_suffix = "report.txt"
         self.derep_dir = derep_dir
         self.save_dir = save_dir
+        self.minsize = minsize
+        self.alpha = alpha
+        self.partition_mb = partition_mb
+        self.partition_by = partition_by
+        self.part_files = []
         self.parse_params(minsize, alpha)
 
     def parse_params(self, minsize, alpha):
         self.params = (
             f"-minsize {minsize} -unoise_alpha {alpha}"
         )
+        if self.partition_mb > 0:
+            self.params += f" -partition_mb {self.partition_mb} -partition_by {self.partition_by}"
+
+    def get_tool_version(self):
+        return manifest.get_tool_version([self.USEARCH_PROG, "--version"])
+
+    def get_n_parallel(self) -> int:
+        """
+        Number of partitions denoised at the same time: one per CPU core, as far as the memory allows.
+        """
+        return max(1, min(self.config.n_cpu, int(self.config.memory // self.MEMORY_GB)))
+
+    @override
+    def get_memory(self) -> float:
+        if self.partition_mb > 0:
+            return self.MEMORY_GB * self.get_n_parallel()
+        return self.MEMORY_GB
+
+    def get_unoise_command(self, infile: str, zotus: str, tabbedout: str, n_threads: int) -> str:
+        return (
+            f"{self.USEARCH_PROG} -unoise3 {infile}"
+            f" -minsize {self.minsize} -unoise_alpha {self.alpha}"
+            f" -threads {n_threads}"
+            f" -zotus {zotus} -tabbedout {tabbedout}"
+        )
+
+    def partition(self, part_prefix: str):
+        self.part_files = partition_uniques(self.infile, part_prefix, int(self.partition_mb * (1 << 20)), self.partition_by, self.minsize)
+        self.config.logger.info(f"Split {self.infile} into {len(self.part_files)} partitions by {self.partition_by}.")
+
+    def denoise_partitions(self, candidates: str):
+        """
+        Denoise every partition, then write the ZOTUs of all partitions, with their sizes, into one FASTA sorted by abundance.
+        """
+        n_parallel = min(self.get_n_parallel(), len(self.part_files))
+        runners = []
+        for part_file in self.part_files:
+            part_prefix = part_file.removesuffix(".fasta")
+            cmd = self.get_unoise_command(part_file, f"{part_prefix}_zotus.fasta", f"{part_prefix}_denoise_report.txt",
+                                          max(1, self.config.n_cpu // n_parallel))
+            runner = subproces_runner.StreamOutputRunner(f"Denoise {os.path.basename(part_file)}", cmd,
+                                                         f"{part_prefix}_report.txt", f"{part_prefix}_report.txt", self.config)
+            runner.tags = {"sample": self.prefix, "stage": self.heading}
+            runners.append(runner)
+        with ThreadPoolExecutor(max_workers=n_parallel) as executor:
+            results = list(executor.map(lambda runner: runner.run(), runners))
+        if not all(results):
+            raise RuntimeError(f"{results.count(False)} of {len(results)} partitions failed.")
+
+        zotus = []
+        for part_file in self.part_files:
+            seqs = {parse_label(label)[0]: seq for label, seq in seq_io.read_fasta(part_file)}
+            _, chfilter = read_tabbedout(f"{part_file.removesuffix('.fasta')}_denoise_report.txt")
+            zotus.extend((size, name, seqs[name]) for name, size, kind in chfilter if kind == "zotu")
+        zotus.sort(key=lambda zotu: (-zotu[0], get_uniq_index(zotu[1])))
+        seq_io.write_fasta([(f"{name};size={size}", seq) for size, name, seq in zotus], candidates)
+
+    def merge_reports(self, reconcile_report: str, reconcile_log: str, denoise_report: str, report: str):
+        part_prefixes = [part_file.removesuffix(".fasta") for part_file in self.part_files]
+        reconcile_reports([f"{part_prefix}_denoise_report.txt" for part_prefix in part_prefixes], reconcile_report, denoise_report)
+        with open(report, "wb") as out_handle:
+            for log in [f"{part_prefix}_report.txt" for part_prefix in part_prefixes] + [reconcile_log]:
+                with open(log, "rb") as log_handle:
+                    shutil.copyfileobj(log_handle, out_handle)
+
+    def remove_partitions(self):
+        for part_file in self.part_files:
+            part_prefix = part_file.removesuffix(".fasta")
+            for path in [part_file, f"{part_prefix}_zotus.fasta", f"{part_prefix}_denoise_report.txt", f"{part_prefix}_report.txt"]:
+                if os.path.exists(path):
+                    os.remove(path)
+        self.part_files = []
 
     def setup(self, prefix):
         self.infile = os.path.join(self.derep_dir, f"{prefix}_{self.in_suffix}")
@@ -30,14 +254,32 @@ class DenoiseStage(stage_builder.StageBuilder):
         report = os.path.join(self.save_dir, f"{prefix}_{self.report_suffix}")
         self.check_infile()
         self.check_savedir()
-        cmd = (
-            f"{self.USEARCH_PROG} -unoise3 {self.infile}"
-            f" {self.params}"
-            f" -threads {self.config.n_cpu}"
-            f" -zotus {denoise_outfile} -tabbedout {denoise_report}"
-        )
-        super().add_stage("Denoise unique sequences", cmd)
-        super().add_stage_output_to_file("Write usearch report", 0, report, report)
+        self.set_manifest(prefix, inputs=[self.infile], outputs=[denoise_outfile, denoise_report, report])
+        if self.partition_mb > 0 and os.path.getsize(self.infile) > self.partition_mb * (1 << 20):
+            self.setup_partitioned(prefix, denoise_outfile, denoise_report, report)
+            return
+        cmd = self.get_unoise_command(self.infile, denoise_outfile, denoise_report, self.config.n_cpu)
+        super().add_stage_stream_to_file("Denoise unique sequences", cmd, report, report)
+
+    def setup_partitioned(self, prefix, denoise_outfile, denoise_report, report):
+        candidates = os.path.join(self.save_dir, f"{prefix}_candidates.fasta")
+        reconcile_report = os.path.join(self.save_dir, f"{prefix}_reconcile_denoise_report.txt")
+        reconcile_log = os.path.join(self.save_dir, f"{prefix}_reconcile_report.txt")
+        super().add_stage_function("Partition unique sequences",
+                                   functools.partial(self.partition, os.path.join(self.save_dir, f"{prefix}_part")))
+        super().add_stage_function("Denoise partitions", functools.partial(self.denoise_partitions, candidates))
+        cmd = self.get_unoise_command(candidates, denoise_outfile, reconcile_report, self.config.n_cpu)
+        super().add_stage_stream_to_file("Reconcile partition ZOTUs", cmd, reconcile_log, reconcile_log)
+        super().add_stage_function("Merge denoise reports",
+                                   functools.partial(self.merge_reports, reconcile_report, reconcile_log, denoise_report, report))
+        super().add_stage_function("Remove temporary files",
+                                   functools.partial(self.remove_files, [candidates, reconcile_report, reconcile_log]))
+
+    def remove_files(self, paths: list[str]):
+        self.remove_partitions()
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
 
     def run(self):
         super().run()
@@ -48,4 +290,4 @@ def fq_to_fa_demo(config, prefix, derep_dir="", save_dir=""):
     stage = DenoiseStage(config, derep_dir=derep_dir, save_dir=save_dir)
     stage.setup(prefix)
     is_complete = stage.run()
-    return is_complete
\ No newline at end of file
+    return is_complete
@@ -1,20 +1,222 @@
+import collections
+import functools
+import heapq
 import os
+from typing import override
 
-from fastq_processor.step_build import stage_builder
+from fastq_processor.step_build import (stage_builder, manifest, seq_io)
+
+BACKENDS = ("usearch", "native")
+# Estimated bytes taken by one unique sequence in the hash table, on top of its bases and label (dict slot, string and list objects).
+ENTRY_OVERHEAD = 200
+# Line width of the FASTA sequences, as written by usearch (default -fasta_cols).
+FASTA_COLS = 80
+
+
+def read_run(run_file: str):
+    """
+    Iterate over a sorted run written by Dereplicator.
+
+    :returns: Generator of the tab-separated fields of each line, with the count and first index as integers.
+    """
+    with open(run_file, "r") as handle:
+        for line in handle:
+            seq, count, first_index, label = line.rstrip("\n").split("\t")
+            yield seq, int(count), int(first_index), label
+
+
+def read_abundance_run(run_file: str):
+    for seq, count, first_index, label in read_run(run_file):
+        yield -count, first_index, seq, label
+
+
+def write_run(entries, run_file: str):
+    with open(run_file, "w") as handle:
+        handle.writelines(f"{seq}\t{count}\t{first_index}\t{label}\n" for seq, count, first_index, label in entries)
+
+
+class Dereplicator:
+    """
+    Count identical sequences in one streaming pass with bounded memory.
+    Sequences are counted in a hash table; whenever its estimated size exceeds the memory budget, it is written to disk
+    as a run sorted by sequence and cleared. The runs are merged at the end, summing the counts of identical sequences.
+
+    Attributes:
+        run_prefix (str): Path prefix of the temporary run files.
+        memory_budget (int): Bytes the hash table may take before it is spilled to disk.
+        counts (dict): Maps each sequence to [count, index of its first occurrence, label of its first occurrence].
+        table_size (int): Estimated bytes taken by 'counts'.
+        run_files (list[str]): Paths of the runs spilled so far.
+        n_seqs (int): Number of sequences added.
+    """
+    def __init__(self, run_prefix: str, memory_budget: int):
+        self.run_prefix = run_prefix
+        self.memory_budget = memory_budget
+        self.counts = {}
+        self.table_size = 0
+        self.run_files = []
+        self.n_seqs = 0
+
+    def add(self, seq: str, label: str):
+        seq = seq.upper()
+        entry = self.counts.get(seq)
+        if entry is None:
+            self.counts[seq] = [1, self.n_seqs, label]
+            self.table_size += ENTRY_OVERHEAD + len(seq) + len(label)
+            if self.table_size > self.memory_budget:
+                self.spill()
+        else:
+            entry[0] += 1
+        self.n_seqs += 1
+
+    def spill(self):
+        run_file = f"{self.run_prefix}.run{len(self.run_files)}"
+        write_run(((seq, *self.counts[seq]) for seq in sorted(self.counts)), run_file)
+        self.run_files.append(run_file)
+        self.counts = {}
+        self.table_size = 0
+
+    def iter_merged(self):
+        """
+        Merge the spilled runs, combining the entries of identical sequences.
+
+        :returns: Generator of (sequence, count, first index, label), sorted by sequence.
+        """
+        merged = None
+        for seq, count, first_index, label in heapq.merge(*(read_run(run_file) for run_file in self.run_files)):
+            if merged is not None and merged[0] == seq:
+                merged[1] += count
+                if first_index < merged[2]:
+                    merged[2:] = [first_index, label]
+                continue
+            if merged is not None:
+                yield tuple(merged)
+            merged = [seq, count, first_index, label]
+        if merged is not None:
+            yield tuple(merged)
+
+    def iter_uniques(self):
+        """
+        Iterate over the unique sequences by decreasing abundance; ties keep the order of first occurrence.
+        If runs were spilled, the merged entries are sorted externally as well.
+
+        :returns: Generator of (sequence, count, label).
+        """
+        if not self.run_files:
+            entries = sorted(self.counts.items(), key=lambda item: (-item[1][0], item[1][1]))
+            for seq, (count, _, label) in entries:
+                yield seq, count, label
+            return
+
+        if self.counts:
+            self.spill()
+        abundance_runs = []
+        chunk, chunk_size = [], 0
+        for entry in self.iter_merged():
+            chunk.append(entry)
+            chunk_size += ENTRY_OVERHEAD + len(entry[0]) + len(entry[3])
+            if chunk_size > self.memory_budget:
+                abundance_runs.append(self.write_abundance_run(chunk, len(abundance_runs)))
+                chunk, chunk_size = [], 0
+        if chunk:
+            abundance_runs.append(self.write_abundance_run(chunk, len(abundance_runs)))
+        for count, _, seq, label in heapq.merge(*(read_abundance_run(run_file) for run_file in abundance_runs)):
+            yield seq, -count, label
+
+    def write_abundance_run(self, entries: list, index: int) -> str:
+        run_file = f"{self.run_prefix}.sorted{index}"
+        write_run(sorted(entries, key=lambda entry: (-entry[1], entry[2])), run_file)
+        self.run_files.append(run_file)
+        return run_file
+
+    def write_fasta(self, fasta_path: str, seq_label: str = "Uniq", sizeout: bool = True) -> dict[int, int]:
+        """
+        Write the unique sequences like 'usearch -fastx_uniques -relabel [seq_label] -sizeout', most abundant first.
+
+        :param fasta_path: Path to the output FASTA file.
+        :param seq_label: Prefix of the new labels, numbered from 1. If empty, the label of the first occurrence is kept.
+        :param sizeout: Whether to append ';size=[count]' to the labels.
+        :returns: Histogram of the counts: the number of unique sequences seen each number of times.
+        """
+        size_counts = collections.Counter()
+        with open(fasta_path, "w") as handle:
+            for n, (seq, count, label) in enumerate(self.iter_uniques(), start=1):
+                header = f"{seq_label}{n}" if seq_label else label
+                if sizeout:
+                    header += f";size={count}"
+                handle.write(f">{header}\n")
+                handle.writelines(seq[i:i + FASTA_COLS] + "\n" for i in range(0, len(seq), FASTA_COLS))
+                size_counts[count] += 1
+        return dict(size_counts)
+
+    def cleanup(self):
+        for run_file in self.run_files:
+            if os.path.exists(run_file):
+                os.remove(run_file)
+        self.run_files = []
+        self.counts = {}
+        self.table_size = 0
+
+
+def format_report(size_counts: dict[int, int], n_spilled: int) -> list[str]:
+    """
+    Summarize the dereplication in the words of the usearch report.
+
+    :param size_counts: Number of unique sequences seen each number of times.
+    :param n_spilled: Number of sorted runs the hash table was spilled into.
+    :returns: The lines of the summary.
+    """
+    n_uniques = sum(size_counts.values())
+    n_seqs = sum(size * n for size, n in size_counts.items())
+    n_singletons = size_counts.get(1, 0)
+    lines = [f"{n_seqs} seqs, {n_uniques} uniques, {n_singletons} singletons ({100 * n_singletons / max(n_uniques, 1):.1f}%)"]
+    if n_uniques:
+        n_below, median = 0, 0
+        for median in sorted(size_counts):
+            n_below += size_counts[median]
+            if n_below > n_uniques // 2:
+                break
+        lines.append(f"Min size {min(size_counts)}, median {median}, max {max(size_counts)}, avg {n_seqs / n_uniques:.2f}")
+    if n_spilled:
+        lines.append(f"Hash table spilled to disk in {n_spilled} sorted runs")
+    return lines
+
+
+def write_report(report_path: str, size_counts: dict[int, int], n_spilled: int):
+    with open(report_path, "w") as handle:
+        handle.write("\n".join(format_report(size_counts, n_spilled)) + "\n")
 
 
 class DereplicateStage(stage_builder.StageBuilder):
+    """
+    Dereplicate the trimmed sequences of a sample.
+
+    Attributes:
+        backend (str): "usearch" runs 'usearch -fastx_uniques'. "native" counts the sequences in this process with a
+            Dereplicator, which has the same output but no 4 GB limit.
+        memory_mb (int): Memory budget (MB) of the native hash table. Larger samples are spilled to disk.
+    """
+    MEMORY_GB = 4.0  # 32-bit usearch is capped at 4 GB
+
     def __init__(self, config, heading="stage_usearch_dereplicate.py", fasta_dir="", save_dir="",
                  annot_size: bool = True,
-                 seq_label: str = "Uniq"
+                 seq_label: str = "Uniq",
+                 backend: str = "usearch",
+                 memory_mb: int = 1024
         ):
         super().__init__(heading=heading, config=config)
-        self.USEARCH_PROG = "usearch" # TODO(SW): Don't use `.exe`, doesn't make sense in docker/ubuntu
+        if backend not in BACKENDS:
+            raise ValueError(f"Invalid dereplication backend: {backend}. Must be one of {BACKENDS}.")
+        self.USEARCH_PROG = config.get_program("usearch") # TODO(SW): Don't use `.exe`, doesn't make sense in docker/ubuntu
         self.in_suffix = "cut.fasta"
         self.out_suffix = "uniq.fasta"
         self.report_suffix = "report.txt"
         self.fasta_dir = fasta_dir
         self.save_dir = save_dir
+        self.annot_size = annot_size
+        self.seq_label = seq_label
+        self.backend = backend
+        self.memory_mb = memory_mb
         self.parse_params(annot_size, seq_label)
 
     def parse_params(self, annot_size, seq_label):
@@ -22,6 +224,34 @@ class DereplicateStage(stage_builder.StageBuilder):
         self.params = (
             f"{sizeout} -relabel {seq_label}"
         )
+        if self.backend == "native":
+            self.params += f" -backend native -memory_mb {self.memory_mb}"
+
+    def get_tool_version(self):
+        if self.backend == "native":
+            return super().get_tool_version()
+        return manifest.get_tool_version([self.USEARCH_PROG, "--version"])
+
+    @override
+    def get_n_cpu(self) -> int:
+        return 1 if self.backend == "native" else self.config.n_cpu
+
+    @override
+    def get_memory(self) -> float:
+        if self.backend == "native":
+            return self.memory_mb / 1024 + 0.5
+        return self.MEMORY_GB
+
+    def dereplicate_native(self, outfile: str, report: str):
+        dereplicator = Dereplicator(run_prefix=outfile, memory_budget=self.memory_mb << 20)
+        try:
+            for label, seq in seq_io.read_fasta(self.infile):
+                dereplicator.add(seq, label)
+            n_spilled = len(dereplicator.run_files)
+            size_counts = dereplicator.write_fasta(outfile, seq_label=self.seq_label, sizeout=self.annot_size)
+        finally:
+            dereplicator.cleanup()
+        write_report(report, size_counts, n_spilled)
 
     def setup(self, prefix):
         self.infile = os.path.join(self.fasta_dir, f"{prefix}_{self.in_suffix}")
@@ -29,22 +259,26 @@ class DereplicateStage(stage_builder.StageBuilder):
         report = os.path.join(self.save_dir, f"{prefix}_{self.report_suffix}")
         self.check_infile()
         self.check_savedir()
+        self.set_manifest(prefix, inputs=[self.infile], outputs=[dereplicate_outfile, report])
+        if self.backend == "native":
+            super().add_stage_function("Dereplicate trimmed sequences",
+                                       functools.partial(self.dereplicate_native, dereplicate_outfile, report))
+            return
         cmd = (
             f"{self.USEARCH_PROG} -fastx_uniques {self.infile}"
             f" {self.params}"
             f" -threads {self.config.n_cpu}"
             f" -fastaout {dereplicate_outfile}"
         )
-        super().add_stage("Dereplicate trimmed sequences", cmd)
-        super().add_stage_output_to_file("Write usearch report", 0, report, report)
+        super().add_stage_stream_to_file("Dereplicate trimmed sequences", cmd, report, report)
 
     def run(self):
         super().run()
         return all(self.output)
 
 
-def dereplicate_demo(config, prefix, fasta_dir="", save_dir=""):
-    stage = DereplicateStage(config, fasta_dir=fasta_dir, save_dir=save_dir)
+def dereplicate_demo(config, prefix, fasta_dir="", save_dir="", backend="usearch"):
+    stage = DereplicateStage(config, fasta_dir=fasta_dir, save_dir=save_dir, backend=backend)
     stage.setup(prefix)
     is_complete = stage.run()
-    return is_complete
\ No newline at end of file
+    return is_complete
@@ -1,30 +1,169 @@
-from Bio import SeqIO
+from concurrent.futures import ProcessPoolExecutor
+import mmap
 import os
+import shutil
 from typing import override
 
 from fastq_processor.step_build import stage_builder
 
+# Bytes read per block by the serial converter.
+READ_BLOCK_SIZE = 16 << 20
+# Line width of the FASTA sequences, as written by Bio.SeqIO.
+FASTA_WRAP = 60
+# Inputs smaller than this are converted serially even when parallel conversion is enabled.
+MIN_PARALLEL_SIZE = 64 << 20
+
+
+def convert_lines(lines: list[bytes]) -> bytes:
+    """
+    Convert complete 4-line FASTQ records to FASTA without parsing the qualities.
+    The output is byte-identical to Bio.SeqIO: the header is the title line, and sequences are wrapped at 60 characters.
+
+    :param lines: FASTQ lines without line breaks; the length is a multiple of 4.
+    :returns: The FASTA text.
+    """
+    headers = lines[0::4]
+    seqs = lines[1::4]
+    if not all(header.startswith(b"@") for header in headers) or not all(plus.startswith(b"+") for plus in lines[2::4]):
+        raise ValueError("Input is not a FASTQ file with 4 lines per record.")
+
+    out = []
+    for header, seq in zip(headers, seqs):
+        seq = seq.rstrip()
+        out.append(b">" + header[1:].rstrip() + b"\n")
+        if len(seq) <= FASTA_WRAP:
+            if seq:
+                out.append(seq + b"\n")
+        else:
+            out.extend(seq[i:i + FASTA_WRAP] + b"\n" for i in range(0, len(seq), FASTA_WRAP))
+    return b"".join(out)
+
+
+def convert_stream(in_handle, out_handle, block_size: int = READ_BLOCK_SIZE):
+    """
+    Convert a FASTQ stream to FASTA in large blocks, carrying incomplete records over to the next block.
+    """
+    pending = b""
+    while block := in_handle.read(block_size):
+        lines = (pending + block).split(b"\n")
+        n_complete = (len(lines) - 1) // 4 * 4
+        out_handle.write(convert_lines(lines[:n_complete]))
+        pending = b"\n".join(lines[n_complete:])
+
+    lines = pending.split(b"\n")
+    if lines and lines[-1] == b"":
+        lines.pop()
+    if len(lines) % 4 != 0:
+        raise ValueError("Input ends with an incomplete FASTQ record.")
+    out_handle.write(convert_lines(lines))
+
+
+def find_record_start(data, offset: int) -> int:
+    """
+    Find the first FASTQ record starting at or after 'offset'. A record starts at a line beginning with '@'
+    that is followed two lines later by a '+' line; quality lines starting with '@' fail this test, since two lines
+    below them is a sequence line.
+
+    :param data: The whole file as bytes or mmap.
+    :param offset: Byte offset to search from.
+    :returns: The offset of the record, or len(data) if there is none.
+    """
+    if offset > 0:
+        offset = data.find(b"\n", offset - 1)
+        offset = len(data) if offset == -1 else offset + 1
+    while offset < len(data):
+        line_starts = [offset]
+        for _ in range(2):
+            next_line = data.find(b"\n", line_starts[-1])
+            if next_line == -1:
+                return len(data)
+            line_starts.append(next_line + 1)
+        if data[offset:offset + 1] == b"@" and data[line_starts[2]:line_starts[2] + 1] == b"+":
+            return offset
+        offset = line_starts[1]
+    return len(data)
+
+
+def convert_range(infile: str, start: int, end: int, part_file: str):
+    """
+    Worker of the parallel converter: convert the records between two record boundaries of a memory-mapped file.
+    """
+    with open(infile, "rb") as in_handle, open(part_file, "wb") as out_handle:
+        with mmap.mmap(in_handle.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            block_start = start
+            while block_start < end:
+                block_end = min(end, find_record_start(data, block_start + READ_BLOCK_SIZE))
+                lines = data[block_start:block_end].split(b"\n")
+                if lines and lines[-1] == b"":
+                    lines.pop()
+                if len(lines) % 4 != 0:
+                    raise ValueError("Input contains an incomplete FASTQ record.")
+                out_handle.write(convert_lines(lines))
+                block_start = block_end
+
 
 class FqToFaStage(stage_builder.StageBuilder):
+    """
+    Convert the primer-trimmed FASTQ of a sample to FASTA.
+
+    Attributes:
+        parallel (bool): Split large inputs at record boundaries and convert the chunks in 'n_cpu' worker processes.
+    """
     def __init__(self, config, heading="stage_fq_to_fa.py", cutprimer_dir="", save_dir="",
-                 overwrite=True
+                 overwrite=True,
+                 parallel: bool = False
         ):
         super().__init__(heading=heading, config=config)
         self.in_suffix = "cut.fastq"
         self.out_suffix = "cut.fasta"
         self.cutprimer_dir = cutprimer_dir
         self.save_dir = save_dir
+        self.parallel = parallel
 
     def fq_to_fa(self):
-        with open(self.infile, "r") as fq, open(self.outfile, "w") as fa:
-            for record in SeqIO.parse(fq, "fastq"):
-                SeqIO.write(record, fa, "fasta")
+        n_workers = self.get_n_cpu()
+        if n_workers > 1 and os.path.getsize(self.infile) >= MIN_PARALLEL_SIZE:
+            self.fq_to_fa_parallel(n_workers)
+            return
+        with open(self.infile, "rb") as fq, open(self.outfile, "wb") as fa:
+            convert_stream(fq, fa)
+
+    def fq_to_fa_parallel(self, n_workers: int):
+        """
+        Convert chunks of the input in worker processes, each into a part file, then concatenate the parts in order.
+        """
+        with open(self.infile, "rb") as in_handle, mmap.mmap(in_handle.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            chunk_size = len(data) // n_workers + 1
+            bounds = sorted({find_record_start(data, i * chunk_size) for i in range(n_workers)} | {len(data)})
+
+        part_files = [f"{self.outfile}.part{i}" for i in range(len(bounds) - 1)]
+        try:
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                futures = [
+                    executor.submit(convert_range, self.infile, start, end, part_file)
+                    for start, end, part_file in zip(bounds[:-1], bounds[1:], part_files)
+                ]
+                for future in futures:
+                    future.result()
+            with open(self.outfile, "wb") as fa:
+                for part_file in part_files:
+                    with open(part_file, "rb") as part:
+                        shutil.copyfileobj(part, fa, READ_BLOCK_SIZE)
+        finally:
+            for part_file in part_files:
+                if os.path.exists(part_file):
+                    os.remove(part_file)
+
+    @override
+    def get_n_cpu(self) -> int:
+        return self.config.n_cpu if self.parallel else 1
 
     def setup(self, prefix):
         self.infile = os.path.join(self.cutprimer_dir, f"{prefix}_{self.in_suffix}")
         self.outfile = os.path.join(self.save_dir, f"{prefix}_{self.out_suffix}")
         self.check_infile()
         self.check_savedir()
+        self.set_manifest(prefix, inputs=[self.infile], outputs=[self.outfile])
         super().add_stage_function("Convert FASTQ to FASTA", self.fq_to_fa)
 
     def run(self):
@@ -32,8 +171,8 @@ class FqToFaStage(stage_builder.StageBuilder):
         return all(self.output)
 
 
-def fq_to_fa_demo(config, prefix, cutprimer_dir="", save_dir=""):
-    stage = FqToFaStage(config, cutprimer_dir=cutprimer_dir, save_dir=save_dir)
+def fq_to_fa_demo(config, prefix, cutprimer_dir="", save_dir="", parallel=False):
+    stage = FqToFaStage(config, cutprimer_dir=cutprimer_dir, save_dir=save_dir, parallel=parallel)
     stage.setup(prefix)
     is_complete = stage.run()
-    return is_complete
\ No newline at end of file
+    return is_complete
@@ -1,20 +1,191 @@
+import functools
+import itertools
 import os
+import re
+from typing import override
 
-from fastq_processor.step_build import stage_builder
+import numpy as np
+
+from fastq_processor.step_build import (stage_builder, manifest, chunk_pool)
+
+BACKENDS = ("usearch", "native")
+# Read pairs merged per chunk by one worker.
+CHUNK_PAIRS = 4096
+# Defaults of usearch -fastq_mergepairs: minimum overlap, and reads are truncated at the first base with Q <= 2.
+MIN_OVERLAP = 16
+TRUNC_TAIL_Q = 2
+PHRED_OFFSET = 33
+# Score of an overlap: its length minus this penalty per mismatch. The best scoring overlap is kept.
+MISMATCH_PENALTY = 3
+
+COMPLEMENT = bytes.maketrans(b"ACGTNacgtn", b"TGCANtgcan")
+RE_LOW_QUALITY = re.compile(b"[" + re.escape(bytes(range(PHRED_OFFSET, PHRED_OFFSET + TRUNC_TAIL_Q + 1))) + b"]")
+
+
+def read_pair_chunk(r1_handle, r2_handle, n_pairs: int = CHUNK_PAIRS) -> list[tuple[bytes, bytes, bytes, bytes, bytes]]:
+    """
+    Read the next read pairs from two FASTQ files opened in binary mode.
+
+    :returns: List of (R1 title, R1 sequence, R1 quality, R2 sequence, R2 quality). Empty at the end of the files.
+    """
+    lines1 = list(itertools.islice(r1_handle, 4 * n_pairs))
+    lines2 = list(itertools.islice(r2_handle, 4 * n_pairs))
+    if len(lines1) != len(lines2) or len(lines1) % 4 != 0:
+        raise ValueError("R1 and R2 do not contain the same number of complete FASTQ records.")
+    if not all(line.startswith(b"@") for line in lines1[0::4] + lines2[0::4]) \
+            or not all(line.startswith(b"+") for line in lines1[2::4] + lines2[2::4]):
+        raise ValueError("Input is not a FASTQ file with 4 lines per record.")
+    lines1 = [line.rstrip() for line in lines1]
+    lines2 = [line.rstrip() for line in lines2]
+    return list(zip([title[1:] for title in lines1[0::4]], lines1[1::4], lines1[3::4], lines2[1::4], lines2[3::4]))
+
+
+def truncate_tail(seq: bytes, qual: bytes) -> tuple[bytes, bytes]:
+    """
+    Truncate a read at its first base with quality TRUNC_TAIL_Q or lower.
+    """
+    low = RE_LOW_QUALITY.search(qual)
+    if low is None:
+        return seq, qual
+    return seq[:low.start()], qual[:low.start()]
+
+
+def to_matrix(reads: list[bytes], width: int, right_align: bool = False, reverse: bool = False) -> np.ndarray:
+    """
+    Encode reads into one zero-padded uint8 matrix, one read per row, without a Python loop over the reads.
+
+    :param reads: The reads, as bytes.
+    :param width: Number of columns; at least the length of the longest read.
+    :param right_align: Align the reads to the last column instead of the first.
+    :param reverse: Write every read reversed.
+    """
+    lengths = np.fromiter(map(len, reads), dtype=np.int64, count=len(reads))
+    flat = np.frombuffer(b"".join(reads), dtype=np.uint8)
+    rows = np.repeat(np.arange(len(reads)), lengths)
+    pos = np.arange(len(flat)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    if reverse:
+        pos = np.repeat(lengths, lengths) - 1 - pos
+    if right_align:
+        pos += np.repeat(width - lengths, lengths)
+    matrix = np.zeros((len(reads), width), dtype=np.uint8)
+    matrix[rows, pos] = flat
+    return matrix
+
+
+def find_overlaps(r1: np.ndarray, r2: np.ndarray, len1: np.ndarray, len2: np.ndarray, maxdiff: int, pctid: float) -> np.ndarray:
+    """
+    Find the best overlap of every pair: the end of R1 against the start of the reverse-complemented R2.
+    All pairs are scored at once for each overlap length. Staggered overlaps, where R2 extends past the start of R1, are not considered.
+
+    :param r1: R1 reads, right-aligned (see 'to_matrix').
+    :param r2: Reverse-complemented R2 reads, left-aligned.
+    :param len1: Lengths of the R1 reads.
+    :param len2: Lengths of the R2 reads.
+    :param maxdiff: Maximum number of mismatches in the overlap.
+    :param pctid: Minimum identity (%) of the overlap.
+    :returns: The overlap length of every pair, 0 for pairs that cannot be merged.
+    """
+    width = r1.shape[1]
+    best_overlap = np.zeros(len(r1), dtype=np.int64)
+    best_score = np.full(len(r1), -1, dtype=np.int64)
+    max_overlap = int(np.minimum(len1, len2).max(initial=0))
+    for overlap in range(MIN_OVERLAP, max_overlap + 1):
+        diffs = np.count_nonzero(r1[:, width - overlap:] != r2[:, :overlap], axis=1)
+        score = overlap - MISMATCH_PENALTY * diffs
+        is_better = (
+            (len1 >= overlap) & (len2 >= overlap)
+            & (diffs <= maxdiff) & ((overlap - diffs) * 100 >= pctid * overlap)
+            & (score > best_score)
+        )
+        best_overlap[is_better] = overlap
+        best_score[is_better] = score[is_better]
+    return best_overlap
+
+
+def merge_chunk(pairs: list[tuple[bytes, bytes, bytes, bytes, bytes]], maxdiff: int = 5, pctid: float = 90) -> tuple[bytes, int, int]:
+    """
+    Merge a chunk of read pairs like 'usearch -fastq_mergepairs'. In the overlap, the base with the higher quality is kept.
+    Agreeing bases keep the higher quality, disagreeing bases get the difference of the qualities (at least Q2).
+
+    :param pairs: Read pairs from 'read_pair_chunk'.
+    :param maxdiff: Maximum number of mismatches in the overlap.
+    :param pctid: Minimum identity (%) of the overlap.
+    :returns: (FASTQ text of the merged reads, number of pairs, number of merged pairs).
+    """
+    if not pairs:
+        return b"", 0, 0
+    titles = [pair[0] for pair in pairs]
+    seqs1, quals1 = zip(*(truncate_tail(seq, qual) for _, seq, qual, _, _ in pairs))
+    seqs2, quals2 = zip(*(truncate_tail(seq, qual) for _, _, _, seq, qual in pairs))
+    rc_seqs2 = [seq.translate(COMPLEMENT)[::-1] for seq in seqs2]
+    len1 = np.fromiter(map(len, seqs1), dtype=np.int64, count=len(pairs))
+    len2 = np.fromiter(map(len, seqs2), dtype=np.int64, count=len(pairs))
+    width1, width2 = max(int(len1.max()), 1), max(int(len2.max()), 1)
+
+    r1 = to_matrix(seqs1, width1, right_align=True)
+    r2 = to_matrix(rc_seqs2, width2)
+    overlaps = find_overlaps(r1, r2, len1, len2, maxdiff, pctid)
+
+    # Gather the overlapping columns of both reads into aligned matrices and build the consensus of all pairs at once.
+    span = min(width1, width2)
+    cols1 = np.clip(width1 - overlaps[:, None] + np.arange(span), 0, width1 - 1)
+    base1 = np.take_along_axis(r1, cols1, axis=1)
+    qual1 = np.take_along_axis(to_matrix(quals1, width1, right_align=True), cols1, axis=1).astype(np.int16)
+    base2 = r2[:, :span]
+    qual2 = to_matrix(quals2, width2, reverse=True)[:, :span].astype(np.int16)
+    consensus = np.where(qual2 > qual1, base2, base1)
+    consensus_qual = np.where(
+        base1 == base2,
+        np.maximum(qual1, qual2),
+        np.maximum(np.abs(qual1 - qual2) + PHRED_OFFSET, PHRED_OFFSET + TRUNC_TAIL_Q)
+    ).astype(np.uint8)
+
+    out = []
+    for i in np.flatnonzero(overlaps):
+        overlap = int(overlaps[i])
+        seq = seqs1[i][:len1[i] - overlap] + consensus[i, :overlap].tobytes() + rc_seqs2[i][overlap:]
+        qual = quals1[i][:len1[i] - overlap] + consensus_qual[i, :overlap].tobytes() + quals2[i][::-1][overlap:]
+        out.append(b"@" + titles[i] + b"\n" + seq + b"\n+\n" + qual + b"\n")
+    return b"".join(out), len(pairs), len(out)
+
+
+def write_report(report_path: str, n_pairs: int, n_merged: int):
+    with open(report_path, "w") as handle:
+        handle.write(
+            "Totals:\n"
+            f"{n_pairs:>10}  Pairs\n"
+            f"{n_merged:>10}  Merged ({100 * n_merged / max(n_pairs, 1):.1f}%)\n"
+            f"{n_pairs - n_merged:>10}  Not merged\n"
+        )
 
 
 class MergeStage(stage_builder.StageBuilder):
+    """
+    Merge the paired-end reads of a sample.
+
+    Attributes:
+        backend (str): "usearch" runs 'usearch -fastq_mergepairs'. "native" merges chunks of read pairs with NumPy
+            in 'n_cpu' worker processes, with the same 'maxdiff' and 'pctid' and no 4 GB limit.
+    """
+    MEMORY_GB = 4.0  # 32-bit usearch is capped at 4 GB
+
     def __init__(self, config, heading="stage_usearch_merge.py", decompress_dir="", save_dir="",
                  maxdiff=5,
-                 pctid=90
+                 pctid=90,
+                 backend: str = "usearch"
         ):
         super().__init__(heading=heading, config=config)
-        self.USEARCH_PROG = "usearch" # TODO(SW): Don't use `.exe`, doesn't make sense in docker/ubuntu
+        if backend not in BACKENDS:
+            raise ValueError(f"Invalid merge backend: {backend}. Must be one of {BACKENDS}.")
+        self.USEARCH_PROG = config.get_program("usearch") # TODO(SW): Don't use `.exe`, doesn't make sense in docker/ubuntu
         self.in_suffix = "R1.fastq"
         self.out_suffix = "merge.fastq"
         self.report_suffix = "report.txt"
         self.decompress_dir = decompress_dir
         self.save_dir = save_dir
+        self.maxdiff = maxdiff
+        self.pctid = pctid
+        self.backend = backend
         self.parse_params(maxdiff, pctid)
 
     def parse_params(self, maxdiff, pctid):
@@ -22,13 +193,43 @@ class MergeStage(stage_builder.StageBuilder):
             f"-fastq_maxdiffs {maxdiff} -fastq_pctid {pctid}"
             f" -threads {self.config.n_cpu}"
         )
+        if self.backend == "native":
+            self.params += " -backend native"
+
+    def get_tool_version(self):
+        if self.backend == "native":
+            return super().get_tool_version()
+        return manifest.get_tool_version([self.USEARCH_PROG, "--version"])
+
+    @override
+    def get_memory(self) -> float:
+        if self.backend == "native":
+            return 0.25 * (self.config.n_cpu + 1)
+        return self.MEMORY_GB
+
+    def merge_native(self, reverse_infile: str, outfile: str, report: str):
+        n_pairs, n_merged = 0, 0
+        with open(self.infile, "rb") as r1_handle, open(reverse_infile, "rb") as r2_handle, open(outfile, "wb") as out_handle:
+            chunks = iter(functools.partial(read_pair_chunk, r1_handle, r2_handle), [])
+            merge = functools.partial(merge_chunk, maxdiff=self.maxdiff, pctid=self.pctid)
+            for merged, n_chunk_pairs, n_chunk_merged in chunk_pool.map_chunks(merge, chunks, self.config.n_cpu):
+                out_handle.write(merged)
+                n_pairs += n_chunk_pairs
+                n_merged += n_chunk_merged
+        write_report(report, n_pairs, n_merged)
 
     def setup(self, prefix):
         self.infile = os.path.join(self.decompress_dir, f"{prefix}_{self.in_suffix}")
+        reverse_infile = os.path.join(self.decompress_dir, f"{prefix}_{self.in_suffix.replace('R1', 'R2')}")
         merge_outfile = os.path.join(self.save_dir, f"{prefix}_{self.out_suffix}")
         report = os.path.join(self.save_dir, f"{prefix}_{self.report_suffix}")
         self.check_infile()
         self.check_savedir()
+        self.set_manifest(prefix, inputs=[self.infile, reverse_infile], outputs=[merge_outfile, report])
+        if self.backend == "native":
+            super().add_stage_function("Merge paired-end sequences",
+                                       functools.partial(self.merge_native, reverse_infile, merge_outfile, report))
+            return
         cmd = (
             f"{self.USEARCH_PROG}"
             f" -fastq_mergepairs {self.infile} -fastqout {merge_outfile}"
@@ -42,8 +243,8 @@ class MergeStage(stage_builder.StageBuilder):
         return all(self.output)
 
 
-def usearch_merge_demo(config, prefix, fastq_dir, save_dir):
-    stage = MergeStage(config, decompress_dir=fastq_dir, save_dir=save_dir)
+def usearch_merge_demo(config, prefix, fastq_dir, save_dir, backend="usearch"):
+    stage = MergeStage(config, decompress_dir=fastq_dir, save_dir=save_dir, backend=backend)
     stage.setup(prefix)
     is_complete = stage.run()
-    return is_complete
\ No newline at end of file
+    return is_complete
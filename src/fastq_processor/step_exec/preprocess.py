@@ -0,0 +1,142 @@
+import functools
+import os
+from typing import override
+
+from fastq_processor.step_build import (stage_builder, chunk_pool)
+from fastq_processor.step_exec import (merge, cut_primer, dereplicate)
+
+# Read counts of the report, in the order of the steps that drop reads.
+COUNT_NAMES = {
+    "pairs": "Pairs",
+    "merged": "Merged",
+    "with_primers": "With primers",
+    "too_short": "Too short",
+    "too_long": "Too long",
+    "untrimmed": "Untrimmed",
+    "written": "Passing filters",
+}
+
+
+def process_chunk(pairs: list, maxdiff: int, pctid: float, trim_params: dict) -> tuple[list[tuple[str, str]], dict]:
+    """
+    Merge a chunk of read pairs, trim the primers of the merged reads and apply the length bounds, in memory.
+
+    :param pairs: Read pairs from 'merge.read_pair_chunk'.
+    :param trim_params: Keyword arguments of 'cut_primer.trim_chunk' other than the reads.
+    :returns: ((label, sequence) of the reads kept, read counts of every step).
+    """
+    merged, n_pairs, n_merged = merge.merge_chunk(pairs, maxdiff=maxdiff, pctid=pctid)
+    trimmed, counts = cut_primer.trim_chunk(merged.splitlines(keepends=True), **trim_params)
+    lines = trimmed.decode().split("\n")
+    reads = [(title[1:].split(None, 1)[0], seq) for title, seq in zip(lines[0::4], lines[1::4])]
+    counts.update(pairs=n_pairs, merged=n_merged)
+    return reads, counts
+
+
+def write_report(report_path: str, counts: dict, size_counts: dict[int, int], n_spilled: int):
+    """
+    Write the number of reads left after each step, followed by the dereplication summary.
+
+    :param counts: Read counts of every step, as returned by 'process_chunk' and summed over the chunks.
+    :param size_counts: Number of unique sequences seen each number of times.
+    :param n_spilled: Number of sorted runs the dereplication hash table was spilled into.
+    """
+    pairs = max(counts["pairs"], 1)
+    lines = [f"{name + ':':<17}{counts[key]:>15,} ({100 * counts[key] / pairs:.1f}%)" for key, name in COUNT_NAMES.items()]
+    lines += [""] + dereplicate.format_report(size_counts, n_spilled)
+    with open(report_path, "w") as handle:
+        handle.write("\n".join(lines) + "\n")
+
+
+class PreprocessStage(stage_builder.StageBuilder):
+    """
+    Merge, trim, filter and dereplicate the paired-end reads of a sample in one streaming pass.
+    This replaces the merge, cutprimer, fqtofa and dereplicate stages: chunks of read pairs are merged and trimmed in
+    'n_cpu' worker processes with the native backends of those stages, and the reads kept are counted by a Dereplicator.
+    Only the dereplicated FASTA and a report with the read counts of every step are written.
+
+    Attributes:
+        trim_params (dict): Primers, error rate and length bounds of the trimmed reads, passed to 'cut_primer.trim_chunk'.
+        memory_mb (int): Memory budget (MB) of the dereplication hash table. Larger samples are spilled to disk.
+    """
+    def __init__(self, config, heading="stage_preprocess.py", decompress_dir="", save_dir="",
+                 maxdiff=5,
+                 pctid=90,
+                 rm_p_5="GTCGGTAAAACTCGTGCCAGC",
+                 rm_p_3="CAAACTGGGATTAGATACCCCACTATG",
+                 error_rate=0.15,
+                 min_read_len=204,
+                 max_read_len=254,
+                 seq_label: str = "Uniq",
+                 memory_mb: int = 1024
+        ):
+        super().__init__(heading=heading, config=config)
+        self.in_suffix = "R1.fastq"
+        self.out_suffix = "uniq.fasta"
+        self.report_suffix = "report.txt"
+        self.decompress_dir = decompress_dir
+        self.save_dir = save_dir
+        self.maxdiff = maxdiff
+        self.pctid = pctid
+        self.seq_label = seq_label
+        self.memory_mb = memory_mb
+        self.trim_params = dict(
+            rm_p_5=rm_p_5,
+            rm_p_3=rm_p_3,
+            error_rate=error_rate,
+            min_len=min_read_len - len(rm_p_5) - len(rm_p_3),
+            max_len=max_read_len - len(rm_p_5) - len(rm_p_3)
+        )
+        self.parse_params(maxdiff, pctid, rm_p_5, rm_p_3, error_rate, min_read_len, max_read_len)
+
+    def parse_params(self, maxdiff, pctid, rm_p_5, rm_p_3, error_rate, min_read_len, max_read_len):
+        self.params = (
+            f"-fastq_maxdiffs {maxdiff} -fastq_pctid {pctid}"
+            f" -g {rm_p_5}...{rm_p_3} -e {error_rate}"
+            f" --minimum-length {self.trim_params['min_len']} --maximum-length {self.trim_params['max_len']}"
+            f" -sizeout -relabel {self.seq_label} -memory_mb {self.memory_mb}"
+        )
+
+    @override
+    def get_memory(self) -> float:
+        return 0.25 * (self.config.n_cpu + 1) + self.memory_mb / 1024
+
+    def preprocess(self, reverse_infile: str, outfile: str, report: str):
+        counts = dict.fromkeys(COUNT_NAMES, 0)
+        dereplicator = dereplicate.Dereplicator(run_prefix=outfile, memory_budget=self.memory_mb << 20)
+        try:
+            with open(self.infile, "rb") as r1_handle, open(reverse_infile, "rb") as r2_handle:
+                chunks = iter(functools.partial(merge.read_pair_chunk, r1_handle, r2_handle), [])
+                process = functools.partial(process_chunk, maxdiff=self.maxdiff, pctid=self.pctid, trim_params=self.trim_params)
+                for reads, chunk_counts in chunk_pool.map_chunks(process, chunks, self.config.n_cpu):
+                    for label, seq in reads:
+                        dereplicator.add(seq, label)
+                    for key, count in chunk_counts.items():
+                        counts[key] = counts.get(key, 0) + count
+            n_spilled = len(dereplicator.run_files)
+            size_counts = dereplicator.write_fasta(outfile, seq_label=self.seq_label)
+        finally:
+            dereplicator.cleanup()
+        write_report(report, counts, size_counts, n_spilled)
+
+    def setup(self, prefix):
+        self.infile = os.path.join(self.decompress_dir, f"{prefix}_{self.in_suffix}")
+        reverse_infile = os.path.join(self.decompress_dir, f"{prefix}_{self.in_suffix.replace('R1', 'R2')}")
+        preprocess_outfile = os.path.join(self.save_dir, f"{prefix}_{self.out_suffix}")
+        report = os.path.join(self.save_dir, f"{prefix}_{self.report_suffix}")
+        self.check_infile()
+        self.check_savedir()
+        self.set_manifest(prefix, inputs=[self.infile, reverse_infile], outputs=[preprocess_outfile, report])
+        super().add_stage_function("Merge, trim and dereplicate paired-end sequences",
+                                   functools.partial(self.preprocess, reverse_infile, preprocess_outfile, report))
+
+    def run(self):
+        super().run()
+        return all(self.output)
+
+
+def preprocess_demo(config, prefix, decompress_dir="", save_dir=""):
+    stage = PreprocessStage(config, decompress_dir=decompress_dir, save_dir=save_dir)
+    stage.setup(prefix)
+    is_complete = stage.run()
+    return is_complete
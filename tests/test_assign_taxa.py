@@ -0,0 +1,52 @@
+import pytest
+import pandas as pd
+
+from analysis_toolkit.runner_build.base_logger import logger
+from fastq_processor.step_build.stage_config import StageConfig
+from fastq_processor.step_exec.assign_taxa import AssignTaxaStage
+
+
+LINEAGE = (
+    "genus_name,family_name,order_name,class_name,phylum_name,kingdom_name\n"
+    "Danio,Danionidae,Cypriniformes,Actinopteri,Chordata,Metazoa\n"
+    "Devario,Danionidae,Cypriniformes,Actinopteri,Chordata,Metazoa\n"
+    "Oryzias,Adrianichthyidae,Beloniformes,Actinopteri,Chordata,Metazoa\n"
+)
+
+
+@pytest.fixture
+def stage(tmp_path):
+    config = StageConfig(verbose=True, dry=True, logger=logger)
+    lineage_path = tmp_path / "lineage.csv"
+    lineage_path.write_text(LINEAGE)
+    stage = AssignTaxaStage(config, denoise_dir="data_dir", save_dir="output_dir", db_path="db_path", lineage_path=str(lineage_path))
+    return stage
+
+
+def test_parse_genus2otherlv(stage):
+    assert stage.genus2otherlv["Oryzias"] == ["Adrianichthyidae", "Beloniformes", "Actinopteri", "Chordata", "Metazoa"]
+    assert stage.family2otherlv["Danionidae"] == ["Danionidae", "Cypriniformes", "Actinopteri", "Chordata", "Metazoa"]
+    assert stage.order2otherlv["Beloniformes"] == ["Beloniformes", "Actinopteri", "Chordata", "Metazoa"]
+
+
+def test_annotate_taxonomy(stage):
+    blast_result = pd.DataFrame([
+        ["Zotu1", "gb|AB1|Danio_rerio", 100.0],
+        ["Zotu2", "gb|AB2|Danionidae_sp.", 99.0],
+        ["Zotu3", "gb|AB3|Beloniformes_sp.", 98.0],
+        ["Zotu4", "gb|AB4|Unknown_sp.", 97.0],
+        ["Zotu5", "gb|AB5|Danio_rerio", 96.0],
+    ])
+    result = stage.annotate_taxonomy(blast_result)
+
+    assert result.shape == (5, 10)
+    assert list(result.iloc[0, 2:9]) == ["Danio_rerio", "Danio", "Danionidae", "Cypriniformes", "Actinopteri", "Chordata", "Metazoa"]
+    assert list(result.iloc[1, 2:9]) == ["Danionidae_sp.", "", "Danionidae", "Cypriniformes", "Actinopteri", "Chordata", "Metazoa"]
+    assert list(result.iloc[2, 2:9]) == ["Beloniformes_sp.", "", "", "Beloniformes", "Actinopteri", "Chordata", "Metazoa"]
+    assert list(result.iloc[3, 2:9]) == ["Unknown_sp.", "", "", "", "", "", ""]
+    assert list(result[2]) == [100.0, 99.0, 98.0, 97.0, 96.0]
+
+
+def test_annotate_empty(stage):
+    result = stage.annotate_taxonomy(pd.DataFrame(columns=[0, 1, 2], dtype=str))
+    assert result.shape == (0, 10)
@@ -0,0 +1,177 @@
+import pytest
+import sys
+
+from analysis_toolkit.runner_build.base_logger import logger
+from fastq_processor.step_build.stage_config import StageConfig
+from fastq_processor.step_exec.assign_taxa import AssignTaxaStage
+from fastq_processor.step_exec.assign_taxa_batch import BatchAssignTaxaStage, PoolAssignTaxaStage
+
+
+LINEAGE = (
+    "genus_name,family_name,order_name,class_name,phylum_name,kingdom_name\n"
+    "Danio,Danionidae,Cypriniformes,Actinopteri,Chordata,Metazoa\n"
+)
+
+# Reports one hit per query, except for sequences starting with "GG", and logs every query it searched.
+FAKE_BLASTN = f"""#!{sys.executable}
+import sys
+args = sys.argv[1:]
+query, out = args[args.index("-query") + 1], args[args.index("-out") + 1]
+records = [block.split("\\n", 1) for block in open(query).read().split(">")[1:]]
+with open(out, "w") as out_handle, open(__file__ + ".log", "a") as log_handle:
+    for seq_id, seq in records:
+        seq = seq.replace("\\n", "")
+        log_handle.write(seq + "\\n")
+        if not seq.startswith("GG"):
+            out_handle.write(f"{{seq_id}},gb|{{seq}}|Danio_rerio,100.000\\n")
+"""
+
+
+@pytest.fixture
+def config():
+    config = StageConfig(verbose=True, logger=logger)
+    return config
+
+
+@pytest.fixture
+def denoise_dir(tmp_path):
+    denoise_dir = tmp_path / "denoise"
+    denoise_dir.mkdir()
+    (denoise_dir / "A_denoise.fasta").write_text(">Zotu1\nACGT\n>Zotu2\nGGCC\n")
+    (denoise_dir / "B_denoise.fasta").write_text(">Zotu1\nTTAA")
+    (denoise_dir / "C_denoise.fasta").write_text(">Zotu1\nAC\nGT\n>Zotu2\nTTAA\n")
+    return denoise_dir
+
+
+@pytest.fixture
+def blastn(tmp_path):
+    blastn = tmp_path / "blastn"
+    blastn.write_text(FAKE_BLASTN)
+    blastn.chmod(0o755)
+    return blastn
+
+
+def searched(blastn):
+    log = blastn.parent / (blastn.name + ".log")
+    return log.read_text().split() if log.exists() else []
+
+
+def make_stage(stage_class, config, denoise_dir, tmp_path, blastn, **kwargs):
+    lineage_path = tmp_path / "lineage.csv"
+    lineage_path.write_text(LINEAGE)
+    stage = stage_class(config, denoise_dir=str(denoise_dir), save_dir=str(tmp_path / "blast"),
+                        db_path=str(tmp_path / "db"), lineage_path=str(lineage_path), specifiers="qseqid sseqid pident", **kwargs)
+    stage.BLAST_PROG = str(blastn)
+    return stage
+
+
+def expected_row(zotu_id, seq):
+    return f"{zotu_id},gb|{seq}|Danio_rerio,Danio_rerio,Danio,Danionidae,Cypriniformes,Actinopteri,Chordata,Metazoa,100.000\n"
+
+
+def test_batch(config, denoise_dir, tmp_path, blastn):
+    stage = make_stage(BatchAssignTaxaStage, config, denoise_dir, tmp_path, blastn)
+    stage.setup(["A", "B", "C"])
+    blast_runners = [runner for runner in stage.runners if runner.prog_name == "Taxonomic assignment"]
+    assert len(blast_runners) == 1
+    assert stage.run()
+
+    blast_dir = tmp_path / "blast"
+    assert (blast_dir / "A_blast.csv").read_text() == expected_row("Zotu1", "ACGT")
+    assert (blast_dir / "B_blast.csv").read_text() == expected_row("Zotu1", "TTAA")
+    assert (blast_dir / "C_blast.csv").read_text() == expected_row("Zotu1", "ACGT") + expected_row("Zotu2", "TTAA")
+    assert sorted(path.name for path in blast_dir.iterdir()) == ["A_blast.csv", "B_blast.csv", "C_blast.csv"]
+
+
+def test_batch_size(config, denoise_dir, tmp_path, blastn):
+    stage = make_stage(BatchAssignTaxaStage, config, denoise_dir, tmp_path, blastn, batch_size=2)
+    stage.setup(["A", "B", "C"])
+    blast_runners = [runner for runner in stage.runners if runner.prog_name == "Taxonomic assignment"]
+    assert len(blast_runners) == 2
+    assert stage.run()
+    assert (tmp_path / "blast" / "C_blast.csv").read_text() == expected_row("Zotu1", "ACGT") + expected_row("Zotu2", "TTAA")
+
+
+def test_pool(config, denoise_dir, tmp_path, blastn):
+    stage = make_stage(PoolAssignTaxaStage, config, denoise_dir, tmp_path, blastn)
+    stage.setup(["A", "B", "C"])
+    assert stage.run()
+    assert searched(blastn) == ["ACGT", "GGCC", "TTAA"]
+
+    blast_dir = tmp_path / "blast"
+    assert (blast_dir / "A_blast.csv").read_text() == expected_row("Zotu1", "ACGT")
+    assert (blast_dir / "B_blast.csv").read_text() == expected_row("Zotu1", "TTAA")
+    assert (blast_dir / "C_blast.csv").read_text() == expected_row("Zotu1", "ACGT") + expected_row("Zotu2", "TTAA")
+
+
+def test_cache(config, denoise_dir, tmp_path, blastn):
+    cache_path = str(tmp_path / "cache.sqlite")
+    stage = make_stage(AssignTaxaStage, config, denoise_dir, tmp_path, blastn, cache_path=cache_path)
+    stage.setup("A")
+    assert stage.run()
+    assert searched(blastn) == ["ACGT", "GGCC"]
+    assert (tmp_path / "blast" / "A_blast.csv").read_text() == expected_row("Zotu1", "ACGT")
+
+    # Hits and misses of sample A are cached, so only TTAA is searched.
+    stage = make_stage(AssignTaxaStage, config, denoise_dir, tmp_path, blastn, cache_path=cache_path)
+    stage.setup("C")
+    assert stage.run()
+    assert searched(blastn) == ["ACGT", "GGCC", "TTAA"]
+    assert (tmp_path / "blast" / "C_blast.csv").read_text() == expected_row("Zotu1", "ACGT") + expected_row("Zotu2", "TTAA")
+
+    stage = make_stage(PoolAssignTaxaStage, config, denoise_dir, tmp_path, blastn, cache_path=cache_path)
+    stage.setup(["A", "B", "C"])
+    assert not any(runner.prog_name == "Taxonomic assignment" for runner in stage.runners)
+    assert stage.run()
+    assert stage.cache.hit_rate == 1.0
+    assert (tmp_path / "blast" / "B_blast.csv").read_text() == expected_row("Zotu1", "TTAA")
+
+
+def test_cache_fingerprint(config, denoise_dir, tmp_path, blastn):
+    cache_path = str(tmp_path / "cache.sqlite")
+    stage = make_stage(AssignTaxaStage, config, denoise_dir, tmp_path, blastn, cache_path=cache_path)
+    stage.setup("B")
+    assert stage.run()
+
+    stage = make_stage(AssignTaxaStage, config, denoise_dir, tmp_path, blastn, cache_path=cache_path, perc_identity=97)
+    stage.setup("B")
+    assert stage.run()
+    assert searched(blastn) == ["TTAA", "TTAA"]
+
+
+def test_cache_failed_search(config, denoise_dir, tmp_path, blastn):
+    # Writes the hit of the first query only, then dies as if it were killed.
+    failing_blastn = tmp_path / "failing_blastn"
+    failing_blastn.write_text(FAKE_BLASTN.replace("    for seq_id, seq in records:", "    for seq_id, seq in records[:1]:")
+                              + "sys.exit(137)\n")
+    failing_blastn.chmod(0o755)
+    cache_path = str(tmp_path / "cache.sqlite")
+    stage = make_stage(AssignTaxaStage, config, denoise_dir, tmp_path, failing_blastn, cache_path=cache_path)
+    stage.setup("A")
+    assert not stage.run()
+    assert not (tmp_path / "blast" / "A_blast.csv").exists()
+
+    # Nothing was cached, so both sequences are searched again.
+    stage = make_stage(AssignTaxaStage, config, denoise_dir, tmp_path, blastn, cache_path=cache_path)
+    stage.setup("A")
+    assert stage.run()
+    assert searched(blastn) == ["ACGT", "GGCC"]
+    assert (tmp_path / "blast" / "A_blast.csv").read_text() == expected_row("Zotu1", "ACGT")
+
+    stage = make_stage(PoolAssignTaxaStage, config, denoise_dir, tmp_path, failing_blastn, cache_path=str(tmp_path / "pool.sqlite"))
+    stage.setup(["A", "B", "C"])
+    assert not stage.run()
+    assert not (tmp_path / "blast" / "B_blast.csv").exists()
+
+
+def test_table_independent_of_cache(config, denoise_dir, tmp_path, blastn):
+    stage = make_stage(AssignTaxaStage, config, denoise_dir, tmp_path, blastn)
+    stage.setup("C")
+    assert stage.run()
+    without_cache = (tmp_path / "blast" / "C_blast.csv").read_bytes()
+
+    stage = make_stage(AssignTaxaStage, config, denoise_dir, tmp_path, blastn, cache_path=str(tmp_path / "cache.sqlite"))
+    stage.setup("C")
+    assert stage.run()
+    assert (tmp_path / "blast" / "C_blast.csv").read_bytes() == without_cache
+    assert without_cache.decode() == expected_row("Zotu1", "ACGT") + expected_row("Zotu2", "TTAA")
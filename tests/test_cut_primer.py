@@ -0,0 +1,126 @@
+import pytest
+import random
+
+from analysis_toolkit.runner_build.base_logger import logger
+from fastq_processor.step_build.stage_config import StageConfig
+from fastq_processor.step_exec.cut_primer import CutPrimerStage, LinkedPrimerTrimmer, PrimerMatcher, trim_chunk
+
+RM_P_5 = "GTCGGTAAAACTCGTGCCAGC"
+RM_P_3 = "CAAACTGGGATTAGATACCCCACTATG"
+
+
+def edit(seq, n_errors, rng):
+    seq = list(seq)
+    for _ in range(n_errors):
+        pos = rng.randrange(len(seq))
+        op = rng.randrange(3)
+        if op == 0:
+            seq[pos] = "A" if seq[pos] != "A" else "C"
+        elif op == 1:
+            del seq[pos]
+        else:
+            seq.insert(pos, rng.choice("ACGT"))
+    return "".join(seq)
+
+
+def best_ends(primer, read):
+    """
+    Fewest errors of a semi-global alignment, and the ends of the alignments with that many errors, by dynamic programming.
+    """
+    prev = list(range(len(primer) + 1))
+    errors = []
+    for base in read:
+        cur = [0]
+        for i in range(1, len(primer) + 1):
+            cur.append(min(prev[i] + 1, cur[i - 1] + 1, prev[i - 1] + (primer[i - 1] != base)))
+        prev = cur
+        errors.append(cur[-1])
+    return min(errors), [j + 1 for j, n in enumerate(errors) if n == min(errors)]
+
+
+def substitute(seq, n_errors, rng):
+    """
+    Substitutions away from the ends of the primer, so the trimmed read is unambiguous.
+    """
+    seq = list(seq)
+    for pos in rng.sample(range(2, len(seq) - 2), n_errors):
+        seq[pos] = "A" if seq[pos] != "A" else "C"
+    return "".join(seq)
+
+
+def make_fastq(n_reads, seed=0):
+    rng = random.Random(seed)
+    records, inserts = [], []
+    for i in range(n_reads):
+        insert = "".join(rng.choices("ACGT", k=rng.randint(150, 210)))
+        seq = "".join(rng.choices("ACGT", k=rng.randint(0, 5))) + substitute(RM_P_5, rng.randint(0, 2), rng) + insert + substitute(RM_P_3, rng.randint(0, 2), rng)
+        records.append(f"@read{i} 1:N:0:1\n{seq}\n+\n{'I' * len(seq)}\n")
+        inserts.append(insert)
+    return "".join(records), inserts
+
+
+@pytest.fixture
+def config():
+    config = StageConfig(verbose=True, logger=logger, n_cpu=2)
+    return config
+
+
+def test_primer_matcher():
+    rng = random.Random(1)
+    matcher = PrimerMatcher(RM_P_5, error_rate=0.15)
+    for _ in range(500):
+        read = "".join(rng.choices("ACGT", k=rng.randint(0, 20))) + edit(RM_P_5, rng.randint(0, 5), rng) + "".join(rng.choices("ACGT", k=40))
+        errors, ends = best_ends(RM_P_5, read)
+        if errors <= 3:
+            assert matcher.find_end(read.encode()) in ends
+
+
+def test_primer_matcher_partial_and_wildcards():
+    matcher = PrimerMatcher(RM_P_5, error_rate=0.15)
+    assert matcher.find_end((RM_P_5[-12:] + "TTTTTTTTTTTTTTTTTTTTTT").encode()) == 12
+    assert matcher.find_end(("TT" + "A" * 60).encode()) is None
+    wildcard = PrimerMatcher("GTCGGTAAAACTCGTGCCRGC", error_rate=0.0)
+    assert not wildcard.seeds
+    assert wildcard.find_end(("TTT" + RM_P_5 + "ACGT").encode()) == 3 + len(RM_P_5)
+
+
+def test_linked_trimmer():
+    trimmer = LinkedPrimerTrimmer(RM_P_5, RM_P_3, error_rate=0.15)
+    insert = "ACGTTGCA" * 20
+    assert trimmer.trim(("GG" + RM_P_5 + insert + RM_P_3 + "AA").encode()) == (2 + len(RM_P_5), 2 + len(RM_P_5) + len(insert))
+    assert trimmer.trim((insert + RM_P_3).encode()) == (0, len(insert))
+    assert trimmer.trim((RM_P_5 + insert).encode()) == (len(RM_P_5), len(RM_P_5) + len(insert))
+    assert trimmer.trim(insert.encode()) is None
+
+
+def test_trim_chunk():
+    fastq, inserts = make_fastq(300)
+    lines = fastq.encode().splitlines(keepends=True)
+    lines += [b"@short\n", (RM_P_5 + "A" * 20 + RM_P_3).encode() + b"\n", b"+\n", b"I" * 68 + b"\n"]
+    lines += [b"@untrimmed\n", b"C" * 180 + b"\n", b"+\n", b"I" * 180 + b"\n"]
+    out, counts = trim_chunk(lines, RM_P_5, RM_P_3, 0.15, min_len=150, max_len=210)
+    assert out.split(b"\n")[1::4] == [insert.encode() for insert in inserts]
+    assert counts == {"processed": 302, "with_primers": 301, "too_short": 1, "too_long": 0, "untrimmed": 1, "written": 300}
+
+
+@pytest.mark.parametrize("n_cpu", [1, 2])
+def test_stage_native(tmp_path, n_cpu):
+    config = StageConfig(verbose=True, logger=logger, n_cpu=n_cpu)
+    fastq, inserts = make_fastq(1000)
+    merge_dir = tmp_path / "merge"
+    merge_dir.mkdir()
+    (merge_dir / "test_merge.fastq").write_text(fastq)
+    stage = CutPrimerStage(config, merge_dir=str(merge_dir), save_dir=str(tmp_path / "cut_primer"),
+                           min_read_len=150 + 48, max_read_len=210 + 48, backend="native")
+    stage.setup("test")
+    assert stage.run()
+    lines = (tmp_path / "cut_primer" / "test_cut.fastq").read_text().split("\n")
+    assert lines[1::4] == inserts
+    assert lines[0] == "@read0 1:N:0:1"
+    assert [len(seq) for seq in lines[1::4]] == [len(qual) for qual in lines[3::4]]
+    assert "Reads written (passing filters):           1,000 (100.0%)" in (tmp_path / "cut_primer" / "test_report.txt").read_text()
+
+
+def test_stage_invalid_backend(config):
+    with pytest.raises(ValueError):
+        CutPrimerStage(config, backend="trimmomatic")
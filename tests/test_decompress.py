@@ -0,0 +1,111 @@
+import pytest
+import gzip
+import shutil
+import sys
+
+from analysis_toolkit.runner_build.base_logger import logger
+from fastq_processor.step_build import stream_feeder
+from fastq_processor.step_build.stage_config import StageConfig
+from fastq_processor.step_exec import decompress
+from fastq_processor.step_exec.decompress import DecompressStage
+from fastq_processor.step_exec.merge import MergeStage
+
+
+FASTQ = {
+    "R1": "@read1 1:N:0:1\nACGTACGT\n+\nIIIIIIII\n" * 1000,
+    "R2": "@read1 2:N:0:1\nTTGGCCAA\n+\nIIIIIIII\n" * 1000,
+}
+
+
+@pytest.fixture
+def config():
+    config = StageConfig(verbose=True, logger=logger, n_cpu=2)
+    return config
+
+
+@pytest.fixture
+def fastq_dir(tmp_path):
+    fastq_dir = tmp_path / "fastq"
+    fastq_dir.mkdir()
+    for read, text in FASTQ.items():
+        with gzip.open(fastq_dir / f"test_{read}.fastq.gz", "wt") as handle:
+            handle.write(text)
+    return fastq_dir
+
+
+@pytest.mark.parametrize("backend", ["python", "isal", "pigz"])
+def test_decompress(config, fastq_dir, tmp_path, backend):
+    # The stage falls back to the gzip module silently, so an unavailable backend would not be tested.
+    if backend == "isal":
+        pytest.importorskip("isal")
+    if backend == "pigz" and shutil.which(config.get_program("pigz")) is None:
+        pytest.skip("pigz is not on the PATH")
+    stage = DecompressStage(config, fastq_dir=str(fastq_dir), save_dir=str(tmp_path / "decompress"), backend=backend)
+    assert stage.backend == backend
+    stage.setup("test")
+    assert stage.run()
+    for read, text in FASTQ.items():
+        assert (tmp_path / "decompress" / f"test_{read}.fastq").read_text() == text
+
+
+def test_resolve_backend(config, monkeypatch):
+    monkeypatch.setattr(decompress, "igzip", None)
+    monkeypatch.setattr(decompress.shutil, "which", lambda prog: None)
+    stage = DecompressStage(config, backend="auto")
+    assert stage.backend == "python"
+    stage = DecompressStage(config, backend="isal")
+    assert stage.backend == "python"
+    with pytest.raises(ValueError):
+        DecompressStage(config, backend="zstd")
+
+
+def test_corrupt_input(config, fastq_dir, tmp_path):
+    (fastq_dir / "test_R2.fastq.gz").write_bytes(b"not gzip")
+    stage = DecompressStage(config, fastq_dir=str(fastq_dir), save_dir=str(tmp_path / "decompress"), backend="python")
+    stage.setup("test")
+    assert not stage.run()
+
+
+# Concatenates R1 and R2 into -fastqout, like a very naive merger. Reads nothing if -fastq_pctid is 0.
+FAKE_USEARCH = f"""#!{sys.executable}
+import sys
+args = sys.argv[1:]
+r1, out = args[args.index("-fastq_mergepairs") + 1], args[args.index("-fastqout") + 1]
+with open(out, "w") as out_handle:
+    if args[args.index("-fastq_pctid") + 1] != "0":
+        out_handle.write(open(r1).read() + open(r1.replace("R1", "R2")).read())
+open(args[args.index("-report") + 1], "w").close()
+"""
+
+
+def run_passthrough(config, fastq_dir, tmp_path, pctid=90):
+    usearch = tmp_path / "usearch"
+    usearch.write_text(FAKE_USEARCH)
+    usearch.chmod(0o755)
+    decompress_dir = tmp_path / "decompress"
+    decompress_stage = DecompressStage(config, fastq_dir=str(fastq_dir), save_dir=str(decompress_dir), backend="python", passthrough=True)
+    decompress_stage.setup("test")
+    assert decompress_stage.run()
+    merge_stage = MergeStage(config, decompress_dir=str(decompress_dir), save_dir=str(tmp_path / "merge"), pctid=pctid)
+    merge_stage.USEARCH_PROG = str(usearch)
+    merge_stage.setup("test")
+    return merge_stage.run()
+
+
+@pytest.mark.skipif(not stream_feeder.is_supported(), reason="named pipes are not supported")
+def test_passthrough(config, fastq_dir, tmp_path):
+    assert run_passthrough(config, fastq_dir, tmp_path)
+    assert (tmp_path / "merge" / "test_merge.fastq").read_text() == FASTQ["R1"] + FASTQ["R2"]
+    assert not (tmp_path / "decompress" / "test_R1.fastq").is_file()
+
+
+@pytest.mark.skipif(not stream_feeder.is_supported(), reason="named pipes are not supported")
+def test_passthrough_corrupt_input(config, fastq_dir, tmp_path):
+    (fastq_dir / "test_R2.fastq.gz").write_bytes(b"not gzip")
+    assert not run_passthrough(config, fastq_dir, tmp_path)
+
+
+@pytest.mark.skipif(not stream_feeder.is_supported(), reason="named pipes are not supported")
+def test_passthrough_unread_pipes(config, fastq_dir, tmp_path):
+    assert not run_passthrough(config, fastq_dir, tmp_path, pctid=0)
+    assert not stream_feeder.FEEDERS
@@ -0,0 +1,130 @@
+import pytest
+import random
+import sys
+
+from analysis_toolkit.read.read_denoise_report import DenoiseReportReader
+from analysis_toolkit.runner_build.base_logger import logger
+from fastq_processor.step_build.stage_config import StageConfig
+from fastq_processor.step_exec.denoise import DenoiseStage, partition_uniques
+
+
+# A sequence is noise of the first more abundant amplicon, at least twice its size, that it differs from by one substitution.
+# Amplicons with a poly-T run are chimeras.
+FAKE_USEARCH = f"""#!{sys.executable}
+import sys
+args = sys.argv[1:]
+infile, minsize = args[args.index("-unoise3") + 1], int(args[args.index("-minsize") + 1])
+records = []
+for line in open(infile):
+    if line.startswith(">"):
+        label = line[1:].strip()
+        records.append([label.split(";")[0], int(label.split("size=")[1].strip(";")), ""])
+    else:
+        records[-1][2] += line.strip()
+amps, lines, zotus = [], [], []
+for name, size, seq in records:
+    if size < minsize:
+        continue
+    top = next((amp for amp in amps if len(amp[2]) == len(seq) and amp[1] >= 2 * size
+                and sum(a != b for a, b in zip(amp[2], seq)) == 1), None)
+    if top is None:
+        amps.append((name, size, seq))
+        lines.append(f"{{name}};size={{size}};\\tdenoise\\tamp{{len(amps)}}")
+    else:
+        lines.append(f"{{name}};size={{size}};\\tdenoise\\tnoise\\tdist=1\\ttop={{top[0]}}")
+for name, size, seq in amps:
+    kind = "chimera" if "TTTTTTTTTT" in seq else "zotu"
+    lines.append(f"{{name}};size={{size}};\\tchfilter\\t{{kind}}")
+    if kind == "zotu":
+        zotus.append(seq)
+with open(args[args.index("-tabbedout") + 1], "w") as handle:
+    handle.write("\\n".join(lines) + "\\n")
+with open(args[args.index("-zotus") + 1], "w") as handle:
+    handle.writelines(f">Zotu{{i}}\\n{{seq}}\\n" for i, seq in enumerate(zotus, start=1))
+print(f"{{len(zotus)}} good, {{len(amps) - len(zotus)}} chimeras", file=sys.stderr)
+"""
+
+
+def make_uniques(seed=0):
+    rng = random.Random(seed)
+    entries = []
+    for i in range(6):
+        parent = "".join(rng.choices("ACG", k=50 + 10 * i))
+        entries.append((1000 - 100 * i, parent))
+        for j, size in enumerate([60, 30, 9]):
+            pos = 5 + 7 * j
+            entries.append((size - i, parent[:pos] + "T" + parent[pos + 1:]))
+    entries.append((120, "ACGA" * 10 + "T" * 12))
+    entries.append((3, "ACGT" * 20))
+    entries.sort(key=lambda entry: -entry[0])
+    return "".join(f">Uniq{n};size={size}\n{seq}\n" for n, (size, seq) in enumerate(entries, start=1))
+
+
+@pytest.fixture
+def config():
+    config = StageConfig(verbose=True, logger=logger, n_cpu=2, memory=8)
+    return config
+
+
+@pytest.fixture
+def derep_dir(tmp_path):
+    derep_dir = tmp_path / "dereplicate"
+    derep_dir.mkdir()
+    (derep_dir / "test_uniq.fasta").write_text(make_uniques())
+    usearch = tmp_path / "usearch"
+    usearch.write_text(FAKE_USEARCH)
+    usearch.chmod(0o755)
+    return derep_dir
+
+
+def run_denoise(config, tmp_path, derep_dir, save_dir_name, **kwargs):
+    save_dir = tmp_path / save_dir_name
+    stage = DenoiseStage(config, derep_dir=str(derep_dir), save_dir=str(save_dir), **kwargs)
+    stage.USEARCH_PROG = str(tmp_path / "usearch")
+    stage.setup("test")
+    assert stage.run()
+    reader = DenoiseReportReader()
+    reader.read_denoise_report(str(save_dir / "test_denoise_report.txt"))
+    return stage, save_dir, reader
+
+
+@pytest.mark.parametrize("partition_by", ["abundance", "length"])
+def test_partitioned(config, tmp_path, derep_dir, partition_by):
+    _, whole_dir, whole = run_denoise(config, tmp_path, derep_dir, "whole")
+    stage, part_dir, part = run_denoise(config, tmp_path, derep_dir, "partitioned", partition_mb=300 / (1 << 20), partition_by=partition_by)
+    assert stage.params == f"-minsize 8 -unoise_alpha 2 -partition_mb {300 / (1 << 20)} -partition_by {partition_by}"
+    assert (part_dir / "test_denoise.fasta").read_text() == (whole_dir / "test_denoise.fasta").read_text()
+    assert part.hap2amp == whole.hap2amp
+    assert part.amp_size == whole.amp_size
+    assert part.hap_size == whole.hap_size
+    assert len(part.hap_size) == 6
+    assert "chimeras" in (part_dir / "test_report.txt").read_text()
+    assert sorted(path.name for path in part_dir.iterdir()) == ["test_denoise.fasta", "test_denoise_report.txt", "test_report.txt"]
+
+
+def test_small_input_is_not_partitioned(config, tmp_path, derep_dir):
+    stage = DenoiseStage(config, derep_dir=str(derep_dir), save_dir=str(tmp_path / "denoise"), partition_mb=1)
+    stage.setup("test")
+    assert [runner.prog_name for runner in stage.runners] == ["Denoise unique sequences"]
+    assert " -partition_mb" not in stage.runners[0].command
+
+
+def test_partition_uniques(tmp_path, derep_dir):
+    infile = str(derep_dir / "test_uniq.fasta")
+    part_files = partition_uniques(infile, str(tmp_path / "part"), 300, "length", minsize=8)
+    assert len(part_files) > 2
+    labels = []
+    for part_file in part_files:
+        text = open(part_file).read()
+        assert len(text) <= 300 or text.count(">") == 1
+        part_labels = [line for line in text.splitlines() if line.startswith(">")]
+        sizes = [int(label.split("size=")[1]) for label in part_labels]
+        assert sizes == sorted(sizes, reverse=True)
+        labels.extend(part_labels)
+    expected = [line for line in open(infile).read().splitlines() if line.startswith(">") and int(line.split("size=")[1]) >= 8]
+    assert sorted(labels) == sorted(expected)
+
+
+def test_invalid_partition_by(config):
+    with pytest.raises(ValueError):
+        DenoiseStage(config, partition_by="random")
@@ -0,0 +1,78 @@
+import pytest
+import collections
+import random
+
+from analysis_toolkit.runner_build.base_logger import logger
+from fastq_processor.step_build.stage_config import StageConfig
+from fastq_processor.step_exec.dereplicate import Dereplicator, DereplicateStage
+
+
+def make_reads(n_reads, seed=0):
+    rng = random.Random(seed)
+    templates = ["".join(rng.choices("ACGT", k=rng.choice([20, 90, 170]))) for _ in range(50)]
+    weights = [1 / (i + 1) for i in range(len(templates))]
+    return [rng.choices(templates, weights)[0] for _ in range(n_reads)]
+
+
+def expected_fasta(reads, seq_label="Uniq", sizeout=True):
+    counts = collections.Counter(reads)
+    first_seen = {seq: i for i, seq in reversed(list(enumerate(reads)))}
+    uniques = sorted(counts, key=lambda seq: (-counts[seq], first_seen[seq]))
+    lines = []
+    for n, seq in enumerate(uniques, start=1):
+        header = f"{seq_label}{n}" if seq_label else f"read{first_seen[seq]}"
+        lines.append(f">{header};size={counts[seq]}" if sizeout else f">{header}")
+        lines.extend(seq[i:i + 80] for i in range(0, len(seq), 80))
+    return "\n".join(lines) + "\n"
+
+
+@pytest.fixture
+def config():
+    config = StageConfig(verbose=True, logger=logger)
+    return config
+
+
+@pytest.mark.parametrize("memory_budget", [1 << 30, 2000, 1])
+def test_dereplicator(tmp_path, memory_budget):
+    reads = make_reads(2000)
+    dereplicator = Dereplicator(run_prefix=str(tmp_path / "test"), memory_budget=memory_budget)
+    for i, seq in enumerate(reads):
+        dereplicator.add(seq.lower() if i % 3 == 0 else seq, f"read{i}")
+    assert (len(dereplicator.run_files) > 0) == (memory_budget < 1 << 30)
+    size_counts = dereplicator.write_fasta(str(tmp_path / "uniq.fasta"))
+    dereplicator.cleanup()
+    assert (tmp_path / "uniq.fasta").read_text() == expected_fasta(reads)
+    assert sum(size * n for size, n in size_counts.items()) == len(reads)
+    assert [path.name for path in tmp_path.iterdir()] == ["uniq.fasta"]
+
+
+def test_dereplicator_keep_labels(tmp_path):
+    reads = make_reads(300)
+    dereplicator = Dereplicator(run_prefix=str(tmp_path / "test"), memory_budget=1000)
+    for i, seq in enumerate(reads):
+        dereplicator.add(seq, f"read{i}")
+    dereplicator.write_fasta(str(tmp_path / "uniq.fasta"), seq_label="", sizeout=False)
+    dereplicator.cleanup()
+    assert (tmp_path / "uniq.fasta").read_text() == expected_fasta(reads, seq_label="", sizeout=False)
+
+
+def test_stage_native(config, tmp_path):
+    reads = ["ACGT" * 30, "ACGT" * 30, "TTGA" * 25, "ACGT" * 30, "TTGA" * 25, "GGCC" * 45]
+    fasta_dir = tmp_path / "fq_to_fa"
+    fasta_dir.mkdir()
+    # Sequences wrapped at 60 characters, as written by the FASTQ to FASTA stage.
+    (fasta_dir / "test_cut.fasta").write_text("".join(
+        f">M001:{i} 1:N:0:1\n" + "".join(seq[j:j + 60] + "\n" for j in range(0, len(seq), 60)) for i, seq in enumerate(reads)
+    ))
+    stage = DereplicateStage(config, fasta_dir=str(fasta_dir), save_dir=str(tmp_path / "dereplicate"), backend="native")
+    assert stage.params == "-sizeout -relabel Uniq -backend native -memory_mb 1024"
+    stage.setup("test")
+    assert stage.run()
+    assert (tmp_path / "dereplicate" / "test_uniq.fasta").read_text() == expected_fasta(reads)
+    report = (tmp_path / "dereplicate" / "test_report.txt").read_text()
+    assert report.startswith("6 seqs, 3 uniques, 1 singletons (33.3%)\nMin size 1, median 2, max 3, avg 2.00\n")
+
+
+def test_stage_invalid_backend(config):
+    with pytest.raises(ValueError):
+        DereplicateStage(config, backend="vsearch")
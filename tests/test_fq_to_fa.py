@@ -0,0 +1,89 @@
+import pytest
+import io
+import random
+
+from Bio import SeqIO
+
+from analysis_toolkit.runner_build.base_logger import logger
+from fastq_processor.step_build.stage_config import StageConfig
+from fastq_processor.step_exec import fq_to_fa
+from fastq_processor.step_exec.fq_to_fa import FqToFaStage, convert_range, convert_stream, find_record_start
+
+
+def make_fastq(n_reads, seed=0):
+    rng = random.Random(seed)
+    records = []
+    for i in range(n_reads):
+        length = rng.choice([0, 5, 60, 61, 150, 250])
+        seq = "".join(rng.choices("ACGTN", k=length))
+        qual = "".join(rng.choices("@ABCFGHI", k=length))
+        records.append(f"@M001:{i}:1 1:N:0:{i}  \n{seq}\n+\n{qual}\n")
+    return "".join(records)
+
+
+def biopython_fasta(fastq):
+    out = io.StringIO()
+    for record in SeqIO.parse(io.StringIO(fastq), "fastq"):
+        SeqIO.write(record, out, "fasta")
+    return out.getvalue().encode()
+
+
+@pytest.fixture
+def config():
+    config = StageConfig(verbose=True, logger=logger, n_cpu=3)
+    return config
+
+
+@pytest.mark.parametrize("block_size", [7, 100, 1 << 20])
+def test_convert_stream(block_size):
+    fastq = make_fastq(500)
+    out = io.BytesIO()
+    convert_stream(io.BytesIO(fastq.encode()), out, block_size=block_size)
+    assert out.getvalue() == biopython_fasta(fastq)
+
+
+def test_convert_stream_crlf_and_no_final_newline():
+    fastq = "@r1 a \r\nACGT\r\n+\r\nIIII\r\n@r2\nAC\n+\nII"
+    out = io.BytesIO()
+    convert_stream(io.BytesIO(fastq.encode()), out)
+    assert out.getvalue() == biopython_fasta(fastq)
+
+
+def test_convert_stream_malformed():
+    with pytest.raises(ValueError):
+        convert_stream(io.BytesIO(b"@r1\nACGT\n+\nIIII\n@r2\nAC\n"), io.BytesIO())
+    with pytest.raises(ValueError):
+        convert_stream(io.BytesIO(b">r1\nACGT\n>r2\nAC\n"), io.BytesIO())
+
+
+def test_find_record_start():
+    data = b"@r1\nACGT\n+\n@III\n@r2\nAC\n+\nII\n"
+    assert find_record_start(data, 0) == 0
+    assert find_record_start(data, 1) == data.index(b"@r2")
+    assert find_record_start(data, data.index(b"@III")) == data.index(b"@r2")
+    assert find_record_start(data, len(data) - 1) == len(data)
+
+
+def test_convert_range(tmp_path):
+    fastq = make_fastq(300)
+    infile = tmp_path / "test.fastq"
+    infile.write_text(fastq)
+    data = infile.read_bytes()
+    middle = find_record_start(data, len(data) // 2)
+    convert_range(str(infile), 0, middle, str(tmp_path / "part0"))
+    convert_range(str(infile), middle, len(data), str(tmp_path / "part1"))
+    assert (tmp_path / "part0").read_bytes() + (tmp_path / "part1").read_bytes() == biopython_fasta(fastq)
+
+
+@pytest.mark.parametrize("parallel", [False, True])
+def test_stage(config, tmp_path, monkeypatch, parallel):
+    monkeypatch.setattr(fq_to_fa, "MIN_PARALLEL_SIZE", 0)
+    fastq = make_fastq(1000)
+    cutprimer_dir = tmp_path / "cut_primer"
+    cutprimer_dir.mkdir()
+    (cutprimer_dir / "test_cut.fastq").write_text(fastq)
+    stage = FqToFaStage(config, cutprimer_dir=str(cutprimer_dir), save_dir=str(tmp_path / "fq_to_fa"), parallel=parallel)
+    stage.setup("test")
+    assert stage.run()
+    assert (tmp_path / "fq_to_fa" / "test_cut.fasta").read_bytes() == biopython_fasta(fastq)
+    assert [path.name for path in (tmp_path / "fq_to_fa").iterdir()] == ["test_cut.fasta"]
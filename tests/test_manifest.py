@@ -0,0 +1,144 @@
+import pytest
+import json
+import os
+
+from analysis_toolkit.runner_build.base_logger import logger
+from fastq_processor.step_build import manifest
+from fastq_processor.step_build.manifest import StageManifest, hash_file
+from fastq_processor.step_build.stage_config import StageConfig
+from fastq_processor.step_exec.fq_to_fa import FqToFaStage
+
+
+FASTQ = "@read1\nACGTACGT\n+\nIIIIIIII\n"
+
+
+@pytest.fixture
+def config():
+    config = StageConfig(verbose=True, logger=logger, resume=True)
+    return config
+
+
+@pytest.fixture
+def cutprimer_dir(tmp_path):
+    cutprimer_dir = tmp_path / "cut_primer"
+    cutprimer_dir.mkdir()
+    (cutprimer_dir / "test_cut.fastq").write_text(FASTQ)
+    return cutprimer_dir
+
+
+def run_stage(config, cutprimer_dir, save_dir):
+    stage = FqToFaStage(config, cutprimer_dir=str(cutprimer_dir), save_dir=str(save_dir))
+    stage.setup("test")
+    skipped = stage.is_up_to_date()
+    is_complete = stage.run_if_changed()
+    return skipped, is_complete
+
+
+def test_hash_file(tmp_path):
+    path = tmp_path / "file.txt"
+    path.write_text("abc")
+    expected = "ba7816bf8f01cfea414140de5dae2223b00361a396177a9cb410ff61f20015ad"
+    assert hash_file(str(path)) == expected
+    assert hash_file(str(tmp_path / "missing.txt")) is None
+
+
+def test_rerun_is_skipped(config, cutprimer_dir, tmp_path):
+    save_dir = tmp_path / "fq_to_fa"
+    assert run_stage(config, cutprimer_dir, save_dir) == (False, True)
+
+    manifest_path = save_dir / "test_manifest.json"
+    record = json.loads(manifest_path.read_text())
+    assert record["stage"] == "stage_fq_to_fa.py"
+    assert record["outputs"] == ["test_cut.fasta"]
+
+    assert run_stage(config, cutprimer_dir, save_dir) == (True, True)
+
+
+def test_changed_input_reruns(config, cutprimer_dir, tmp_path):
+    save_dir = tmp_path / "fq_to_fa"
+    run_stage(config, cutprimer_dir, save_dir)
+
+    (cutprimer_dir / "test_cut.fastq").write_text(FASTQ + "@read2\nTTTT\n+\nIIII\n")
+    assert run_stage(config, cutprimer_dir, save_dir) == (False, True)
+    assert ">read2" in (save_dir / "test_cut.fasta").read_text()
+
+
+def test_missing_output_reruns(config, cutprimer_dir, tmp_path):
+    save_dir = tmp_path / "fq_to_fa"
+    run_stage(config, cutprimer_dir, save_dir)
+
+    os.remove(save_dir / "test_cut.fasta")
+    assert run_stage(config, cutprimer_dir, save_dir) == (False, True)
+
+
+def test_changed_params(tmp_path):
+    infile = tmp_path / "in.txt"
+    infile.write_text("data")
+    outfile = tmp_path / "out.txt"
+    outfile.write_text("result")
+    manifest_path = str(tmp_path / "manifest.json")
+
+    StageManifest(manifest_path, "stage", "-perc_identity 90", lambda: "v1", [str(infile)], [str(outfile)]).write()
+
+    assert StageManifest(manifest_path, "stage", "-perc_identity 90", lambda: "v1", [str(infile)], [str(outfile)]).is_up_to_date()
+    assert not StageManifest(manifest_path, "stage", "-perc_identity 97", lambda: "v1", [str(infile)], [str(outfile)]).is_up_to_date()
+    assert not StageManifest(manifest_path, "stage", "-perc_identity 90", lambda: "v2", [str(infile)], [str(outfile)]).is_up_to_date()
+
+
+def test_unchanged_input_not_rehashed(tmp_path, monkeypatch):
+    infile = tmp_path / "in.txt"
+    infile.write_text("data")
+    outfile = tmp_path / "out.txt"
+    outfile.write_text("result")
+    manifest_path = str(tmp_path / "manifest.json")
+
+    def new_manifest():
+        return StageManifest(manifest_path, "stage", "", lambda: "v1", [str(infile)], [str(outfile)])
+
+    new_manifest().write()
+    hashed = []
+    monkeypatch.setattr(manifest, "hash_file", lambda path: hashed.append(path) or hash_file(path))
+    assert new_manifest().is_up_to_date()
+    assert hashed == []
+
+    # Same size, new modification time: the input is hashed again, and found changed.
+    infile.write_text("date")
+    os.utime(infile, ns=(0, os.stat(infile).st_mtime_ns + 10**9))
+    assert not new_manifest().is_up_to_date()
+    assert hashed == [str(infile)]
+
+
+def test_touched_input_refreshes_stats(tmp_path):
+    infile = tmp_path / "in.txt"
+    infile.write_text("data")
+    outfile = tmp_path / "out.txt"
+    outfile.write_text("result")
+    manifest_path = tmp_path / "manifest.json"
+    StageManifest(str(manifest_path), "stage", "", lambda: "v1", [str(infile)], [str(outfile)]).write()
+
+    mtime_ns = os.stat(infile).st_mtime_ns + 10**9
+    os.utime(infile, ns=(mtime_ns, mtime_ns))
+    assert StageManifest(str(manifest_path), "stage", "", lambda: "v1", [str(infile)], [str(outfile)]).is_up_to_date()
+    assert json.loads(manifest_path.read_text())["input_stats"] == {"in.txt": [4, mtime_ns]}
+
+
+def test_manifest_without_stats(tmp_path):
+    infile = tmp_path / "in.txt"
+    infile.write_text("data")
+    outfile = tmp_path / "out.txt"
+    outfile.write_text("result")
+    manifest_path = tmp_path / "manifest.json"
+    StageManifest(str(manifest_path), "stage", "", lambda: "v1", [str(infile)], [str(outfile)]).write()
+    record = json.loads(manifest_path.read_text())
+    del record["input_stats"]
+    manifest_path.write_text(json.dumps(record))
+
+    assert StageManifest(str(manifest_path), "stage", "", lambda: "v1", [str(infile)], [str(outfile)]).is_up_to_date()
+    assert "input_stats" in json.loads(manifest_path.read_text())
+
+
+def test_resume_disabled(cutprimer_dir, tmp_path):
+    config = StageConfig(verbose=True, logger=logger)
+    save_dir = tmp_path / "fq_to_fa"
+    run_stage(config, cutprimer_dir, save_dir)
+    assert run_stage(config, cutprimer_dir, save_dir) == (False, True)
@@ -0,0 +1,94 @@
+import pytest
+import random
+
+from analysis_toolkit.runner_build.base_logger import logger
+from fastq_processor.step_build.stage_config import StageConfig
+from fastq_processor.step_exec.merge import COMPLEMENT, MergeStage, merge_chunk, read_pair_chunk
+
+
+def reverse_complement(seq):
+    return seq.translate(COMPLEMENT)[::-1]
+
+
+def make_pairs(n_pairs, seed=0, read_len=150):
+    rng = random.Random(seed)
+    amplicons, pairs = [], []
+    for i in range(n_pairs):
+        amplicon = "".join(rng.choices("ACGT", k=rng.randint(180, 280))).encode()
+        seq1, seq2 = bytearray(amplicon[:read_len]), bytearray(reverse_complement(amplicon)[:read_len])
+        qual1, qual2 = bytearray(b"I" * read_len), bytearray(b"I" * read_len)
+        # A low-quality error in the overlap of R2, which the consensus corrects.
+        pos = read_len - 10
+        seq2[pos] = ord("A") if seq2[pos] != ord("A") else ord("C")
+        qual2[pos] = ord("+")
+        amplicons.append(amplicon)
+        pairs.append((f"read{i} 1:N:0:1".encode(), bytes(seq1), bytes(qual1), bytes(seq2), bytes(qual2)))
+    return amplicons, pairs
+
+
+def write_fastq(pairs, r1_path, r2_path):
+    with open(r1_path, "wb") as r1, open(r2_path, "wb") as r2:
+        for title, seq1, qual1, seq2, qual2 in pairs:
+            r1.write(b"@" + title + b"\n" + seq1 + b"\n+\n" + qual1 + b"\n")
+            r2.write(b"@" + title.replace(b" 1:", b" 2:") + b"\n" + seq2 + b"\n+\n" + qual2 + b"\n")
+
+
+@pytest.fixture
+def config():
+    config = StageConfig(verbose=True, logger=logger, n_cpu=2)
+    return config
+
+
+def test_merge_chunk():
+    amplicons, pairs = make_pairs(200)
+    merged, n_pairs, n_merged = merge_chunk(pairs)
+    lines = merged.split(b"\n")
+    assert (n_pairs, n_merged) == (200, 200)
+    assert lines[1::4][:200] == amplicons
+    assert lines[0] == b"@read0 1:N:0:1"
+    assert all(len(seq) == len(qual) for seq, qual in zip(lines[1::4], lines[3::4]))
+
+
+def test_merge_chunk_filters():
+    amplicons, pairs = make_pairs(50)
+    # Amplicons longer than 2 x 150 - 16 bases overlap too little to be merged.
+    long_pair = make_pairs(1, seed=1, read_len=150)[1][0]
+    long_pair = (long_pair[0], long_pair[1][:100], long_pair[2][:100], long_pair[3][:100], long_pair[4][:100])
+    merged, n_pairs, n_merged = merge_chunk(pairs + [long_pair])
+    assert (n_pairs, n_merged) == (51, 50)
+    # Every overlap has one mismatch.
+    assert merge_chunk(pairs, maxdiff=0)[2] == 0
+    assert merge_chunk(pairs, pctid=100)[2] == 0
+    # A trailing Q2 base truncates the read.
+    title, seq1, qual1, seq2, qual2 = pairs[0]
+    assert merge_chunk([(title, seq1, qual1[:20] + b"#" + qual1[21:], seq2, qual2)])[2] == 0
+
+
+def test_read_pair_chunk_mismatch(tmp_path):
+    _, pairs = make_pairs(10)
+    write_fastq(pairs, tmp_path / "R1.fastq", tmp_path / "R2.fastq")
+    with open(tmp_path / "R2.fastq", "ab") as handle:
+        handle.write(b"@extra\nACGT\n+\nIIII\n")
+    with open(tmp_path / "R1.fastq", "rb") as r1, open(tmp_path / "R2.fastq", "rb") as r2:
+        with pytest.raises(ValueError):
+            read_pair_chunk(r1, r2, n_pairs=100)
+
+
+@pytest.mark.parametrize("n_cpu", [1, 2])
+def test_stage_native(tmp_path, n_cpu):
+    config = StageConfig(verbose=True, logger=logger, n_cpu=n_cpu)
+    amplicons, pairs = make_pairs(5000)
+    decompress_dir = tmp_path / "decompress"
+    decompress_dir.mkdir()
+    write_fastq(pairs, decompress_dir / "test_R1.fastq", decompress_dir / "test_R2.fastq")
+    stage = MergeStage(config, decompress_dir=str(decompress_dir), save_dir=str(tmp_path / "merge"), backend="native")
+    assert stage.params == f"-fastq_maxdiffs 5 -fastq_pctid 90 -threads {n_cpu} -backend native"
+    stage.setup("test")
+    assert stage.run()
+    assert (tmp_path / "merge" / "test_merge.fastq").read_bytes().split(b"\n")[1::4] == amplicons
+    assert "5000  Merged (100.0%)" in (tmp_path / "merge" / "test_report.txt").read_text()
+
+
+def test_stage_invalid_backend(config):
+    with pytest.raises(ValueError):
+        MergeStage(config, backend="vsearch")
@@ -0,0 +1,69 @@
+import pytest
+import random
+
+from analysis_toolkit.runner_build.base_logger import logger
+from fastq_processor.step_build.stage_config import StageConfig
+from fastq_processor.step_exec.cut_primer import CutPrimerStage
+from fastq_processor.step_exec.dereplicate import DereplicateStage
+from fastq_processor.step_exec.fq_to_fa import FqToFaStage
+from fastq_processor.step_exec.merge import COMPLEMENT, MergeStage
+from fastq_processor.step_exec.preprocess import PreprocessStage
+
+RM_P_5 = "GTCGGTAAAACTCGTGCCAGC"
+RM_P_3 = "CAAACTGGGATTAGATACCCCACTATG"
+
+
+def write_pairs(n_pairs, r1_path, r2_path, seed=0, read_len=150):
+    """
+    Read pairs of amplicons drawn from a few species, with a few amplicons without primers and a few pairs that do not overlap.
+    """
+    rng = random.Random(seed)
+    species = ["".join(rng.choices("ACGT", k=rng.randint(150, 200))) for _ in range(20)]
+    with open(r1_path, "w") as r1, open(r2_path, "w") as r2:
+        for i in range(n_pairs):
+            amplicon = RM_P_5 + rng.choice(species) + RM_P_3
+            if i % 50 == 0:
+                amplicon = "".join(rng.choices("ACGT", k=len(amplicon)))
+            if i % 70 == 0:
+                amplicon = amplicon[:read_len] + "".join(rng.choices("ACGT", k=300))
+            rc = amplicon.encode().translate(COMPLEMENT)[::-1].decode()
+            r1.write(f"@read{i} 1:N:0:1\n{amplicon[:read_len]}\n+\n{'I' * read_len}\n")
+            r2.write(f"@read{i} 2:N:0:1\n{rc[:read_len]}\n+\n{'I' * read_len}\n")
+
+
+@pytest.fixture
+def config():
+    config = StageConfig(verbose=True, logger=logger, n_cpu=2)
+    return config
+
+
+def test_stage_matches_separate_stages(config, tmp_path):
+    decompress_dir = tmp_path / "decompress"
+    decompress_dir.mkdir()
+    write_pairs(2000, decompress_dir / "test_R1.fastq", decompress_dir / "test_R2.fastq")
+
+    stage = PreprocessStage(config, decompress_dir=str(decompress_dir), save_dir=str(tmp_path / "preprocess"),
+                            min_read_len=190, max_read_len=260)
+    stage.setup("test")
+    assert stage.run()
+
+    stages = [
+        MergeStage(config, decompress_dir=str(decompress_dir), save_dir=str(tmp_path / "merge"), backend="native"),
+        CutPrimerStage(config, merge_dir=str(tmp_path / "merge"), save_dir=str(tmp_path / "cut_primer"),
+                       min_read_len=190, max_read_len=260, backend="native"),
+        FqToFaStage(config, cutprimer_dir=str(tmp_path / "cut_primer"), save_dir=str(tmp_path / "fq_to_fa")),
+        DereplicateStage(config, fasta_dir=str(tmp_path / "fq_to_fa"), save_dir=str(tmp_path / "dereplicate"), backend="native"),
+    ]
+    for separate_stage in stages:
+        separate_stage.setup("test")
+        assert separate_stage.run()
+
+    assert (tmp_path / "preprocess" / "test_uniq.fasta").read_text() == (tmp_path / "dereplicate" / "test_uniq.fasta").read_text()
+    assert sorted(path.name for path in (tmp_path / "preprocess").iterdir()) == ["test_report.txt", "test_uniq.fasta"]
+
+    report = (tmp_path / "preprocess" / "test_report.txt").read_text().splitlines()
+    assert report[0] == "Pairs:                     2,000 (100.0%)"
+    assert report[1] == "Merged:                    1,971 (98.5%)"
+    assert report[6] == "Passing filters:           1,937 (96.8%)"
+    derep_report = (tmp_path / "dereplicate" / "test_report.txt").read_text().splitlines()
+    assert report[8:] == derep_report
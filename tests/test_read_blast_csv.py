@@ -0,0 +1,129 @@
+import pytest
+
+from analysis_toolkit.read import read_blast_csv
+from analysis_toolkit.read.read_blast_csv import BlastReader
+
+BLAST_TABLE = (
+    "Zotu1,gb|AB1|,Danio rerio,Danio,Cyprinidae,Cypriniformes,Actinopteri,Chordata,Metazoa,99.5,170,1,0,1,170,5,174,1.2e-80,310.0\n"
+    "Zotu2,gb|AB2|,Mugil cephalus,Mugil,Mugil,Mugiliformes,Actinopteri,Chordata,Metazoa,100.0,168,0,0,1,168,1,168,3e-85,311.5\n"
+    "Zotu3,gb|AB3|,Oryzias sp.:a/b,Oryzias,,,,,,91.2,165,14,1,2,166,1,165,2e-50,200.1\n"
+    "Zotu3,gb|AB4|,Oryzias latipes,Oryzias,Adrianichthyidae,Beloniformes,Actinopteri,Chordata,Metazoa,92.0,165,13,0,2,166,1,165,1e-52,205.0\n"
+)
+
+
+@pytest.fixture
+def blast_table(tmp_path):
+    path = tmp_path / "test_blast.csv"
+    path.write_text(BLAST_TABLE)
+    return str(path)
+
+
+def test_read_blast_columns(blast_table):
+    reader = BlastReader()
+    hits = reader.read_blast_columns(blast_table)
+    assert list(hits.columns) == reader.hit_columns
+    assert reader.hit_columns[2:9] == BlastReader.DESIRED_LEVEL
+    assert hits["length"].dtype == "int32"
+    assert hits["evalue"].dtype == "float64"
+    assert hits["species"].dtype == "category"
+    assert hits["bitscore"].tolist() == [310.0, 311.5, 200.1, 205.0]
+    assert hits["species"].tolist()[2] == "Oryzias sp._a_b"
+    assert hits["family"].tolist()[:3] == ["Cyprinidae", "Mugilidae", ""]
+
+
+def test_read_blast_table_matches_process_line(blast_table):
+    reader = BlastReader()
+    reader.read_blast_table(blast_table)
+    line_reader = BlastReader()
+    for line in BLAST_TABLE.splitlines(keepends=True):
+        line_reader.process_line(line)
+    assert reader.hap2level["Zotu1"] == line_reader.hap2level["Zotu1"]
+    assert reader.hap2level["Zotu2"] == line_reader.hap2level["Zotu2"]
+    # The two hits of Zotu3 disagree from the kingdom down, since the lineage of the first one is unknown.
+    assert set(reader.hap2level["Zotu3"].values()) == {""}
+    assert len(reader.hits) == 4
+
+
+@pytest.mark.parametrize("engine", ["pyarrow", "c"])
+def test_read_blast_table_empty(tmp_path, monkeypatch, engine):
+    if engine == "pyarrow":
+        pytest.importorskip("pyarrow")
+    else:
+        monkeypatch.setattr(read_blast_csv, "pyarrow", None)
+    path = tmp_path / "empty_blast.csv"
+    path.write_text("")
+    reader = BlastReader()
+    reader.read_blast_table(str(path))
+    assert reader.hap2level == {}
+    assert list(reader.hits.columns) == reader.hit_columns
+    assert reader.hits["length"].dtype == "int32"
+
+
+def test_read_blast_table_custom_specifiers(tmp_path):
+    path = tmp_path / "custom_blast.csv"
+    path.write_text(
+        "Zotu1,gb|AB1|,Danio rerio,Danio,Cyprinidae,Cypriniformes,Actinopteri,Chordata,Metazoa,99.5,170,1e-80,Danio rerio\n"
+        "Zotu1,gb|AB2|,Danio kyathit,Danio,Cyprinidae,Cypriniformes,Actinopteri,Chordata,Metazoa,96.0,170,1e-70,Danio kyathit\n"
+    )
+    reader = BlastReader(identity_thresholds={"species": 98}, specifiers="qseqid sseqid pident qlen evalue sscinames")
+    reader.read_blast_table(str(path))
+    assert list(reader.hits.columns[9:]) == ["pident", "qlen", "evalue", "sscinames"]
+    assert reader.hits["qlen"].dtype == "int32"
+    assert reader.hits["sscinames"].tolist() == ["Danio rerio", "Danio kyathit"]
+    assert reader.hap2level["Zotu1"]["species"] == "Danio rerio"
+
+
+def test_read_blast_table_mismatched_specifiers(blast_table):
+    # The table has more columns than the specifiers give: the taxonomy is still read from the leading columns.
+    reader = BlastReader(specifiers="qseqid sseqid evalue")
+    reader.read_blast_table(blast_table)
+    assert list(reader.hits.columns) == ["qseqid", "sseqid"] + BlastReader.DESIRED_LEVEL
+    assert reader.hap2level["Zotu1"]["species"] == "Danio rerio"
+
+    with pytest.raises(ValueError):
+        BlastReader(identity_thresholds={"species": 98}, specifiers="qseqid sseqid evalue")
+
+
+MULTI_HIT_TABLE = (
+    "Zotu1,gb|AB1|,Danio rerio,Danio,Cyprinidae,Cypriniformes,Actinopteri,Chordata,Metazoa,99.5,170,1,0,1,170,1,170,1e-80,310.0\n"
+    "Zotu1,gb|AB2|,Danio kyathit,Danio,Cyprinidae,Cypriniformes,Actinopteri,Chordata,Metazoa,96.0,170,7,0,1,170,1,170,1e-70,280.0\n"
+    "Zotu2,gb|AB3|,Oryzias latipes,Oryzias,Adrianichthyidae,Beloniformes,Actinopteri,Chordata,Metazoa,100.0,165,0,0,1,165,1,165,1e-85,305.0\n"
+    "Zotu1,gb|AB4|,Carassius auratus,Carassius,Cyprinidae,Cypriniformes,Actinopteri,Chordata,Metazoa,91.0,170,15,0,1,170,1,170,1e-50,220.0\n"
+    "Zotu2,gb|AB5|,Oryzias latipes,Oryzias,Adrianichthyidae,Beloniformes,Actinopteri,Chordata,Metazoa,99.0,165,2,0,1,165,1,165,1e-80,300.0\n"
+)
+
+
+@pytest.fixture
+def multi_hit_table(tmp_path):
+    path = tmp_path / "multi_blast.csv"
+    path.write_text(MULTI_HIT_TABLE)
+    return str(path)
+
+
+def test_read_blast_table_lca(multi_hit_table):
+    reader = BlastReader()
+    reader.read_blast_table(multi_hit_table)
+    assert list(reader.hap2level) == ["Zotu1", "Zotu2"]
+    assert reader.hap2level["Zotu1"] == {"species": "", "genus": "", "family": "Cyprinidae", "order": "Cypriniformes",
+                                         "class": "Actinopteri", "phylum": "Chordata", "kingdom": "Metazoa"}
+    assert reader.hap2level["Zotu2"]["species"] == "Oryzias latipes"
+
+
+def test_read_blast_table_lca_thresholds(multi_hit_table):
+    reader = BlastReader(identity_thresholds={"species": 98, "genus": 95})
+    reader.read_blast_table(multi_hit_table)
+    assert reader.hap2level["Zotu1"]["species"] == "Danio rerio"
+    assert reader.hap2level["Zotu1"]["genus"] == "Danio"
+    assert reader.hap2level["Zotu2"]["species"] == "Oryzias latipes"
+
+    # No hit reaches the species threshold, so only the levels above are assigned.
+    reader = BlastReader(identity_thresholds={"species": 99.9, "genus": 99})
+    reader.read_blast_table(multi_hit_table)
+    assert reader.hap2level["Zotu1"]["species"] == ""
+    assert reader.hap2level["Zotu1"]["genus"] == "Danio"
+    assert reader.hap2level["Zotu2"]["species"] == "Oryzias latipes"
+
+
+def test_invalid_identity_thresholds():
+    with pytest.raises(ValueError):
+        BlastReader(identity_thresholds={"strain": 99})
@@ -0,0 +1,96 @@
+import pytest
+
+from analysis_toolkit.read.read_denoise_report import DenoiseReportReader
+
+DENOISE_REPORT = (
+    "Uniq1;size=88422;\tdenoise\tamp1\n"
+    "Uniq2;size=9000;\tdenoise\tamp2\n"
+    "Uniq3;size=812;\tdenoise\tnoise\ttop=Uniq1\n"
+    "Uniq4;size=700;\tdenoise\tnoise\tdist=1\ttop=Uniq2\n"
+    "Uniq5;size=651;\tdenoise\tamp3\n"
+    "Uniq6;size=12;\tdenoise\tnoise\ttop=Uniq1\n"
+    "Uniq1;size=88422;\tchfilter\tzotu\n"
+    "Uniq2;size=9000;\tchfilter\tchimera\n"
+    "Uniq5;size=651;\tchfilter\tzotu\n"
+)
+
+
+@pytest.fixture
+def denoise_report(tmp_path):
+    path = tmp_path / "test_denoise_report.txt"
+    path.write_text(DENOISE_REPORT)
+    return str(path)
+
+
+def test_read_denoise_report(denoise_report):
+    reader = DenoiseReportReader()
+    reader.read_denoise_report(denoise_report)
+    assert reader.hap2amp == {"Zotu1": ["Uniq1", "Uniq3", "Uniq6"], "Chimera1": ["Uniq2", "Uniq4"], "Zotu2": ["Uniq5"]}
+    assert list(reader.hap2amp) == ["Zotu1", "Chimera1", "Zotu2"]
+    assert reader.amp_size == {"Uniq1": 88422, "Uniq2": 9000, "Uniq3": 812, "Uniq4": 700, "Uniq5": 651, "Uniq6": 12}
+    assert reader.hap_size == {"Zotu1": 88422, "Zotu2": 651}
+    assert reader.hap_sizes.tolist() == [88422, 9000, 651]
+    assert reader.amp_sizes.dtype == "int64"
+
+
+def test_read_denoise_report_chfilter_order(tmp_path):
+    # Haplotypes outside the chfilter step keep their names and come first. Every chfilter line is numbered,
+    # but only the first one naming a haplotype renames it.
+    path = tmp_path / "chfilter_order.txt"
+    path.write_text(
+        "Uniq1;size=50;\tdenoise\tamp1\n"
+        "Uniq2;size=40;\tdenoise\tamp2\n"
+        "Uniq3;size=30;\tdenoise\tamp3\n"
+        "Uniq4;size=3;\tdenoise\tnoise\ttop=Uniq3\n"
+        "Uniq3;size=30;\tchfilter\tzotu\n"
+        "Uniq8;size=8;\tchfilter\tchimera\n"
+        "Uniq1;size=50;\tchfilter\tchimera\n"
+        "Uniq3;size=30;\tchfilter\tzotu\n"
+    )
+    reader = DenoiseReportReader()
+    reader.read_denoise_report(str(path))
+    assert reader.hap_names == ["Uniq2", "Zotu1", "Chimera2"]
+    assert reader.hap2amp == {"Uniq2": ["Uniq2"], "Zotu1": ["Uniq3", "Uniq4"], "Chimera2": ["Uniq1"]}
+    assert reader.hap_size == {"Zotu1": 30, "Zotu2": 30}
+    assert reader.hap_sizes.tolist() == [40, 30, 50]
+
+
+def test_read_denoise_report_chunks(denoise_report):
+    # Chunks shorter than a line are carried over until a newline is found.
+    report = DenoiseReportReader.parse_tabbedout(denoise_report, chunk_size=7)
+    assert report["denoise_names"].astype(str).tolist() == [f"Uniq{i}" for i in range(1, 7)]
+    assert report["denoise_tops"].astype(str).tolist() == ["Uniq1", "Uniq2", "Uniq1", "Uniq2", "Uniq5", "Uniq1"]
+    assert report["chfilter_is_zotu"].tolist() == [True, False, True]
+
+
+def test_read_denoise_report_labelled_top(tmp_path):
+    path = tmp_path / "labelled_top.txt"
+    path.write_text("Uniq1;size=10;\tdenoise\tamp1\nUniq2;size=5;\tdenoise\tnoise\ttop=Uniq1;size=10;\tdist=1\n")
+    report = DenoiseReportReader.parse_tabbedout(str(path))
+    assert report["denoise_tops"].astype(str).tolist() == ["Uniq1", "Uniq1"]
+    assert report["denoise_sizes"].tolist() == [10, 5]
+
+
+def test_read_denoise_report_missing_top(tmp_path):
+    # Tops without an 'amp' line, and without a trailing newline at the end of the file, are haplotypes of their own.
+    path = tmp_path / "missing_top.txt"
+    path.write_text("Uniq1;size=10;\tdenoise\tamp1\nUniq2;size=5;\tdenoise\tnoise\ttop=Uniq9\nUniq1;size=10;\tchfilter\tzotu")
+    reader = DenoiseReportReader()
+    reader.read_denoise_report(str(path))
+    assert reader.hap2amp == {"Uniq9": ["Uniq2"], "Zotu1": ["Uniq1"]}
+
+
+def test_read_denoise_report_empty(tmp_path):
+    path = tmp_path / "empty_report.txt"
+    path.write_text("")
+    reader = DenoiseReportReader()
+    reader.read_denoise_report(str(path))
+    assert reader.hap2amp == {}
+    assert reader.hap_size == {}
+
+
+def test_invalid_size(tmp_path):
+    path = tmp_path / "invalid_report.txt"
+    path.write_text("Uniq1;size=1x;\tdenoise\tamp1\n")
+    with pytest.raises(ValueError):
+        DenoiseReportReader().read_denoise_report(str(path))
@@ -0,0 +1,71 @@
+import pickle
+
+import pytest
+from Bio import SeqIO
+
+from analysis_toolkit.read import read_fasta
+from analysis_toolkit.read.read_fasta import FastaReader, LazySequences
+
+UNIQ_FASTA = (
+    ">Uniq1;size=120;\nACGTACGTAC\n"
+    ">Uniq2;size=30;\nACGTAC\nGTAC\r\nTT\n"
+    ">Uniq3;size=2;\n"
+    ">Uniq4;size=1; extra words\nGGGG"
+)
+
+
+@pytest.fixture
+def uniq_fasta(tmp_path):
+    path = tmp_path / "test_uniq.fasta"
+    path.write_bytes(UNIQ_FASTA.encode())
+    return str(path)
+
+
+def test_parse_fasta_matches_seqio(uniq_fasta):
+    reader = FastaReader()
+    reader.read_fasta(uniq_fasta, seq_type="Haplotype")
+    with open(uniq_fasta) as handle:
+        expected = {record.description: str(record.seq) for record in SeqIO.parse(handle, "fasta")}
+    assert reader.seq_dict == expected
+    assert list(reader.seq_dict) == list(expected)
+
+
+def test_parse_fasta_amplicon(uniq_fasta):
+    reader = FastaReader()
+    reader.read_fasta(uniq_fasta, seq_type="Amplicon")
+    assert reader.seq_dict == {"Uniq1": "ACGTACGTAC", "Uniq2": "ACGTACGTACTT", "Uniq3": "", "Uniq4": "GGGG"}
+
+
+def test_parse_fasta_lazy(uniq_fasta):
+    reader = FastaReader()
+    reader.read_fasta(uniq_fasta, seq_type="Amplicon", lazy=True)
+    assert isinstance(reader.seq_dict, LazySequences)
+    assert reader.seq_dict["Uniq2"] == "ACGTACGTACTT"
+    # The mapping holds no open file, so it can be pickled.
+    restored = pickle.loads(pickle.dumps(reader.seq_dict))
+    assert dict(restored) == {"Uniq1": "ACGTACGTAC", "Uniq2": "ACGTACGTACTT", "Uniq3": "", "Uniq4": "GGGG"}
+    with pytest.raises(KeyError):
+        restored["Uniq5"]
+
+
+def test_lazy_open_maps_bounded(tmp_path, monkeypatch):
+    monkeypatch.setattr(read_fasta, "MAX_OPEN_MAPS", 2)
+    mappings = []
+    for i in range(5):
+        path = tmp_path / f"sample{i}_uniq.fasta"
+        path.write_text(f">Uniq1;size=3;\n{'ACGT' * (i + 1)}\n")
+        reader = FastaReader()
+        reader.read_fasta(str(path), seq_type="Amplicon", lazy=True)
+        mappings.append(reader.seq_dict)
+    for _ in range(2):
+        for i, mapping in enumerate(mappings):
+            assert mapping["Uniq1"] == "ACGT" * (i + 1)
+            assert len(read_fasta._open_maps) <= 2
+
+
+def test_parse_fasta_empty(tmp_path):
+    path = tmp_path / "empty.fasta"
+    path.write_text("")
+    reader = FastaReader()
+    reader.read_fasta(str(path))
+    assert reader.seq_dict == {}
@@ -0,0 +1,128 @@
+import pytest
+import json
+import subprocess
+import sys
+import time
+
+from analysis_toolkit.runner_build.base_logger import logger
+from fastq_processor.step_build.function_runner import FunctionRunner
+from fastq_processor.step_build.stage_builder import StageBuilder
+from fastq_processor.step_build.stage_config import StageConfig
+from fastq_processor.step_build.subproces_runner import StreamOutputRunner
+
+
+USAGE_KEYS = {"wall_s", "user_s", "sys_s", "max_rss_mb", "read_bytes", "write_bytes"}
+
+
+class NoopStage(StageBuilder):
+    def setup(self):
+        pass
+
+
+@pytest.fixture
+def metrics_path(tmp_path):
+    return str(tmp_path / "metrics.jsonl")
+
+
+@pytest.fixture
+def config(metrics_path):
+    config = StageConfig(verbose=True, logger=logger, metrics_path=metrics_path)
+    return config
+
+
+def read_metrics(metrics_path):
+    with open(metrics_path) as handle:
+        return [json.loads(line) for line in handle]
+
+
+def test_subprocess_metrics(config, metrics_path, tmp_path):
+    command = f"{sys.executable} -c \"print('x' * 1000)\""
+    runner = StreamOutputRunner("Print", command, str(tmp_path / "out.txt"), str(tmp_path / "err.txt"), config)
+    runner.tags = {"sample": "test", "stage": "stage_print"}
+    assert runner.run()
+
+    entries = read_metrics(metrics_path)
+    assert len(entries) == 1
+    assert entries[0]["sample"] == "test"
+    assert entries[0]["stage"] == "stage_print"
+    assert entries[0]["program"] == "Print"
+    assert entries[0]["complete"]
+    assert USAGE_KEYS <= set(entries[0])
+    assert entries[0]["max_rss_mb"] > 0
+
+
+def test_failed_subprocess_metrics(config, metrics_path, tmp_path):
+    command = f"{sys.executable} -c \"raise SystemExit(3)\""
+    runner = StreamOutputRunner("Exit", command, str(tmp_path / "out.txt"), str(tmp_path / "err.txt"), config)
+    assert not runner.run()
+    assert not read_metrics(metrics_path)[0]["complete"]
+
+
+def test_pipeline_start_failure_reaps_started(config, tmp_path, monkeypatch):
+    started = []
+    popen = subprocess.Popen
+
+    def record_popen(*args, **kwargs):
+        process = popen(*args, **kwargs)
+        started.append(process)
+        return process
+
+    monkeypatch.setattr(subprocess, "Popen", record_popen)
+    # The first command would block forever on a full pipe if it were left running.
+    commands = [f"{sys.executable} -c \"while True: print('x' * 1000)\"", str(tmp_path / "missing_program")]
+    runner = StreamOutputRunner("Pipeline", commands, str(tmp_path / "out.txt"), str(tmp_path / "err.txt"), config)
+    assert not runner.run()
+    assert len(started) == 1
+    assert started[0].returncode is not None
+
+
+def test_function_metrics(config, metrics_path):
+    runner = FunctionRunner("Allocate", lambda: bytearray(50 * 1024 * 1024), config)
+    assert runner.run()
+
+    entry = read_metrics(metrics_path)[0]
+    assert entry["program"] == "Allocate"
+    assert USAGE_KEYS <= set(entry)
+    assert entry["wall_s"] >= 0
+
+
+def test_no_metrics_path(tmp_path):
+    config = StageConfig(verbose=True, logger=logger)
+    runner = FunctionRunner("Nothing", lambda: None, config)
+    assert runner.run()
+    assert USAGE_KEYS == set(runner.usage)
+
+
+def hold_memory(size_mb):
+    # Memory is sampled periodically, so the allocation is kept for a few sampling intervals.
+    data = b"x" * (size_mb * 1024 * 1024)
+    time.sleep(0.3)
+    return data
+
+
+def test_function_memory_is_a_delta(config):
+    # The interpreter and its imports are already resident, so only the allocation is counted.
+    runner = FunctionRunner("Allocate", lambda: hold_memory(200), config)
+    assert runner.run()
+    assert 150 < runner.usage["max_rss_mb"] < 400
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="child processes are listed from /proc")
+def test_function_memory_counts_children(config):
+    command = [sys.executable, "-c", "import time; x = b'x' * (200 * 1024 * 1024); time.sleep(0.5)"]
+    runner = FunctionRunner("Child", lambda: subprocess.run(command, check=True), config)
+    assert runner.run()
+    assert runner.usage["max_rss_mb"] > 150
+
+
+def test_stage_peak_memory_ignores_functions(config, tmp_path):
+    stage = NoopStage("Mixed", config)
+    stage.add_stage_function("Allocate", lambda: hold_memory(100))
+    assert stage.run()
+    assert stage.peak_rss_mb > 50
+    assert stage.get_peak_memory() is None
+
+    stage.add_stage_function("Allocate", lambda: hold_memory(100))
+    stage.add_stage_stream_to_file("Print", f"{sys.executable} -c \"print('x')\"", str(tmp_path / "out.txt"), str(tmp_path / "err.txt"))
+    assert stage.run()
+    assert 0 < stage.get_peak_memory() * 1024 < stage.peak_rss_mb
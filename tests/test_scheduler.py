@@ -0,0 +1,178 @@
+import pytest
+import threading
+import time
+
+from analysis_toolkit.runner_build.base_logger import logger
+from fastq_processor.run_processor import FastqProcessor
+from fastq_processor.step_build.scheduler import DagScheduler
+
+
+@pytest.fixture
+def scheduler():
+    return DagScheduler(n_cpu=2, logger=logger)
+
+
+def test_add_task(scheduler):
+    scheduler.add_task(("s1", "a"), lambda: True)
+    with pytest.raises(ValueError):
+        scheduler.add_task(("s1", "a"), lambda: True)
+    with pytest.raises(ValueError):
+        scheduler.add_task(("s1", "b"), lambda: True, depends_on=[("s1", "unknown")])
+
+    task = scheduler.add_task(("s1", "c"), lambda: True, n_cpu=8)
+    assert task.n_cpu == 2
+
+
+def test_run_order(scheduler):
+    order = []
+    lock = threading.Lock()
+
+    def record(name):
+        def func():
+            with lock:
+                order.append(name)
+            return True
+        return func
+
+    scheduler.add_task(("s1", "a"), record("s1a"))
+    scheduler.add_task(("s1", "b"), record("s1b"), depends_on=[("s1", "a")])
+    scheduler.add_task(("s1", "c"), record("s1c"), depends_on=[("s1", "b")])
+    status = scheduler.run()
+
+    assert order == ["s1a", "s1b", "s1c"]
+    assert set(status.values()) == {"COMPLETE"}
+
+
+def test_failure_skips_dependents(scheduler):
+    scheduler.add_task(("s1", "a"), lambda: False)
+    scheduler.add_task(("s1", "b"), lambda: True, depends_on=[("s1", "a")])
+    scheduler.add_task(("s2", "a"), lambda: True)
+    status = scheduler.run()
+
+    expected = {("s1", "a"): "FAIL", ("s1", "b"): "SKIP", ("s2", "a"): "COMPLETE"}
+    assert status == expected
+
+
+def test_exception_is_failure(scheduler):
+    def raise_error():
+        raise RuntimeError("boom")
+
+    scheduler.add_task(("s1", "a"), raise_error)
+    assert scheduler.run() == {("s1", "a"): "FAIL"}
+
+
+def test_cpu_budget_and_overlap():
+    scheduler = DagScheduler(n_cpu=3, logger=logger)
+    running = []
+    peak = []
+    lock = threading.Lock()
+
+    def work(n_cpu):
+        def func():
+            with lock:
+                running.append(n_cpu)
+                peak.append(sum(running))
+            time.sleep(0.05)
+            with lock:
+                running.remove(n_cpu)
+            return True
+        return func
+
+    scheduler.add_task(("s1", "heavy"), work(2), n_cpu=2)
+    scheduler.add_task(("s2", "light"), work(1), n_cpu=1)
+    scheduler.add_task(("s2", "heavy"), work(2), n_cpu=2, depends_on=[("s2", "light")])
+    scheduler.run()
+
+    assert max(peak) == 3
+    assert scheduler.tasks[("s2", "light")].start_time < scheduler.tasks[("s1", "heavy")].end_time
+
+
+def test_critical_path(scheduler):
+    scheduler.add_task(("s1", "a"), lambda: True)
+    scheduler.add_task(("s1", "b"), lambda: True, depends_on=[("s1", "a")])
+    scheduler.add_task(("s2", "a"), lambda: True)
+    for name, (start, end) in {("s1", "a"): (0, 1), ("s1", "b"): (1, 4), ("s2", "a"): (0, 2)}.items():
+        scheduler.tasks[name].start_time, scheduler.tasks[name].end_time = start, end
+
+    path, total = scheduler.critical_path()
+    assert path == [("s1", "a"), ("s1", "b")]
+    assert total == 4
+
+
+def test_memory_budget():
+    scheduler = DagScheduler(n_cpu=4, logger=logger, memory=4)
+    running = []
+    peak = []
+    lock = threading.Lock()
+
+    def work(memory):
+        def func():
+            with lock:
+                running.append(memory)
+                peak.append(sum(running))
+            time.sleep(0.05)
+            with lock:
+                running.remove(memory)
+            return True
+        return func
+
+    for sample in ["s1", "s2", "s3"]:
+        scheduler.add_task((sample, "denoise"), work(3), memory=3)
+    status = scheduler.run()
+
+    assert set(status.values()) == {"COMPLETE"}
+    assert max(peak) == 3
+
+
+def test_oversized_task_runs_alone():
+    scheduler = DagScheduler(n_cpu=2, logger=logger, memory=2)
+    scheduler.add_task(("s1", "blast"), lambda: True, memory=16)
+    scheduler.add_task(("s2", "blast"), lambda: True, memory=1)
+    assert set(scheduler.run().values()) == {"COMPLETE"}
+
+
+def test_learned_memory():
+    scheduler = DagScheduler(n_cpu=2, logger=logger, memory=8)
+    scheduler.add_task(("s1", "denoise"), lambda: True, memory=1, kind="denoise", get_peak_memory=lambda: 5.0)
+    scheduler.run()
+
+    assert scheduler.broker.learned_memory == {"denoise": 5.0}
+    assert scheduler.broker.estimate_memory("denoise", 1) == pytest.approx(6.0)
+    assert scheduler.broker.estimate_memory("merge", 1) == 1
+
+
+def test_oversized_task_not_starved():
+    scheduler = DagScheduler(n_cpu=2, logger=logger, memory=2)
+    running = []
+    overlaps = []
+    lock = threading.Lock()
+
+    def work(name, duration=0.05):
+        def func():
+            with lock:
+                running.append(name)
+                overlaps.append(list(running))
+            time.sleep(duration)
+            with lock:
+                running.remove(name)
+            return True
+        return func
+
+    # Staggered durations, so there is always a small task running unless the scheduler holds the others back.
+    for i in range(2):
+        scheduler.add_task((f"s{i}", "merge"), work(f"s{i}", 0.05 * (i + 1)), memory=1)
+    scheduler.add_task(("big", "blast"), work("big"), memory=16)
+    for i in range(2, 8):
+        scheduler.add_task((f"s{i}", "merge"), work(f"s{i}", 0.05 * (i % 2 + 1)), memory=1)
+    assert set(scheduler.run().values()) == {"COMPLETE"}
+
+    # The small tasks queued after the oversized one wait for it instead of running around it until the queue drains.
+    big = scheduler.tasks[("big", "blast")]
+    assert all(big.start_time <= scheduler.tasks[(f"s{i}", "merge")].start_time for i in range(2, 8))
+    assert ["big"] in overlaps and not any("big" in names and len(names) > 1 for names in overlaps)
+
+
+@pytest.mark.parametrize("scheduler_type", ["DAG", "dag "])
+def test_invalid_scheduler_type(tmp_path, scheduler_type):
+    with pytest.raises(ValueError):
+        FastqProcessor(str(tmp_path), "fastq", db_path="", lineage_path="", scheduler_type=scheduler_type)
@@ -0,0 +1,66 @@
+from collections.abc import ItemsView, ValuesView
+import pickle
+
+import numpy as np
+import pytest
+
+from analysis_toolkit.runner_exec.sequence_store import PackedSequences, SequenceStore
+
+SEQS = ["ACGTACGTA", "", "GGNNCRTA", "acgT", "TTTT", "ACGTACGTA"]
+
+
+def test_add_and_get():
+    store = SequenceStore()
+    seq_ids = store.add(SEQS)
+    assert seq_ids.tolist() == [0, 1, 2, 3, 4, 0]
+    assert [store.get(seq_id) for seq_id in seq_ids] == SEQS
+    assert store.get_many(seq_ids[::-1]) == SEQS[::-1]
+    # Two bits per base, every sequence starting at a byte boundary.
+    assert store.n_bytes == 3 + 0 + 2 + 1 + 1
+    assert bytes(store.exception_chars) == b"NNRacg"
+
+
+def test_global_deduplication():
+    store = SequenceStore()
+    first = store.pack({"Uniq1": "ACGT", "Uniq2": "GGGG"})
+    second = store.pack({"Uniq1": "GGGG", "Uniq2": "CCCN"})
+    assert len(store) == 3
+    assert dict(first) == {"Uniq1": "ACGT", "Uniq2": "GGGG"}
+    assert second["Uniq2"] == "CCCN"
+    assert list(second.items()) == [("Uniq1", "GGGG"), ("Uniq2", "CCCN")]
+    with pytest.raises(KeyError):
+        first["Uniq3"]
+
+
+def test_pickle_shares_store():
+    store = SequenceStore()
+    samples = [store.pack({"Zotu1": "ACGTTGCA", "Zotu2": "TTNA"}), store.pack({"Zotu1": "TTNA"})]
+    restored = pickle.loads(pickle.dumps(samples))
+    assert restored[0].store is restored[1].store
+    assert restored[1]["Zotu1"] == "TTNA"
+    # The deduplication index is rebuilt when sequences are added after loading.
+    assert restored[0].store.add(["ACGTTGCA", "GATTACA"]).tolist() == [0, 2]
+    assert restored[0].store.get(2) == "GATTACA"
+
+
+def test_random_sequences():
+    rng = np.random.default_rng(0)
+    seqs = ["".join(rng.choice(list("ACGTN"), size=n, p=[0.249, 0.25, 0.25, 0.25, 0.001])) for n in rng.integers(0, 200, 500)]
+    store = SequenceStore()
+    packed = store.pack(dict(enumerate(seqs)))
+    assert isinstance(packed, PackedSequences)
+    assert list(packed.values()) == seqs
+    assert [packed[i] for i in range(len(seqs))] == seqs
+
+
+def test_mapping_views():
+    store = SequenceStore()
+    packed = store.pack({"Zotu1": "ACGT", "Zotu2": "TTNA"})
+    items, values = packed.items(), packed.values()
+    assert isinstance(items, ItemsView) and isinstance(values, ValuesView)
+    assert len(items) == len(values) == 2
+    assert ("Zotu2", "TTNA") in items and ("Zotu2", "ACGT") not in items
+    assert "TTNA" in values and "GGGG" not in values
+    assert items == {("Zotu1", "ACGT"), ("Zotu2", "TTNA")}
+    assert packed == {"Zotu1": "ACGT", "Zotu2": "TTNA"}
+    assert list(values) == ["ACGT", "TTNA"]
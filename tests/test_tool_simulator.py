@@ -0,0 +1,90 @@
+import pytest
+import csv
+import gzip
+import random
+import subprocess
+import time
+
+from fastq_processor.run_processor import FastqProcessor
+from fastq_processor.step_build import tool_simulator
+
+RM_P_5 = "GTCGGTAAAACTCGTGCCAGC"
+RM_P_3 = "CAAACTGGGATTAGATACCCCACTATG"
+LINEAGE = (
+    "genus_name,family_name,order_name,class_name,phylum_name,kingdom_name\n"
+    "Danio,Cyprinidae,Cypriniformes,Actinopteri,Chordata,Metazoa\n"
+    "Oryzias,Adrianichthyidae,Beloniformes,Actinopteri,Chordata,Metazoa\n"
+)
+
+
+def write_sample(fastq_dir, prefix, n_pairs=300, seed=0):
+    rng = random.Random(seed)
+    inserts = ["".join(rng.choices("ACGT", k=rng.randint(165, 180))) for _ in range(5)]
+    with gzip.open(fastq_dir / f"{prefix}_R1.fastq.gz", "wt") as r1, gzip.open(fastq_dir / f"{prefix}_R2.fastq.gz", "wt") as r2:
+        for i in range(n_pairs):
+            amplicon = RM_P_5 + inserts[i % len(inserts)] + RM_P_3
+            r1.write(f"@read{i} 1:N:0:1\n{amplicon[:150]}\n+\n{'I' * 150}\n")
+            r2.write(f"@read{i} 2:N:0:1\n{tool_simulator.reverse_complement(amplicon)[:150]}\n+\n{'I' * 150}\n")
+    return inserts
+
+
+@pytest.fixture
+def programs(tmp_path):
+    return tool_simulator.write_executables(str(tmp_path / "bin"))
+
+
+def test_version(programs):
+    result = subprocess.run([programs["usearch"], "--version"], capture_output=True, text=True)
+    assert result.returncode == 0
+    assert result.stdout == tool_simulator.VERSIONS["usearch"] + "\n"
+
+
+def test_unoise3(tmp_path):
+    uniques = tmp_path / "uniq.fasta"
+    parent = "ACGT" * 30
+    variant = parent[:10] + "T" + parent[11:]
+    uniques.write_text(f">Uniq1;size=100\n{parent}\n>Uniq2;size=10\n{variant}\n>Uniq3;size=9\n{'A' * 120}\n>Uniq4;size=2\n{'C' * 120}\n")
+    args = ["-unoise3", str(uniques), "-minsize", "8", "-unoise_alpha", "2",
+            "-zotus", str(tmp_path / "zotus.fasta"), "-tabbedout", str(tmp_path / "report.txt")]
+    assert tool_simulator.main("usearch", args) == 0
+    # 10/100 is below 1/2^(2*1+1), so Uniq2 is noise; Uniq4 is below minsize.
+    assert (tmp_path / "report.txt").read_text().splitlines() == [
+        "Uniq1;size=100;\tdenoise\tamp1",
+        "Uniq2;size=10;\tdenoise\tnoise\ttop=Uniq1",
+        "Uniq3;size=9;\tdenoise\tamp2",
+        "Uniq1;size=100;\tchfilter\tzotu",
+        "Uniq3;size=9;\tchfilter\tzotu",
+    ]
+    assert (tmp_path / "zotus.fasta").read_text() == f">Zotu1\n{parent}\n>Zotu2\n{'A' * 120}\n"
+
+
+def test_missing_input():
+    assert tool_simulator.main("usearch", ["-fastx_uniques", "missing.fasta", "-fastaout", "out.fasta"]) == 1
+
+
+def test_burn():
+    start = time.process_time()
+    tool_simulator.burn(1 << 20, cpu_s_per_mb=0.2, memory_mb_per_mb=1)
+    assert time.process_time() - start >= 0.2
+
+
+def test_pipeline(tmp_path, programs):
+    fastq_dir = tmp_path / "fastq"
+    fastq_dir.mkdir()
+    samples = {f"sample{i}": write_sample(fastq_dir, f"sample{i}", seed=i) for i in range(3)}
+    (tmp_path / "db.fasta").write_text(">gb|Danio_rerio\nACGT\n>gb|Oryzias_latipes\nACGT\n")
+    (tmp_path / "lineage.csv").write_text(LINEAGE)
+
+    processor = FastqProcessor(str(tmp_path), "fastq", db_path=str(tmp_path / "db"), lineage_path=str(tmp_path / "lineage.csv"),
+                               n_cpu=2, n_workers=2, scheduler_type="dag", decompress_backend="pigz", minsize=2,
+                               programs=programs, record_metrics=False)
+    assert all(result["complete"] for result in processor.summary.values())
+
+    for prefix, inserts in samples.items():
+        zotus = [line for line in (tmp_path / "denoise" / f"{prefix}_denoise.fasta").read_text().splitlines() if not line.startswith(">")]
+        assert sorted(zotus) == sorted(inserts)
+        with open(tmp_path / "blast" / f"{prefix}_blast.csv") as handle:
+            hits = list(csv.reader(handle))
+        assert len(hits) == len(inserts)
+        assert {hit[2] for hit in hits} <= {"Danio_rerio", "Oryzias_latipes"}
+        assert {hit[4] for hit in hits} <= {"Cyprinidae", "Adrianichthyidae"}